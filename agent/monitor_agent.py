@@ -12,7 +12,12 @@ import time
 import json
 import socket
 import argparse
+import calendar
+import hashlib
+import struct
 import sys
+import zlib
+from collections import deque
 from datetime import datetime
 
 # Python 2/3 compatibility
@@ -35,9 +40,125 @@ except ImportError:
     else:
         import urllib2
 
+# zstd compression is optional, gzip (zlib) is always available
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
+# Content-Encodings the agent can produce, preferred first
+AGENT_ENCODINGS = ['zstd', 'gzip'] if HAS_ZSTD else ['gzip']
+
+# Payloads smaller than this are sent uncompressed
+COMPRESSION_MIN_SIZE = 512
+
+# Compact binary sample format (layout documented in backend/wire_format.py,
+# the field list below must match SAMPLE_FIELDS there)
+BINARY_CONTENT_TYPE = 'application/vnd.monitoring.sample'
+BINARY_MAGIC = b'MSMP'
+BINARY_VERSION = 1
+# Version 2 adds FLAG_PARTITION_USAGE: partitions carry used/free/percent only
+BINARY_VERSION_PARTITION_USAGE = 2
+FLAG_PARTITION_USAGE = 0x01
+
+# (section, key, kind) of the fixed numeric fields, in wire order ('i' fields travel as int64)
+BINARY_FIELDS = [
+    ('cpu', 'cpu_percent_total', 'f'), ('cpu', 'cpu_count_logical', 'i'), ('cpu', 'cpu_count_physical', 'i'),
+    ('cpu', 'cpu_freq_current', 'f'), ('cpu', 'cpu_freq_min', 'f'), ('cpu', 'cpu_freq_max', 'f'),
+    ('memory', 'memory_total', 'i'), ('memory', 'memory_available', 'i'), ('memory', 'memory_used', 'i'),
+    ('memory', 'memory_percent', 'f'), ('memory', 'memory_free', 'i'), ('memory', 'swap_total', 'i'),
+    ('memory', 'swap_used', 'i'), ('memory', 'swap_free', 'i'), ('memory', 'swap_percent', 'f'),
+    ('network', 'bytes_sent', 'i'), ('network', 'bytes_recv', 'i'), ('network', 'packets_sent', 'i'),
+    ('network', 'packets_recv', 'i'), ('network', 'errin', 'i'), ('network', 'errout', 'i'),
+    ('network', 'dropin', 'i'), ('network', 'dropout', 'i'),
+    ('network', 'bytes_sent_per_sec', 'o'), ('network', 'bytes_recv_per_sec', 'o'),
+    ('disk_io', 'read_count', 'i'), ('disk_io', 'write_count', 'i'), ('disk_io', 'read_bytes', 'i'),
+    ('disk_io', 'write_bytes', 'i'), ('disk_io', 'read_time', 'i'), ('disk_io', 'write_time', 'i'),
+    ('disk_io', 'read_bytes_per_sec', 'o'), ('disk_io', 'write_bytes_per_sec', 'o'),
+]
+BINARY_SCHEMA_SECTIONS = ('timestamp', 'cpu', 'memory', 'disk', 'io')
+BINARY_HEADER = struct.Struct('<4sBBI')
+BINARY_NUMBERS = struct.Struct('<dQ' + ''.join('q' if kind == 'i' else 'd' for _, _, kind in BINARY_FIELDS) + '3d')
+BINARY_PARTITION = struct.Struct('<QQQHH')
+BINARY_PARTITION_USAGE = struct.Struct('<QQH')
+
+
+def to_bytes(value):
+    """UTF-8 encode text (Python 2 str is already bytes)"""
+    return value if isinstance(value, bytes) else value.encode('utf-8')
+
+
+def iso_to_epoch(timestamp):
+    """Convert a naive UTC ISO timestamp (datetime.isoformat()) to epoch seconds"""
+    fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in timestamp else '%Y-%m-%dT%H:%M:%S'
+    dt = datetime.strptime(timestamp, fmt)
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+def encode_binary_sample(metrics):
+    """Encode a sample dict as one binary record"""
+    sections = {
+        'cpu': metrics.get('cpu') or {},
+        'memory': metrics.get('memory') or {},
+        'network': (metrics.get('io') or {}).get('network') or {},
+        'disk_io': (metrics.get('io') or {}).get('disk_io') or {}
+    }
+    
+    missing = 0
+    values = []
+    for index, (section, key, kind) in enumerate(BINARY_FIELDS):
+        value = sections[section].get(key)
+        if value is None:
+            missing |= 1 << index
+            value = 0
+        values.append(int(value) if kind == 'i' else float(value))
+    
+    load_average = sections['cpu'].get('load_average')
+    if not load_average:
+        missing |= 1 << len(BINARY_FIELDS)
+        load_average = [0.0, 0.0, 0.0]
+    
+    numbers = [iso_to_epoch(metrics['timestamp']), missing] + values + [float(v) for v in load_average]
+    parts = [BINARY_NUMBERS.pack(*numbers)]
+    
+    cores = [int(round(value * 100)) for value in sections['cpu'].get('cpu_percent_per_core') or []]
+    parts.append(struct.pack('<H%dH' % len(cores), len(cores), *cores))
+    
+    disk = metrics.get('disk') or {}
+    usage = disk.get('usage')
+    partitions = disk.get('partitions') or []
+    parts.append(struct.pack('<H', len(partitions if usage is None else usage)))
+    for used, free, percent in usage or []:
+        parts.append(BINARY_PARTITION_USAGE.pack(used, free, int(round(percent * 100))))
+    for partition in partitions if usage is None else []:
+        names = b'\0'.join(to_bytes(partition.get(name) or '') for name in ('device', 'mountpoint', 'fstype'))
+        parts.append(BINARY_PARTITION.pack(partition['total'], partition['used'], partition['free'],
+                                           int(round(partition['percent'] * 100)), len(names)))
+        parts.append(names)
+    
+    extras = dict((k, v) for k, v in metrics.items() if k not in BINARY_SCHEMA_SECTIONS)
+    encoded_extras = to_bytes(json.dumps(extras)) if extras else b''
+    parts.append(struct.pack('<I', len(encoded_extras)) + encoded_extras)
+    
+    body = b''.join(parts)
+    if usage is None:
+        header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, 0, BINARY_HEADER.size + len(body))
+    else:
+        header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION_PARTITION_USAGE, FLAG_PARTITION_USAGE,
+                                    BINARY_HEADER.size + len(body))
+    return header + body
+
+
+def content_hash(value):
+    """Short stable hash of a JSON-serializable value"""
+    return hashlib.sha1(to_bytes(json.dumps(value, sort_keys=True))).hexdigest()[:16]
+
 
 class MonitoringAgent:
-    def __init__(self, server_url: str, api_key: str, hostname: str = None, interval: int = 5, use_key_mapping: bool = True):
+    def __init__(self, server_url: str, api_key: str, hostname: str = None, interval: int = 5, use_key_mapping: bool = True,
+                 batch_size: int = 50, max_backlog: int = 720, compression: str = 'auto',
+                 wire_format: str = 'auto', static_interval: int = 60):
         """
         Initialize monitoring agent
         
@@ -48,6 +169,12 @@ class MonitoringAgent:
             interval: Collection interval in seconds
             use_key_mapping: If True, hostname will be determined by API key on server side (more secure)
                            If False, agent sends its own hostname
+            batch_size: Maximum number of backlogged samples sent in one /api/metrics/batch request
+            max_backlog: Maximum number of unsent samples kept while the server is unreachable
+            compression: 'auto' (best encoding the server accepts), 'zstd', 'gzip' or 'none'
+            wire_format: 'auto' (binary once the server accepts it), 'binary' (from the first request) or 'json'
+            static_interval: Resend unchanged static sections (system info, partition layout)
+                             at least every N cycles
         """
         self.server_url = server_url
         self.api_key = api_key
@@ -57,6 +184,20 @@ class MonitoringAgent:
         self.previous_net_io = None
         self.previous_disk_io = None
         self.previous_time = None
+        self.batch_size = batch_size
+        self.backlog = deque(maxlen=max_backlog)  # Samples not yet accepted by the server, oldest first
+        self.batch_supported = True  # Cleared when the server has no /api/metrics/batch endpoint
+        self.compression = compression
+        # Negotiated from the server's Accept-Encoding response header, plain JSON until then
+        self.content_encoding = None
+        self.wire_format = wire_format
+        # Negotiated from the server's Accept-Post response header in auto mode
+        self.use_binary = wire_format == 'binary'
+        self.static_interval = static_interval
+        # Set when the server advertises X-Metrics-Delta (it can fill in omitted static sections)
+        self.delta_supported = False
+        self.static_sent = {}  # section -> content hash last sent in full
+        self.cycles_since_static = 0
         
     def get_cpu_metrics(self):
         """Collect CPU metrics"""
@@ -267,57 +408,199 @@ class MonitoringAgent:
             'uptime': uptime_str
         }
     
-    def send_metrics(self, metrics):
-        """Send metrics to central server"""
+    def prepare_metrics(self, metrics):
+        """Shape a sample for sending"""
+        # If using key mapping, don't send hostname in metrics
+        # Server will determine hostname from API key
+        if self.use_key_mapping:
+            # Remove hostname from metrics, server will add it
+            sample = dict((k, v) for k, v in metrics.items() if k != 'hostname')
+        else:
+            # Send metrics with hostname
+            sample = dict(metrics)
+        
+        if self.delta_supported:
+            self.suppress_static_sections(sample)
+        
+        return sample
+    
+    def suppress_static_sections(self, sample):
+        """Replace static sections the server already has with their content hash
+        
+        System info is reduced to its uptime and the partition list to [used, free, percent]
+        per partition. Every section is sent in full when its hash changes, every
+        static_interval cycles, and after the server asks for a resync.
+        """
+        system = sample.get('system') or {}
+        partitions = (sample.get('disk') or {}).get('partitions') or []
+        
+        hashes = {
+            'system': content_hash(dict((k, v) for k, v in system.items() if k != 'uptime')),
+            'disk': content_hash([[p.get('device'), p.get('mountpoint'), p.get('fstype'), p.get('total')]
+                                  for p in partitions])
+        }
+        sample['static'] = hashes
+        
+        self.cycles_since_static += 1
+        if self.cycles_since_static >= self.static_interval:
+            self.static_sent = {}
+            self.cycles_since_static = 0
+        
+        if 'system' in sample and self.static_sent.get('system') == hashes['system']:
+            del sample['system']
+            sample['uptime'] = system.get('uptime')
+        else:
+            self.static_sent['system'] = hashes['system']
+        
+        if 'disk' in sample and self.static_sent.get('disk') == hashes['disk']:
+            sample['disk'] = {'usage': [[p['used'], p['free'], p['percent']] for p in partitions]}
+        else:
+            self.static_sent['disk'] = hashes['disk']
+    
+    def handle_response(self, text):
+        """Process the server's reply to an accepted POST"""
         try:
+            reply = json.loads(text)
+        except (TypeError, ValueError):
+            return
+        
+        resync = reply.get('resync') if isinstance(reply, dict) else None
+        if resync:
+            # Server lost (or never had) these static sections, send them in full next time
+            print("Server requested full resend of: {0}".format(', '.join(resync)))
+            for section in resync:
+                self.static_sent.pop(section, None)
+    
+    def negotiate_encoding(self, accept_encoding):
+        """Pick the request Content-Encoding from the server's Accept-Encoding header"""
+        if self.compression == 'none' or accept_encoding is None:
+            return
+        
+        offered = [e.strip().lower() for e in accept_encoding.split(',')]
+        wanted = AGENT_ENCODINGS if self.compression == 'auto' else [self.compression]
+        encoding = next((e for e in wanted if e in offered and e in AGENT_ENCODINGS), None)
+        
+        if encoding != self.content_encoding:
+            print("Payload compression: {0}".format(encoding or 'none'))
+            self.content_encoding = encoding
+    
+    def negotiate_format(self, accept_post):
+        """Switch to the binary sample format when the server's Accept-Post lists it"""
+        if self.wire_format != 'auto' or accept_post is None:
+            return
+        
+        offered = [t.strip().lower() for t in accept_post.split(',')]
+        use_binary = BINARY_CONTENT_TYPE in offered
+        
+        if use_binary != self.use_binary:
+            print("Payload format: {0}".format('binary' if use_binary else 'json'))
+            self.use_binary = use_binary
+    
+    def encode_samples(self, samples, batch):
+        """Serialize samples in the negotiated format, returns (body, content_type)"""
+        if self.use_binary:
+            return b''.join(encode_binary_sample(sample) for sample in samples), BINARY_CONTENT_TYPE
+        
+        json_data = json.dumps(samples if batch else samples[0])
+        return to_bytes(json_data), 'application/json'
+    
+    def compress(self, data):
+        """Compress a request body with the negotiated encoding, returns (body, encoding)"""
+        if not self.content_encoding or len(data) < COMPRESSION_MIN_SIZE:
+            return data, None
+        
+        if self.content_encoding == 'zstd':
+            return zstandard.ZstdCompressor(level=3).compress(data), 'zstd'
+        
+        # gzip container via zlib (gzip.compress is not available on Python 2)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush(), 'gzip'
+    
+    def post(self, url, data, headers):
+        """POST raw bytes, returns (status_code, response_text, response_headers)"""
+        if HAS_REQUESTS:
+            # Use requests library (preferred)
+            response = requests.post(url, data=data, headers=headers, timeout=10)
+            return response.status_code, response.text, response.headers
+        
+        # Fallback to urllib (Python 2/3 compatible)
+        req = urllib2.Request(url, data=data, headers=headers)
+        
+        try:
+            response = urllib2.urlopen(req, timeout=10)
+            return response.getcode(), response.read(), response.info()
+        except urllib2.HTTPError as e:
+            return e.code, e.read(), e.info()
+    
+    def post_samples(self, path, samples, batch=False):
+        """POST samples to the server, returns (status_code, response_text)"""
+        url = "{0}{1}".format(self.server_url, path)
+        
+        while True:
+            data, content_type = self.encode_samples(samples, batch)
+            body, encoding = self.compress(data)
             headers = {
-                'Content-Type': 'application/json',
+                'Content-Type': content_type,
                 'X-API-Key': self.api_key
             }
+            if encoding:
+                headers['Content-Encoding'] = encoding
             
-            # If using key mapping, don't send hostname in metrics
-            # Server will determine hostname from API key
-            if self.use_key_mapping:
-                # Remove hostname from metrics, server will add it
-                metrics_to_send = dict((k, v) for k, v in metrics.items() if k != 'hostname')
-            else:
-                # Send metrics with hostname
-                metrics_to_send = metrics
+            status, text, response_headers = self.post(url, body, headers)
             
-            # Convert to JSON
-            json_data = json.dumps(metrics_to_send)
+            if status == 415 and (self.use_binary or encoding):
+                # Server stopped accepting the negotiated format (e.g. downgraded), resend as plain JSON
+                print("Server rejected {0} payload, falling back to plain JSON".format(
+                    'binary' if self.use_binary else encoding))
+                self.use_binary = False
+                self.content_encoding = None
+                continue
             
-            if HAS_REQUESTS:
-                # Use requests library (preferred)
-                response = requests.post(
-                    "{0}/api/metrics".format(self.server_url),
-                    data=json_data,
-                    headers=headers,
-                    timeout=10
-                )
-                if response.status_code == 200:
-                    return True
-                else:
-                    print("Error sending metrics: {0} - {1}".format(response.status_code, response.text))
-                    return False
-            else:
-                # Fallback to urllib (Python 2/3 compatible)
-                url = "{0}/api/metrics".format(self.server_url)
-                if sys.version_info[0] >= 3:
-                    req = urllib2.Request(url, data=json_data.encode('utf-8'), headers=headers)
+            self.negotiate_encoding(response_headers.get('Accept-Encoding'))
+            self.negotiate_format(response_headers.get('Accept-Post'))
+            
+            delta_supported = response_headers.get('X-Metrics-Delta') is not None
+            if delta_supported != self.delta_supported:
+                print("Static section suppression: {0}".format('on' if delta_supported else 'off'))
+                self.delta_supported = delta_supported
+                self.static_sent = {}
+            return status, text
+    
+    def send_metrics(self, metrics):
+        """Send metrics to central server
+        
+        Samples that could not be delivered stay in a bounded backlog. While there is a
+        backlog it is drained through /api/metrics/batch, so catching up after an outage
+        costs one request per batch_size samples instead of one request per sample.
+        """
+        self.backlog.append(self.prepare_metrics(metrics))
+        
+        try:
+            while self.backlog:
+                if len(self.backlog) > 1 and self.batch_supported:
+                    batch = [self.backlog[i] for i in range(min(self.batch_size, len(self.backlog)))]
+                    status, text = self.post_samples('/api/metrics/batch', batch, batch=True)
+                    
+                    if status in (404, 405):
+                        # Older server without the batch endpoint
+                        print("Server does not support batch ingest, sending backlog one sample at a time")
+                        self.batch_supported = False
+                        continue
                 else:
-                    req = urllib2.Request(url, data=json_data, headers=headers)
+                    batch = [self.backlog[0]]
+                    status, text = self.post_samples('/api/metrics', batch)
                 
-                try:
-                    response = urllib2.urlopen(req, timeout=10)
-                    if response.getcode() == 200:
-                        return True
-                    else:
-                        print("Error sending metrics: {0}".format(response.getcode()))
-                        return False
-                except Exception as e:
-                    print("Failed to send metrics: {0}".format(str(e)))
+                # 202: the server queued the samples for asynchronous storage
+                if status not in (200, 202):
+                    print("Error sending metrics: {0} - {1}".format(status, text))
                     return False
+                
+                self.handle_response(text)
+                
+                for _ in batch:
+                    self.backlog.popleft()
+            
+            return True
                     
         except Exception as e:
             print("Failed to send metrics: {0}".format(str(e)))
@@ -329,6 +612,8 @@ class MonitoringAgent:
         print("Sending metrics to: {0}".format(self.server_url))
         print("Collection interval: {0} seconds".format(self.interval))
         print("Key mapping enabled: {0}".format(self.use_key_mapping))
+        print("Compression: {0}".format(self.compression))
+        print("Wire format: {0}".format(self.wire_format))
         print("Python version: {0}.{1}.{2}".format(sys.version_info[0], sys.version_info[1], sys.version_info[2]))
         print("psutil version: {0}".format(psutil.__version__))
         
@@ -356,7 +641,7 @@ class MonitoringAgent:
                 if self.send_metrics(metrics):
                     print("  [OK] Metrics sent successfully")
                 else:
-                    print("  [ERROR] Failed to send metrics")
+                    print("  [ERROR] Failed to send metrics ({0} samples queued)".format(len(self.backlog)))
                 
                 time.sleep(self.interval)
                 
@@ -393,6 +678,12 @@ def check_dependencies():
     else:
         print("requests: Not available (using urllib fallback)")
     
+    # Check zstandard (optional)
+    if HAS_ZSTD:
+        print("zstandard: Available (zstd payload compression)")
+    else:
+        print("zstandard: Not available (using gzip payload compression)")
+    
     print("=" * 60)
     print("All checks passed!")
     print("=" * 60)
@@ -438,6 +729,16 @@ Compatible with:
                        help='Collection interval in seconds (default: 5)')
     parser.add_argument('--no-key-mapping', action='store_true',
                        help='Disable key mapping (send local hostname instead of using API key mapping)')
+    parser.add_argument('--batch-size', type=int, default=50,
+                       help='Maximum samples per batch request when sending a backlog (default: 50)')
+    parser.add_argument('--max-backlog', type=int, default=720,
+                       help='Maximum unsent samples kept while the server is unreachable (default: 720)')
+    parser.add_argument('--compression', choices=['auto', 'zstd', 'gzip', 'none'], default='auto',
+                       help='Payload compression, used once the server advertises support (default: auto)')
+    parser.add_argument('--static-interval', type=int, default=60,
+                       help='Resend unchanged system info and partition layout every N cycles (default: 60)')
+    parser.add_argument('--wire-format', choices=['auto', 'binary', 'json'], default='auto',
+                       help='Sample encoding, auto switches to binary once the server advertises support (default: auto)')
     
     args = parser.parse_args()
     
@@ -446,7 +747,12 @@ Compatible with:
         api_key=args.api_key,
         hostname=args.hostname,
         interval=args.interval,
-        use_key_mapping=not args.no_key_mapping
+        use_key_mapping=not args.no_key_mapping,
+        batch_size=args.batch_size,
+        max_backlog=args.max_backlog,
+        compression=args.compression,
+        wire_format=args.wire_format,
+        static_interval=args.static_interval
     )
     
     agent.run()
@@ -689,6 +689,9 @@ def check_alerts(current_metrics):
     
     all_alerts = []
     
+    # Work on a copy: the store keeps adding hosts while the checks iterate
+    current_metrics = dict(current_metrics)
+    
     # Check all alert conditions
     all_alerts.extend(check_server_down(current_metrics, alert_config))
     all_alerts.extend(check_cpu_usage(current_metrics, alert_config))
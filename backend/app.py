@@ -1,10 +1,15 @@
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for, send_from_directory
+from flask import Flask, request, jsonify, render_template, session, redirect, url_for, send_from_directory, g
 from flask_cors import CORS
+from bisect import bisect_left
 from datetime import datetime, timedelta
 import json
+import math
 import os
-from collections import defaultdict, deque
-from threading import Lock
+from threading import Lock, Thread
+import atexit
+import signal
+import sys
+import time
 import hashlib
 import secrets
 import sqlite3
@@ -12,6 +17,18 @@ from functools import wraps
 
 # Import alert system
 import alert_system
+import wire_format
+import group_metrics
+import history_db
+import quantile_sketch
+import range_query
+import request_log
+import rollups
+import segment_store
+import streaming_stats
+import top_hosts
+from metric_store import MetricStore, RING_DIR
+from ring_buffer import RingDirectory, format_timestamp, parse_timestamp
 
 app = Flask(__name__, static_folder='../dashboard', static_url_path='/static', template_folder='../dashboard')
 app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(32))
@@ -25,28 +42,64 @@ app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)
 # CORS configuration - support credentials
 CORS(app, supports_credentials=True, origins=['*'])
 
-# Request logging middleware
+# Request logging middleware (sampled, structured, see request_log.py)
+request_log.configure()
+
 @app.before_request
-def log_request():
-    """Log all incoming requests"""
-    print(f"[REQUEST] {request.method} {request.path} from {request.remote_addr}")
-    print(f"[REQUEST] Headers: {dict(request.headers)}")
-    if request.method in ['POST', 'PUT', 'PATCH']:
-        print(f"[REQUEST] Body: {request.get_data(as_text=True)[:500]}")  # First 500 chars
-
-# Response logging middleware
+def start_request_timer():
+    """Remember when the request started for the latency field"""
+    g.request_started = time.perf_counter()
+
 @app.after_request
 def log_response(response):
-    """Log all outgoing responses"""
-    print(f"[RESPONSE] {request.method} {request.path} -> {response.status}")
-    print(f"[RESPONSE] Content-Type: {response.content_type}")
+    """Log the finished request, subject to level and per-route sampling"""
+    request_log.log_request(request, response, g.get('request_started', time.perf_counter()))
     return response
 
-# In-memory storage for metrics (untuk demo, bisa diganti dengan database)
-metrics_storage = defaultdict(lambda: deque(maxlen=1000))  # Store last 1000 metrics per server
-current_metrics = {}  # Latest metrics per server
-system_info_cache = {}  # Cache system info (OS, kernel, etc) - updated every 5 minutes
-storage_lock = Lock()
+# Advertise the request encodings (RFC 7694) and body formats accepted on ingest routes
+# so agents can negotiate compression and the binary sample format
+@app.after_request
+def advertise_ingest_encodings(response):
+    """Add Accept-Encoding and Accept-Post to metric ingest responses"""
+    if request.path.startswith('/api/metrics'):
+        response.headers['Accept-Encoding'] = ', '.join(wire_format.SUPPORTED_ENCODINGS)
+        response.headers['Accept-Post'] = ', '.join(wire_format.SUPPORTED_CONTENT_TYPES)
+        # Agents may omit unchanged static sections (see MetricStore._expand_static_sections)
+        response.headers['X-Metrics-Delta'] = '1'
+    return response
+
+# In-memory storage for metrics (see metric_store.py). serve.py replaces this local
+# instance with a proxy to the store shared by all worker processes.
+store = MetricStore()
+
+# History endpoints map the store's ring files directly: no copy through the store, no lock
+history_rings = RingDirectory(RING_DIR)
+
+# Upper bound on samples accepted by a single /api/metrics/batch request
+MAX_BATCH_SAMPLES = int(os.environ.get('MAX_BATCH_SAMPLES', 1000))
+
+# Asynchronous ingest: requests enqueue samples and get 202, a consumer thread stores them.
+# Set INGEST_QUEUE_SIZE=0 to store synchronously and answer 200 (for agents that require it).
+INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', 10000))
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', 500))
+INGEST_RETRY_AFTER = 5  # seconds, Retry-After of a batch refused by a full queue
+
+# API key -> hostname for active hosts, loaded at startup and kept in sync by the host endpoints
+api_key_registry = {}
+api_key_registry_stats = {'hits': 0, 'misses': 0, 'reloads': 0}
+api_key_registry_lock = Lock()
+
+# Shared change counter (multiprocessing.Value) set by serve.py: a worker reloads its registry
+# when another worker changed a host's key
+api_key_registry_generation = None
+api_key_registry_loaded_generation = 0
+
+# Last-seen times recorded at ingest and flushed to the hosts table in batches
+LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL', 10))  # seconds
+last_seen = {}  # hostname -> 'YYYY-MM-DD HH:MM:SS' (UTC, same format as CURRENT_TIMESTAMP)
+last_seen_dirty = set()  # hostnames not yet written to the database
+last_seen_stats = {'flushes': 0, 'rows_written': 0, 'errors': 0}
+last_seen_lock = Lock()
 
 # Jika ingin persistent storage
 STORAGE_DIR = 'data'
@@ -116,6 +169,9 @@ def init_db():
         cursor.execute('ALTER TABLE hosts ADD COLUMN group_id INTEGER')
         print("[MIGRATION] ✓ group_id column added")
     
+    # Group members are looked up by group (group metrics, /api/query)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_hosts_group_id ON hosts (group_id)')
+    
     # Migration: Add enable_key_mapping column if it doesn't exist
     if not check_column_exists(cursor, 'hosts', 'enable_key_mapping'):
         print("[MIGRATION] Adding enable_key_mapping column to hosts table...")
@@ -185,21 +241,135 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def verify_api_key(api_key):
-    """Verify API key and return hostname"""
+def read_host_groups():
+    """{hostname: group id or None} of every registered host"""
     db = get_db()
-    host = db.execute('SELECT hostname FROM hosts WHERE api_key = ? AND is_active = 1', (api_key,)).fetchone()
+    hosts = db.execute('SELECT hostname, group_id FROM hosts').fetchall()
     db.close()
-    return host['hostname'] if host else None
+    return {host['hostname']: host['group_id'] for host in hosts}
 
 
-def save_to_file(hostname, metrics):
-    """Save metrics to JSON file (optional persistent storage)"""
-    date_str = datetime.now().strftime('%Y-%m-%d')
-    filename = os.path.join(STORAGE_DIR, f"{hostname}_{date_str}.jsonl")
+def sync_host_groups():
+    """Push the group membership of every host to the store (group series, see group_metrics.py)"""
+    store.set_host_groups(read_host_groups())
+
+
+def load_api_key_registry():
+    """Load API keys of all active hosts into the in-memory registry"""
+    global api_key_registry_loaded_generation
+    
+    # Read the generation first so a change made during the reload triggers another one
+    if api_key_registry_generation is not None:
+        api_key_registry_loaded_generation = api_key_registry_generation.value
+    
+    db = get_db()
+    hosts = db.execute('SELECT hostname, api_key FROM hosts WHERE is_active = 1').fetchall()
+    db.close()
+    
+    with api_key_registry_lock:
+        api_key_registry.clear()
+        for host in hosts:
+            api_key_registry[host['api_key']] = host['hostname']
+        api_key_registry_stats['reloads'] += 1
     
-    with open(filename, 'a') as f:
-        f.write(json.dumps(metrics) + '\n')
+    print(f"[AUTH] API key registry loaded ({len(hosts)} active hosts)")
+
+def register_api_key(api_key, hostname, is_active=True):
+    """Add or replace a host's API key in the registry (inactive hosts are dropped)"""
+    with api_key_registry_lock:
+        if is_active:
+            api_key_registry[api_key] = hostname
+        else:
+            api_key_registry.pop(api_key, None)
+    notify_api_key_registry_changed()
+
+def unregister_api_key(api_key):
+    """Remove an API key from the registry"""
+    with api_key_registry_lock:
+        api_key_registry.pop(api_key, None)
+    notify_api_key_registry_changed()
+
+def notify_api_key_registry_changed():
+    """Make the other worker processes reload their registry"""
+    if api_key_registry_generation is not None:
+        with api_key_registry_generation.get_lock():
+            api_key_registry_generation.value += 1
+
+def refresh_api_key_registry():
+    """Reload the registry if another worker process changed it"""
+    if api_key_registry_generation is not None \
+            and api_key_registry_generation.value != api_key_registry_loaded_generation:
+        load_api_key_registry()
+
+def verify_api_key(api_key):
+    """Verify API key and return hostname (dictionary lookup, no database access)"""
+    refresh_api_key_registry()
+    hostname = api_key_registry.get(api_key)
+    
+    with api_key_registry_lock:
+        if hostname:
+            api_key_registry_stats['hits'] += 1
+        else:
+            api_key_registry_stats['misses'] += 1
+    
+    return hostname
+
+def touch_last_seen(hostname):
+    """Record that a host was just seen (written to the database by the last-seen writer)"""
+    now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    with last_seen_lock:
+        last_seen[hostname] = now
+        last_seen_dirty.add(hostname)
+
+def forget_last_seen(hostname):
+    """Drop in-memory last-seen state for a host that was renamed or deleted"""
+    with last_seen_lock:
+        last_seen.pop(hostname, None)
+        last_seen_dirty.discard(hostname)
+
+def flush_last_seen():
+    """Write all pending last-seen times in a single transaction"""
+    with last_seen_lock:
+        if not last_seen_dirty:
+            return 0
+        rows = [(last_seen[hostname], hostname) for hostname in last_seen_dirty]
+        last_seen_dirty.clear()
+    
+    try:
+        db = get_db()
+        db.executemany('UPDATE hosts SET last_seen = ? WHERE hostname = ?', rows)
+        db.commit()
+        db.close()
+    except Exception as e:
+        print(f"[ERROR] Failed to flush last_seen for {len(rows)} hosts: {e}")
+        with last_seen_lock:
+            # Retry on the next flush unless the host was deleted meanwhile
+            last_seen_dirty.update(hostname for _, hostname in rows if hostname in last_seen)
+            last_seen_stats['errors'] += 1
+        return 0
+    
+    with last_seen_lock:
+        last_seen_stats['flushes'] += 1
+        last_seen_stats['rows_written'] += len(rows)
+    
+    return len(rows)
+
+def start_last_seen_writer(interval=LAST_SEEN_FLUSH_INTERVAL):
+    """Start background thread that flushes last-seen times every `interval` seconds"""
+    def writer_loop():
+        while True:
+            time.sleep(interval)
+            try:
+                flush_last_seen()
+            except Exception as e:
+                print(f"[ERROR] Last-seen writer: {e}")
+    
+    writer_thread = Thread(target=writer_loop, daemon=True)
+    writer_thread.start()
+    
+    # Final flush so the last interval is not lost on shutdown
+    atexit.register(flush_last_seen)
+    print(f"[HOST] Last-seen writer started (flushing every {interval}s)")
 
 
 @app.route('/')
@@ -470,7 +640,7 @@ def health():
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.utcnow().isoformat(),
-        'servers_count': len(current_metrics)
+        'servers_count': store.count()
     })
 
 
@@ -487,13 +657,21 @@ def receive_metrics():
         if not hostname:
             return jsonify({'error': 'Invalid API key'}), 401
         
-        # Update last_seen for the host
-        db = get_db()
-        db.execute('UPDATE hosts SET last_seen = CURRENT_TIMESTAMP WHERE hostname = ?', (hostname,))
-        db.commit()
-        db.close()
+        # Update last_seen for the host (flushed to the database in batches)
+        touch_last_seen(hostname)
+        
+        try:
+            metrics = get_metrics_payload()
+        except (wire_format.UnsupportedEncoding, wire_format.PayloadTooLarge, ValueError) as e:
+            return payload_error_response(e)
         
-        metrics = request.json
+        if not isinstance(metrics, dict):
+            return jsonify({'error': 'Expected a JSON object'}), 400
+        
+        try:
+            wire_format.validate_sample(metrics)
+        except wire_format.InvalidSample as e:
+            return jsonify({'error': f'Invalid sample: {e}'}), 400
         
         # Override hostname with the one from API key
         metrics['hostname'] = hostname
@@ -501,49 +679,226 @@ def receive_metrics():
         # Add server timestamp
         metrics['server_received_at'] = datetime.utcnow().isoformat()
         
-        with storage_lock:
-            # Cache system info if present
-            if 'system' in metrics:
-                system_info_cache[hostname] = metrics['system']
-                print(f"[INFO] System info cached for {hostname}")
+        status_code, resync = store.submit([(hostname, metrics)])
+        
+        response = {'status': 'success', 'hostname': hostname}
+        if resync:
+            response['resync'] = resync
+        return jsonify(response), status_code
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/metrics/batch', methods=['POST'])
+def receive_metrics_batch():
+    """Receive many samples in one request (buffered intervals or a relay forwarding several hosts)
+    
+    The body is a JSON array of samples. Samples belong to the host of the X-API-Key header
+    unless they carry their own `api_key` field, which lets a relay forward other agents' data.
+    """
+    try:
+        # Verify API key once for the whole request
+        api_key = request.headers.get('X-API-Key')
+        if not api_key:
+            return jsonify({'error': 'API key required'}), 401
+        
+        hostname = verify_api_key(api_key)
+        if not hostname:
+            return jsonify({'error': 'Invalid API key'}), 401
+        
+        try:
+            samples = get_metrics_payload(batch=True)
+        except (wire_format.UnsupportedEncoding, wire_format.PayloadTooLarge, ValueError) as e:
+            return payload_error_response(e)
+        
+        if not isinstance(samples, list):
+            return jsonify({'error': 'Expected a JSON array of samples'}), 400
+        
+        if len(samples) > MAX_BATCH_SAMPLES:
+            return jsonify({'error': f'Batch too large (max {MAX_BATCH_SAMPLES} samples)'}), 413
+        
+        received_at = datetime.utcnow().isoformat()
+        accepted = []
+        rejected = 0
+        
+        for metrics in samples:
+            if not isinstance(metrics, dict):
+                rejected += 1
+                continue
             
-            # Always include cached system info in current metrics
-            if hostname in system_info_cache:
-                metrics['system'] = system_info_cache[hostname]
+            # A malformed sample is rejected on its own, the rest of the batch is stored
+            try:
+                wire_format.validate_sample(metrics)
+            except wire_format.InvalidSample:
+                rejected += 1
+                continue
             
-            # Store in memory
-            metrics_storage[hostname].append(metrics)
-            current_metrics[hostname] = metrics
+            sample_hostname = hostname
+            sample_api_key = metrics.pop('api_key', None)
+            if sample_api_key and sample_api_key != api_key:
+                sample_hostname = verify_api_key(sample_api_key)
+                if not sample_hostname:
+                    rejected += 1
+                    continue
             
-            # Optionally save to file
-            # save_to_file(hostname, metrics)
+            metrics['hostname'] = sample_hostname
+            metrics['server_received_at'] = received_at
+            accepted.append(metrics)
+        
+        # A backlog is never coalesced: when it does not fit, the agent keeps it and retries
+        status_code, resync = store.submit([(metrics['hostname'], metrics) for metrics in accepted], live=False)
+        if status_code == 503:
+            response = jsonify({'error': 'Ingest queue full, retry later'})
+            response.headers['Retry-After'] = str(INGEST_RETRY_AFTER)
+            return response, 503
         
-        return jsonify({'status': 'success', 'hostname': hostname}), 200
+        for seen_hostname in set(metrics['hostname'] for metrics in accepted):
+            touch_last_seen(seen_hostname)
+        
+        response = {'status': 'success', 'accepted': len(accepted), 'rejected': rejected}
+        if resync:
+            response['resync'] = resync
+        return jsonify(response), status_code
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def start_ingest_queue():
+    """Start the ingest queue of the local metric store"""
+    store.start_ingest_queue(INGEST_QUEUE_SIZE, INGEST_BATCH_SIZE)
+    
+    # Store whatever is still queued on shutdown
+    atexit.register(store.stop)
+
+
+def start_history_writer():
+    """Persist the samples of the local metric store to SQLite and to segment files"""
+    store.start_history_writer()
+    store.start_segment_writer()
+
+
+def get_metrics_payload(batch=False):
+    """Decode the body of an agent POST, honouring Content-Encoding and Content-Type
+    
+    Returns a sample dict, or a list of samples when batch is True.
+    """
+    body = wire_format.decode_body(request.get_data(), request.headers.get('Content-Encoding'))
+    
+    if request.mimetype == wire_format.BINARY_CONTENT_TYPE:
+        samples = wire_format.decode_samples(body)
+        if batch:
+            return samples
+        if len(samples) != 1:
+            raise ValueError('Expected exactly one binary record')
+        return samples[0]
+    
+    return json.loads(body)
+
+
+def payload_error_response(error):
+    """Map a payload decoding error to an HTTP response"""
+    if isinstance(error, wire_format.UnsupportedEncoding):
+        return jsonify({'error': str(error)}), 415
+    if isinstance(error, wire_format.PayloadTooLarge):
+        return jsonify({'error': str(error)}), 413
+    return jsonify({'error': f'Invalid payload: {error}'}), 400
+
+
+@app.route('/api/ingest/stats', methods=['GET'])
+@login_required
+def get_ingest_stats():
+    """Get ingest path statistics"""
+    with api_key_registry_lock:
+        registry_stats = dict(api_key_registry_stats, size=len(api_key_registry))
+    
+    with last_seen_lock:
+        writer_stats = dict(last_seen_stats, pending=len(last_seen_dirty), interval=LAST_SEEN_FLUSH_INTERVAL)
+    
+    store_stats = store.get_stats()
+    
+    return jsonify({
+        'api_key_registry': registry_stats,
+        'last_seen_writer': writer_stats,
+        'ingest_queue': store_stats.pop('ingest_queue'),
+        'store': store_stats,
+        'request_log': request_log.get_stats()
+    })
+
+
 @app.route('/api/servers', methods=['GET'])
 @login_required
 def get_servers():
     """Get list of all monitored servers"""
-    servers = []
+    servers = store.list_servers()
     
-    with storage_lock:
-        for hostname, metrics in current_metrics.items():
-            server_info = {
-                'hostname': hostname,
-                'last_update': metrics.get('timestamp'),
-                'cpu_percent': metrics.get('cpu', {}).get('cpu_percent_total', 0),
-                'memory_percent': metrics.get('memory', {}).get('memory_percent', 0),
-                'status': 'online'  # Could add logic to mark offline if no recent updates
-            }
-            servers.append(server_info)
+    for server_info in servers:
+        server_info['status'] = 'online'  # Could add logic to mark offline if no recent updates
     
     return jsonify(servers)
 
 
+@app.route('/api/fleet/summary', methods=['GET'])
+@login_required
+def get_fleet_summary():
+    """Fleet-wide aggregates of the latest samples, computed by the store (see fleet_summary.py)"""
+    config = alert_system.get_alert_config() or {}
+    thresholds = {key: config[key] for key in ('cpu_threshold', 'memory_threshold', 'disk_threshold')
+                  if config.get(key) is not None}
+    summary = store.get_fleet_summary(thresholds, config.get('server_down_timeout') or 60)
+    
+    db = get_db()
+    registered = db.execute('SELECT COUNT(*) FROM hosts').fetchone()[0]
+    group_count = db.execute('SELECT COUNT(*) FROM groups').fetchone()[0]
+    db.close()
+    
+    # Registered hosts without a sample since the store started
+    summary = dict(summary, registered=registered, groups=group_count)
+    summary['status'] = dict(summary['status'], never_reported=max(registered - summary['hosts'], 0))
+    return jsonify(summary)
+
+
+# Upper bound on k for /api/top
+TOP_MAX_K = int(os.environ.get('TOP_MAX_K', 500))
+
+
+@app.route('/api/top', methods=['GET'])
+@login_required
+def get_top_hosts():
+    """The k online hosts with the highest current or windowed (mean) value of a metric
+    
+    Read from the rankings the store maintains at ingest (see top_hosts.py): O(k), not a sort
+    of the fleet. Hosts count as online like in the fleet summary (server_down_timeout).
+    """
+    metric = request.args.get('metric', default='cpu')
+    window = request.args.get('window', default='current')
+    k = request.args.get('k', default=10, type=int)
+    
+    if metric not in top_hosts.TOP_METRICS:
+        return jsonify({'error': f"Unknown metric '{metric}'"}), 400
+    if window not in top_hosts.TOP_WINDOWS:
+        return jsonify({'error': f"Unknown window '{window}'"}), 400
+    if not 0 < k <= TOP_MAX_K:
+        return jsonify({'error': f'k must be between 1 and {TOP_MAX_K}'}), 400
+    
+    config = alert_system.get_alert_config() or {}
+    down_timeout = config.get('server_down_timeout') or 60
+    ranked = store.get_top(metric, window, k, time.time() - down_timeout)
+    
+    return jsonify({
+        'metric': metric,
+        'window': window,
+        'k': k,
+        'hosts': [{
+            'rank': rank,
+            'hostname': hostname,
+            'value': value,
+            'last_update': format_timestamp(epoch)
+        } for rank, (hostname, value, epoch) in enumerate(ranked, 1)]
+    })
+
+
 @app.route('/api/hosts', methods=['GET'])
 @login_required
 def get_hosts():
@@ -561,6 +916,10 @@ def get_hosts():
         ''').fetchall()
         db.close()
         
+        # Prefer the in-memory last-seen time, the database copy lags by up to one flush
+        with last_seen_lock:
+            recent_last_seen = dict(last_seen)
+        
         result = [{
             'id': host['id'],
             'hostname': host['hostname'],
@@ -569,7 +928,7 @@ def get_hosts():
             'is_active': bool(host['is_active']),
             'api_key': host['api_key'],
             'created_at': host['created_at'],
-            'last_seen': host['last_seen'],
+            'last_seen': recent_last_seen.get(host['hostname'], host['last_seen']),
             'group_id': host['group_id'],
             'group_name': host['group_name'],
             'group_icon': host['group_icon']
@@ -614,6 +973,9 @@ def add_host():
         host_id = cursor.lastrowid
         db.close()
         
+        register_api_key(api_key, hostname)
+        sync_host_groups()
+        
         print(f"[HOST] New host added: {hostname} (ID: {host_id}, Group: {group_id}, Key Mapping: {enable_key_mapping})")
         
         return jsonify({
@@ -665,6 +1027,11 @@ def update_host(host_id):
         updated_host = db.execute('SELECT * FROM hosts WHERE id = ?', (host_id,)).fetchone()
         db.close()
         
+        register_api_key(updated_host['api_key'], updated_host['hostname'], bool(updated_host['is_active']))
+        if updated_host['hostname'] != host['hostname']:
+            forget_last_seen(host['hostname'])
+        sync_host_groups()
+        
         print(f"[API] Host updated: {hostname} (ID: {host_id})")
         
         return jsonify({
@@ -698,6 +1065,10 @@ def delete_host(host_id):
     db.commit()
     db.close()
     
+    unregister_api_key(host['api_key'])
+    forget_last_seen(hostname)
+    sync_host_groups()
+    
     print(f"[API] Host deleted: {hostname} (ID: {host_id})")
     
     return jsonify({'success': True})
@@ -719,6 +1090,9 @@ def regenerate_api_key(host_id):
     db.commit()
     db.close()
     
+    unregister_api_key(host['api_key'])
+    register_api_key(new_api_key, host['hostname'], bool(host['is_active']))
+    
     return jsonify({'api_key': new_api_key})
 
 
@@ -849,17 +1223,104 @@ def delete_group(group_id):
     db.execute('DELETE FROM groups WHERE id = ?', (group_id,))
     db.commit()
     db.close()
+    sync_host_groups()
     
     print(f"[API] Group deleted: {group_name} (ID: {group_id})")
     
     return jsonify({'success': True})
 
 
+def read_group_buckets(group_id, resolution, since):
+    """Buckets (start, aggregates) of a group from `since`, oldest first
+    
+    resolution None reads the points themselves. Buckets the store still holds every point of
+    are built from its points, older ones come from the group_rollups table.
+    """
+    seconds = rollups.RESOLUTION_SECONDS[resolution] if resolution else group_metrics.GROUP_STEP
+    since -= since % seconds  # include the bucket the window starts in
+    points = store.get_group_points(group_id, since)
+    
+    # First bucket whose points are all held by the store
+    oldest = store.get_group_oldest(group_id)
+    if oldest is None:
+        boundary = float('inf')
+    elif oldest <= since:
+        boundary = since
+    else:
+        boundary = oldest + -oldest % seconds
+    
+    buckets = []
+    if since < boundary:
+        stored_resolution = resolution or rollups.RESOLUTIONS[0][0]
+        count = (min(boundary, time.time()) - since) // rollups.RESOLUTION_SECONDS[stored_resolution] + 1
+        stored, unwritten = read_persisted(
+            'group_rollups', stored_resolution, since, [group_id],
+            lambda: history_db.read_group_rollups(group_id, stored_resolution, since, int(count)))
+        stored = merge_buckets(stored, *[(start, aggregates) for _, start, aggregates in unwritten])
+        buckets = [(start, aggregates) for start, aggregates in stored if start < boundary]
+    
+    recent = {}
+    for start, values in points:
+        bucket = start - start % seconds
+        if bucket >= boundary:
+            rollups.merge(recent.setdefault(bucket, group_metrics.new_aggregates()),
+                          group_metrics.point_aggregates(values))
+    return buckets + sorted(recent.items())
+
+
+@app.route('/api/groups/<int:group_id>/metrics', methods=['GET'])
+@login_required
+def get_group_metrics(group_id):
+    """Aggregate series and statistics of a host group (see group_metrics.py)
+    
+    Per-minute points over the group's online members, kept by the store at ingest. Long windows
+    are read at the coarsest resolution still giving `limit` points, like server history.
+    """
+    minutes = request.args.get('minutes', default=60, type=int)
+    limit = request.args.get('limit', default=100, type=int)
+    resolution = request.args.get('resolution', default='auto')
+    
+    if resolution not in ('auto', 'raw') and resolution not in rollups.RESOLUTION_SECONDS:
+        return jsonify({'error': f"Unknown resolution '{resolution}'"}), 400
+    if minutes <= 0:
+        return jsonify({'error': 'minutes must be positive'}), 400
+    
+    db = get_db()
+    group = db.execute('SELECT id, name FROM groups WHERE id = ?', (group_id,)).fetchone()
+    host_count = db.execute('SELECT COUNT(*) FROM hosts WHERE group_id = ?', (group_id,)).fetchone()[0]
+    db.close()
+    
+    if not group:
+        return jsonify({'error': 'Group not found'}), 404
+    
+    chosen = rollups.choose_resolution(minutes * 60, limit) if resolution == 'auto' else resolution
+    if chosen == 'raw':
+        chosen = None
+    buckets = read_group_buckets(group_id, chosen, time.time() - minutes * 60)
+    
+    total = group_metrics.new_aggregates()
+    for _, aggregates in buckets:
+        rollups.merge(total, aggregates)
+    
+    latest = store.get_group_points(group_id, time.time() - 3 * group_metrics.GROUP_STEP)
+    
+    return jsonify({
+        'group_id': group_id,
+        'name': group['name'],
+        'hosts': host_count,
+        'minutes': minutes,
+        'resolution': chosen or 'raw',
+        'current': group_metrics.point_entry(*latest[-1]) if latest else None,
+        'stats': group_metrics.summarize(total),
+        'history': [group_metrics.bucket_entry(start, aggregates)
+                    for start, aggregates in reversed(buckets[-max(limit, 0):])] if limit > 0 else []
+    })
+
+
 @app.route('/api/servers/<hostname>/current', methods=['GET'])
 def get_current_metrics(hostname):
     """Get current metrics for a specific server"""
-    with storage_lock:
-        metrics = current_metrics.get(hostname)
+    metrics = store.get_current(hostname)
     
     if not metrics:
         return jsonify({'error': 'Server not found'}), 404
@@ -867,53 +1328,234 @@ def get_current_metrics(hostname):
     return jsonify(metrics)
 
 
+def read_persisted(kind, resolution, since, owners, read):
+    """read() of the history database plus the closed buckets the history writer still holds
+    
+    Buckets wait up to HISTORY_FLUSH_INTERVAL in the writer; reads see them right away. Read
+    again when a flush finished in between, so a bucket is neither missed nor counted twice.
+    Returns (read(), [(owner, start, value)]), see MetricStore.get_unwritten.
+    """
+    for _ in range(5):
+        generation = store.get_history_generation()
+        stored = read()
+        current, unwritten = store.get_unwritten(kind, resolution, since, owners)
+        if current == generation:
+            break
+    return stored, unwritten
+
+
+def merge_buckets(buckets, *others):
+    """(start, aggregates) buckets merged by start, oldest first
+    
+    The aggregates of `buckets` are merged into (they must be fresh copies), others are copied.
+    """
+    merged = dict(buckets)
+    for start, aggregates in others:
+        if start in merged:
+            rollups.merge(merged[start], aggregates)
+        else:
+            merged[start] = list(aggregates)
+    return sorted(merged.items())
+
+
+def read_rollup_buckets(hostname, resolution, since, limit):
+    """Last `limit` rollup buckets of a host from `since`: stored ones, those waiting for the
+    history writer and the one being filled"""
+    seconds = rollups.RESOLUTION_SECONDS[resolution]
+    since -= since % seconds  # include the bucket the window starts in
+    buckets, unwritten = read_persisted('rollups', resolution, since, [hostname],
+                                        lambda: history_db.read_rollups(hostname, resolution, since, limit))
+    others = [(start, aggregates) for _, start, aggregates in unwritten]
+    
+    # Part of the open bucket was written before a restart when it is stored too
+    current = store.get_open_rollup(hostname, resolution)
+    if current is not None and current[0] >= since:
+        others.append(current)
+    
+    buckets = merge_buckets(buckets, *others)
+    return buckets[-limit:] if limit > 0 else []
+
+
+# Percentiles read at least this many buckets per host: coarser resolutions for longer windows
+SKETCH_BUCKETS = 12
+
+
+def window_percentiles(hostnames, seconds, end=None):
+    """p50/p95/p99 of the rolled-up series over the last `seconds` before `end` (default: now)
+    
+    Merges the stored sketches of the hosts (every host when hostnames is None) with those the
+    history writer still holds and the minute the store is still filling; the window is widened to whole buckets. Returns
+    (resolution, host count, {metric: {p50, p95, p99, count}}).
+    """
+    resolution = rollups.choose_resolution(seconds, SKETCH_BUCKETS) or rollups.SKETCH_RESOLUTION
+    since = (end or time.time()) - seconds
+    since -= since % rollups.RESOLUTION_SECONDS[resolution]
+    
+    merged, unwritten = read_persisted('sketches', resolution, since, hostnames,
+                                       lambda: history_db.read_sketches(resolution, since, hostnames))
+    for hostname, _, data in unwritten:
+        quantile_sketch.merge_sketches(merged.setdefault(hostname, rollups.new_sketches()),
+                                       rollups.decode_sketches(data))
+    for hostname, (start, data) in store.get_open_sketches(hostnames).items():
+        if start >= since:
+            quantile_sketch.merge_sketches(merged.setdefault(hostname, rollups.new_sketches()),
+                                           rollups.decode_sketches(data))
+    
+    total = rollups.new_sketches()
+    for sketches in merged.values():
+        quantile_sketch.merge_sketches(total, sketches)
+    return resolution, len(merged), quantile_sketch.percentiles(rollups.ROLLUP_METRICS, total)
+
+
 @app.route('/api/servers/<hostname>/history', methods=['GET'])
 def get_metrics_history(hostname):
-    """Get historical metrics for a specific server"""
+    """Get historical metrics for a specific server
+    
+    Entries come from the first source covering the window, newest first:
+    
+        rollup buckets   averages of rollups.ROLLUP_METRICS plus min/max, marked 'resolution'
+        ring             full samples (per-core CPU, partitions, load average, counters)
+        compressed tier  marked 'source': 'compressed', only rollups.ROLLUP_METRICS
+        segment files    marked 'source': 'segment', every scalar series and the load average,
+                         no per-core CPU or partitions
+        database         full samples
+    """
     # Get query parameters
     minutes = request.args.get('minutes', default=60, type=int)
     limit = request.args.get('limit', default=100, type=int)
-    
-    with storage_lock:
-        history = list(metrics_storage.get(hostname, []))
-    
-    if not history:
+    resolution = request.args.get('resolution', default='auto')
+    
+    if resolution not in ('auto', 'raw') and resolution not in rollups.RESOLUTION_SECONDS:
+        return jsonify({'error': f"Unknown resolution '{resolution}'"}), 400
+    
+    since = time.time() - minutes * 60
+    limit = max(limit, 0)
+    
+    # Long windows come from the coarsest rollup that still gives `limit` points
+    chosen = rollups.choose_resolution(minutes * 60, limit) if resolution == 'auto' else resolution
+    if chosen in rollups.RESOLUTION_SECONDS:
+        buckets = read_rollup_buckets(hostname, chosen, since, limit)
+        # A host too new for rollups is better described by its raw samples
+        if len(buckets) > 1 or chosen == resolution:
+            return jsonify([
+                rollups.rollup_entry(hostname, chosen, start, aggregates) for start, aggregates in reversed(buckets)
+            ])
+    
+    # Binary search for the window start on the epoch timestamps, then read only the window
+    ring = history_rings.get(hostname)
+    history = ring.read(since=since, limit=limit) if ring is not None else []
+    
+    # The older part of a window reaching past the ring comes from progressively slower
+    # sources: the compressed in-memory series, the segment files, the history database
+    oldest = ring.oldest_timestamp() if ring is not None else None
+    before = oldest if oldest is not None else float('inf')
+    for source in (store.get_compressed_history, segment_store.read_segments, history_db.read_samples):
+        if len(history) >= limit or since >= before:
+            break
+        older = source(hostname, since, before, limit - len(history))
+        if older:
+            history = older + history
+            before = parse_timestamp(older[0]['timestamp'])
+    
+    if not history and (ring is None or not len(ring)):
         return jsonify({'error': 'No data found for server'}), 404
     
-    # Filter by time if needed
-    cutoff_time = datetime.utcnow() - timedelta(minutes=minutes)
-    filtered_history = []
-    
-    for metric in reversed(history):  # Most recent first
-        try:
-            metric_time = datetime.fromisoformat(metric['timestamp'].replace('Z', '+00:00'))
-            if metric_time >= cutoff_time:
-                filtered_history.append(metric)
-        except:
-            filtered_history.append(metric)  # Include if can't parse time
-    
-    # Apply limit
-    filtered_history = filtered_history[:limit]
-    
-    return jsonify(filtered_history)
+    return jsonify(history[::-1])  # Most recent first
+
+
+# Minutes of the streaming statistics windows, /stats?minutes= uses them when it matches
+STATS_WINDOW_MINUTES = {seconds // 60: name for name, seconds in streaming_stats.STATS_WINDOWS if seconds}
 
 
 @app.route('/api/servers/<hostname>/stats', methods=['GET'])
 def get_server_stats(hostname):
-    """Get aggregated statistics for a server"""
-    with storage_lock:
-        history = list(metrics_storage.get(hostname, []))
-    
-    if not history:
+    """Get aggregated statistics for a server
+    
+    `window` (5m, 1h or all: the last HISTORY_SIZE samples) is answered in O(1) from the running
+    statistics the store keeps at ingest, ending at the host's newest sample. `minutes` uses the
+    matching window when there is one; longer windows are summarized from rollup buckets, others
+    from the ring. Percentiles come from the quantile sketches (see window_percentiles).
+    """
+    window = request.args.get('window')
+    minutes = request.args.get('minutes', type=int)  # default: everything in the ring
+    points = request.args.get('points', default=100, type=int)
+    
+    if window is None:
+        window = 'all' if not minutes else STATS_WINDOW_MINUTES.get(minutes)
+    elif window not in streaming_stats.WINDOW_SECONDS:
+        return jsonify({'error': f"Unknown window '{window}'"}), 400
+    
+    if window is not None:
+        stats = store.get_stream_stats(hostname, window)
+        if stats is not None:
+            metrics = stats['metrics']
+            
+            def window_stats(name):
+                values = metrics[name]
+                return {key: values[key] or 0 for key in ('current', 'average', 'min', 'max', 'stddev')}
+            
+            seconds = streaming_stats.WINDOW_SECONDS[window]
+            if seconds is None:
+                ring = history_rings.get(hostname)
+                oldest = ring.oldest_timestamp() if ring is not None else None
+                seconds = stats['latest'] - oldest if oldest is not None else 0
+            percentiles = window_percentiles([hostname], seconds, stats['latest'])[2] if seconds > 0 else {}
+            
+            return jsonify({
+                'hostname': hostname,
+                'window': window,
+                'latest': format_timestamp(stats['latest']),
+                'data_points': stats['samples'],
+                'cpu': window_stats('cpu.cpu_percent_total'),
+                'memory': window_stats('memory.memory_percent'),
+                'metrics': metrics,
+                'percentiles': percentiles
+            })
+        # Not seen since the store started: compute from stored samples instead
+        seconds = streaming_stats.WINDOW_SECONDS[window]
+        minutes = seconds // 60 if seconds else None
+    
+    # Long windows are summarized from rollup buckets instead of raw samples
+    resolution = rollups.choose_resolution(minutes * 60, points) if minutes else None
+    if resolution is not None:
+        buckets = read_rollup_buckets(hostname, resolution, time.time() - minutes * 60,
+                                      minutes * 60 // rollups.RESOLUTION_SECONDS[resolution] + 1)
+        if buckets:
+            total = rollups.new_aggregates()
+            for _, aggregates in buckets:
+                rollups.merge(total, aggregates)
+            summary = rollups.summarize(total)
+            current = store.get_current(hostname) or {}
+            
+            def section_stats(name, value):
+                values = summary.get(name)
+                if values is None:
+                    return {'current': value or 0, 'average': 0, 'min': 0, 'max': 0}
+                return {'current': value or 0, 'average': values['average'], 'min': values['min'], 'max': values['max']}
+            
+            return jsonify({
+                'hostname': hostname,
+                'resolution': resolution,
+                'minutes': minutes,
+                'data_points': summary.get('cpu.cpu_percent_total', {}).get('count', 0),
+                'cpu': section_stats('cpu.cpu_percent_total', current.get('cpu', {}).get('cpu_percent_total')),
+                'memory': section_stats('memory.memory_percent', current.get('memory', {}).get('memory_percent')),
+                'percentiles': window_percentiles([hostname], minutes * 60)[2]
+            })
+    
+    ring = history_rings.get(hostname)
+    if ring is None or not len(ring):
         return jsonify({'error': 'No data found for server'}), 404
     
-    # Calculate statistics
-    cpu_values = [m.get('cpu', {}).get('cpu_percent_total', 0) for m in history]
-    memory_values = [m.get('memory', {}).get('memory_percent', 0) for m in history]
+    # Calculate statistics straight from the columns (missing values count as 0)
+    since = time.time() - minutes * 60 if minutes else None
+    columns = ring.read_columns(['cpu.cpu_percent_total', 'memory.memory_percent'], since=since)
+    cpu_values = [value if value == value else 0 for value in columns['cpu.cpu_percent_total']]
+    memory_values = [value if value == value else 0 for value in columns['memory.memory_percent']]
     
     stats = {
         'hostname': hostname,
-        'data_points': len(history),
+        'data_points': len(columns['timestamp']),
         'cpu': {
             'current': cpu_values[-1] if cpu_values else 0,
             'average': sum(cpu_values) / len(cpu_values) if cpu_values else 0,
@@ -931,11 +1573,198 @@ def get_server_stats(hostname):
     return jsonify(stats)
 
 
+@app.route('/api/percentiles', methods=['GET'])
+@login_required
+def get_percentiles():
+    """Fleet-wide (or, with group_id, group-wide) p50/p95/p99 of the rolled-up series"""
+    minutes = request.args.get('minutes', default=60, type=int)
+    group_id = request.args.get('group_id', type=int)
+    
+    if minutes <= 0:
+        return jsonify({'error': 'minutes must be positive'}), 400
+    
+    hostnames = None
+    if group_id is not None:
+        db = get_db()
+        group = db.execute('SELECT id FROM groups WHERE id = ?', (group_id,)).fetchone()
+        hosts = db.execute('SELECT hostname FROM hosts WHERE group_id = ?', (group_id,)).fetchall()
+        db.close()
+        if not group:
+            return jsonify({'error': 'Group not found'}), 404
+        hostnames = [host['hostname'] for host in hosts]
+    
+    # Merging host sketches gives the same accuracy as one sketch over all their samples
+    resolution, host_count, percentiles = window_percentiles(hostnames, minutes * 60)
+    return jsonify({
+        'scope': 'fleet' if group_id is None else 'group',
+        'group_id': group_id,
+        'minutes': minutes,
+        'resolution': resolution,
+        'hosts': host_count,
+        'percentiles': percentiles
+    })
+
+
+# Limits of /api/query: hosts per query and buckets per series
+QUERY_MAX_HOSTS = int(os.environ.get('QUERY_MAX_HOSTS', 200))
+QUERY_MAX_POINTS = int(os.environ.get('QUERY_MAX_POINTS', 11000))
+
+
+def parse_query_time(value, default):
+    """Epoch seconds from a query parameter given as epoch seconds or ISO timestamp, None if invalid"""
+    if value is None or value == '':
+        return default
+    try:
+        epoch = float(value)
+    except ValueError:
+        return parse_timestamp(value)
+    # float() also takes 'nan', 'inf' and values beyond any datetime
+    if not math.isfinite(epoch):
+        return None
+    try:
+        format_timestamp(epoch)
+    except (OverflowError, ValueError, OSError):
+        return None
+    return epoch
+
+
+def select_hosts(patterns, group_id):
+    """Registered hostnames matching any of the glob patterns and in the group (None: any), sorted"""
+    clauses, params = [], []
+    if patterns:
+        # GLOB is case-sensitive, so a pattern with a literal prefix uses the hostname index
+        clauses.append('(' + ' OR '.join('hostname GLOB ?' for _ in patterns) + ')')
+        params.extend(patterns)
+    if group_id is not None:
+        clauses.append('group_id = ?')
+        params.append(group_id)
+    
+    query = 'SELECT hostname FROM hosts'
+    if clauses:
+        query += ' WHERE ' + ' AND '.join(clauses)
+    
+    db = get_db()
+    hosts = db.execute(query + ' ORDER BY hostname', params).fetchall()
+    db.close()
+    return [host['hostname'] for host in hosts]
+
+
+@app.route('/api/query', methods=['GET'])
+@login_required
+def query_range():
+    """Aligned step-bucketed series of one metric for many hosts (see range_query.py)
+    
+    hosts: comma-separated glob patterns, group: group id (both optional, combined with AND).
+    start/end: epoch seconds or ISO timestamps (default: the last hour), step: seconds,
+    agg: avg, min, max, sum or count of the values in each bucket.
+    
+    Each series has `available_from`, the first step holding data (None if it has none);
+    `partial` is true when some series has no data in the first step, i.e. the range reaches
+    past what the ring, the compressed series and the rollups still hold for that host.
+    """
+    metric = request.args.get('metric', default='cpu.cpu_percent_total')
+    patterns = [pattern.strip() for pattern in request.args.get('hosts', default='').split(',') if pattern.strip()]
+    group_id = request.args.get('group', type=int)
+    step = request.args.get('step', default=60, type=int)
+    agg = request.args.get('agg', default='avg')
+    end = parse_query_time(request.args.get('end'), time.time())
+    start = parse_query_time(request.args.get('start'), end - 3600 if end is not None else None)
+    
+    if metric not in range_query.QUERY_METRICS:
+        return jsonify({'error': f"Unknown metric '{metric}'"}), 400
+    if agg not in range_query.AGGREGATIONS:
+        return jsonify({'error': f"Unknown aggregation '{agg}'"}), 400
+    if start is None or end is None:
+        return jsonify({'error': 'start and end must be epoch seconds or ISO timestamps'}), 400
+    if step <= 0 or start >= end:
+        return jsonify({'error': 'step must be positive and start before end'}), 400
+    
+    start -= start % step
+    if (end - start) / step > QUERY_MAX_POINTS:
+        return jsonify({'error': f'Too many points per series (max {QUERY_MAX_POINTS}), increase step'}), 400
+    
+    if group_id is not None:
+        db = get_db()
+        group = db.execute('SELECT id FROM groups WHERE id = ?', (group_id,)).fetchone()
+        db.close()
+        if not group:
+            return jsonify({'error': 'Group not found'}), 404
+    
+    hostnames = select_hosts(patterns, group_id)
+    if len(hostnames) > QUERY_MAX_HOSTS:
+        return jsonify({'error': f'{len(hostnames)} hosts match (max {QUERY_MAX_HOSTS}), narrow the selection'}), 400
+    
+    # Per host the ring covers the newest part of the range, the compressed series the samples
+    # before it still in memory, rollup buckets whatever is older than both
+    resolution = range_query.rollup_resolution(metric, step) if history_db.HISTORY_DB else None
+    cuts = {}
+    older = {}
+    for hostname in hostnames:
+        ring = history_rings.get(hostname)
+        oldest = ring.oldest_timestamp() if ring is not None else None
+        timestamps, values = [], []
+        if oldest is None or oldest > start:
+            timestamps, values = store.get_compressed_series(hostname, metric, start,
+                                                             oldest if oldest is not None else end)
+        if timestamps:
+            oldest = timestamps[0]
+        cut = start
+        if resolution is not None and (oldest is None or oldest > start):
+            seconds = rollups.RESOLUTION_SECONDS[resolution]
+            # The bucket the raw samples start in is complete in the rollups table
+            cut = end if oldest is None else min(end, oldest + -oldest % seconds)
+        # Raw samples from the cut on, the rollups cover the rest
+        first = bisect_left(timestamps, cut)
+        cuts[hostname] = cut
+        older[hostname] = (timestamps[first:], values[first:])
+    
+    rolled = [hostname for hostname in hostnames if cuts[hostname] > start]
+    stored = {}
+    if rolled:
+        before = max(cuts[hostname] for hostname in rolled)
+        stored, unwritten = read_persisted('rollups', resolution, start, rolled,
+                                           lambda: history_db.read_rollup_range(rolled, resolution, start, before))
+        # Stored and unwritten parts of a bucket add up, StepBuckets sums them
+        for hostname, bucket_start, aggregates in unwritten:
+            stored.setdefault(hostname, []).append((bucket_start, aggregates))
+    
+    timestamps = [format_timestamp(epoch) for epoch in range_query.StepBuckets(start, end, step).timestamps()]
+    series = []
+    partial = False
+    for hostname in hostnames:
+        buckets = range_query.StepBuckets(start, end, step)
+        cut = cuts[hostname]
+        buckets.add_rollups(metric, [bucket for bucket in stored.get(hostname, ()) if bucket[0] < cut])
+        buckets.add_samples(*older[hostname])
+        ring = history_rings.get(hostname)
+        if ring is not None and cut < end:
+            columns = ring.read_columns([metric], since=cut)
+            buckets.add_samples(columns['timestamp'], columns[metric])
+        first = buckets.first_filled()
+        partial = partial or first != 0
+        series.append({
+            'hostname': hostname,
+            'available_from': timestamps[first] if first is not None else None,
+            'values': buckets.values(agg)
+        })
+    
+    return jsonify({
+        'metric': metric,
+        'agg': agg,
+        'step': step,
+        'start': format_timestamp(start),
+        'end': format_timestamp(end),
+        'resolution': resolution if rolled else 'raw',
+        'partial': partial,
+        'timestamps': timestamps,
+        'series': series
+    })
+
+
 @app.route('/api/servers/<hostname>/disk', methods=['GET'])
 def get_disk_info(hostname):
     """Get disk information for a specific server"""
-    with storage_lock:
-        metrics = current_metrics.get(hostname)
+    metrics = store.get_current(hostname)
     
     if not metrics:
         return jsonify({'error': 'Server not found'}), 404
@@ -949,30 +1778,25 @@ def get_network_info(hostname):
     """Get network I/O information"""
     minutes = request.args.get('minutes', default=5, type=int)
     
-    with storage_lock:
-        history = list(metrics_storage.get(hostname, []))
-    
-    if not history:
+    ring = history_rings.get(hostname)
+    if ring is None or not len(ring):
         return jsonify({'error': 'No data found for server'}), 404
     
-    # Get recent network data
-    cutoff_time = datetime.utcnow() - timedelta(minutes=minutes)
+    # Get recent network data: binary search for the window, then read four columns
+    names = ['network.bytes_sent_per_sec', 'network.bytes_recv_per_sec', 'network.bytes_sent', 'network.bytes_recv']
+    columns = ring.read_columns(names, since=time.time() - minutes * 60)
     network_data = []
     
-    for metric in reversed(history):
-        try:
-            metric_time = datetime.fromisoformat(metric['timestamp'].replace('Z', '+00:00'))
-            if metric_time >= cutoff_time:
-                io_data = metric.get('io', {}).get('network', {})
-                network_data.append({
-                    'timestamp': metric['timestamp'],
-                    'bytes_sent_per_sec': io_data.get('bytes_sent_per_sec', 0),
-                    'bytes_recv_per_sec': io_data.get('bytes_recv_per_sec', 0),
-                    'bytes_sent': io_data.get('bytes_sent', 0),
-                    'bytes_recv': io_data.get('bytes_recv', 0)
-                })
-        except:
-            continue
+    for k in range(len(columns['timestamp']) - 1, -1, -1):  # Most recent first
+        sent_rate = columns['network.bytes_sent_per_sec'][k]
+        recv_rate = columns['network.bytes_recv_per_sec'][k]
+        network_data.append({
+            'timestamp': format_timestamp(columns['timestamp'][k]),
+            'bytes_sent_per_sec': sent_rate if sent_rate == sent_rate else 0,
+            'bytes_recv_per_sec': recv_rate if recv_rate == recv_rate else 0,
+            'bytes_sent': columns['network.bytes_sent'][k],
+            'bytes_recv': columns['network.bytes_recv'][k]
+        })
     
     return jsonify(network_data)
 
@@ -1249,10 +2073,25 @@ if __name__ == '__main__':
     print("Starting Monitoring Server...")
     print("Initializing database...")
     init_db()
-    
-    # Start alert monitoring
-    print("Starting alert monitor...")
-    alert_system.start_alert_monitor(current_metrics, interval=30)
+    load_api_key_registry()
+    
+    # Turn SIGTERM (docker stop) into a normal exit so shutdown flushes run
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
+    # debug=True runs this block in the reloader's watcher process as well; only the process
+    # that serves requests (WERKZEUG_RUN_MAIN) owns the store's files and background jobs
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        # Reload the state of the previous run before accepting traffic
+        store.start_snapshotter()
+        sync_host_groups()
+        store.start_memory_budget()
+        start_last_seen_writer()
+        start_history_writer()
+        start_ingest_queue()
+        
+        # Start alert monitoring
+        print("Starting alert monitor...")
+        alert_system.start_alert_monitor(store.current_metrics, interval=30)
     
     print("Dashboard available at: http://localhost:5000")
     print("API endpoint: http://localhost:5000/api/metrics")
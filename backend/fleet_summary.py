@@ -0,0 +1,131 @@
+"""
+Fleet summary
+The latest values of every host are kept in columns (one array per metric, one slot per host)
+that the metric store updates at ingest. A summary is computed from the columns, one pass of
+builtins (sum, max, sorted) per column instead of walking every host's sample dict, and cached
+for FLEET_SUMMARY_TTL seconds: the dashboard's 10s refresh costs the same at any fleet size.
+
+Aggregates cover the hosts that are online, i.e. reported within the alert configuration's
+server_down_timeout; threshold counts use the alert thresholds too.
+"""
+import os
+import time
+from array import array
+from bisect import bisect_right
+from itertools import compress
+from threading import Lock
+
+FLEET_SUMMARY_TTL = float(os.environ.get('FLEET_SUMMARY_TTL', 5))  # seconds
+
+# Columns in column_values order: cpu_percent_total, memory_percent, swap_percent, the fullest
+# partition's percent, network bytes_sent/bytes_recv_per_sec
+FLEET_COLUMNS = ('cpu', 'memory', 'swap', 'disk', 'network_sent', 'network_recv')
+
+# Columns summarized with mean/max/percentiles, and the alert threshold each is checked against
+USAGE_COLUMNS = (('cpu', 'cpu_threshold'), ('memory', 'memory_threshold'), ('swap', None), ('disk', 'disk_threshold'))
+
+PERCENTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+
+NAN = float('nan')
+
+
+def column_values(metrics):
+    """Values of FLEET_COLUMNS in a sample, NaN where missing"""
+    io = metrics.get('io') or {}
+    partitions = (metrics.get('disk') or {}).get('partitions') or []
+    percents = [partition.get('percent') for partition in partitions if partition.get('percent') is not None]
+    raw = (
+        (metrics.get('cpu') or {}).get('cpu_percent_total'),
+        (metrics.get('memory') or {}).get('memory_percent'),
+        (metrics.get('memory') or {}).get('swap_percent'),
+        max(percents) if percents else None,
+        (io.get('network') or {}).get('bytes_sent_per_sec'),
+        (io.get('network') or {}).get('bytes_recv_per_sec'),
+    )
+    values = []
+    for value in raw:
+        try:
+            values.append(float(value))
+        except (TypeError, ValueError):
+            values.append(NAN)
+    return values
+
+
+def usage_summary(values, threshold=None):
+    """mean/max/percentiles of a column's values (already filtered), plus hosts over threshold"""
+    values = sorted(value for value in values if value == value)
+    summary = {'hosts': len(values)}
+    if values:
+        summary['mean'] = sum(values) / len(values)
+        summary['max'] = values[-1]
+        summary.update((label, values[round(q * (len(values) - 1))]) for label, q in PERCENTILES)
+    else:
+        summary.update(dict.fromkeys(('mean', 'max') + tuple(label for label, _ in PERCENTILES)))
+    if threshold is not None:
+        summary['threshold'] = threshold
+        # Alerts fire above the threshold
+        summary['over_threshold'] = len(values) - bisect_right(values, threshold)
+    return summary
+
+
+class FleetTable:
+    """Latest column values of every host (one writer per host: the metric store)"""
+
+    def __init__(self, ttl=FLEET_SUMMARY_TTL):
+        self.slots = {}  # hostname -> slot
+        self.hostnames = []  # appended last, so columns always have at least len(hostnames) slots
+        self.epochs = array('d')
+        self.columns = {name: array('d') for name in FLEET_COLUMNS}
+        self.slot_lock = Lock()  # new hosts of different shards may arrive together
+        self.ttl = ttl
+        self.cache = None  # (key, computed at, summary)
+
+    def update(self, hostname, epoch, metrics):
+        slot = self.slots.get(hostname)
+        if slot is None:
+            with self.slot_lock:
+                slot = self.slots.get(hostname)
+                if slot is None:
+                    self.epochs.append(epoch)
+                    for column in self.columns.values():
+                        column.append(NAN)
+                    slot = self.slots[hostname] = len(self.hostnames)
+                    self.hostnames.append(hostname)
+
+        self.epochs[slot] = epoch
+        for name, value in zip(FLEET_COLUMNS, column_values(metrics)):
+            self.columns[name][slot] = value
+
+    def summary(self, thresholds, down_timeout, now=None):
+        """Fleet summary (see the module docstring), cached for `ttl` seconds per configuration"""
+        now = time.time() if now is None else now
+        key = (tuple(sorted(thresholds.items())), down_timeout)
+        cache = self.cache
+        if cache is not None and cache[0] == key and now - cache[1] < self.ttl:
+            return cache[2]
+
+        count = len(self.hostnames)
+        cutoff = now - down_timeout
+        online = [epoch >= cutoff for epoch in self.epochs[:count]]
+        online_count = sum(online)
+
+        summary = {
+            'generated_at': now,
+            'hosts': count,
+            'status': {'online': online_count, 'down': count - online_count},
+            'network': {
+                'bytes_sent_per_sec': sum(value for value in compress(self.columns['network_sent'][:count], online)
+                                          if value == value),
+                'bytes_recv_per_sec': sum(value for value in compress(self.columns['network_recv'][:count], online)
+                                          if value == value)
+            }
+        }
+        for name, threshold_key in USAGE_COLUMNS:
+            threshold = thresholds.get(threshold_key) if threshold_key else None
+            summary[name] = usage_summary(compress(self.columns[name][:count], online), threshold)
+
+        self.cache = (key, now, summary)
+        return summary
+
+    def nbytes(self):
+        return 8 * len(self.epochs) * (len(self.columns) + 1)
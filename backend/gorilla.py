@@ -0,0 +1,382 @@
+"""
+Gorilla-compressed in-memory series
+Keeps days of raw samples of the rolled-up series (rollups.ROLLUP_METRICS) per host in RAM.
+Samples go into an uncompressed active chunk; when it is full it is encoded the way Facebook's
+Gorilla does it and kept as bytes:
+
+    timestamps  milliseconds, first one in 64 bits, then delta-of-delta in '0' | '10' + 7 bits |
+                '110' + 9 bits | '1110' + 12 bits | '1111' + 64 bits
+    values      first value in 64 bits, then the XOR with the previous one: '0' if equal, else
+                '10' + the meaningful bits inside the previous leading/trailing zero window, or
+                '11' + 5 bits leading zeros + 6 bits length - 1 + the meaningful bits
+
+Missing values are NaN. A query decodes only the chunks overlapping its window. History entries
+read from here carry 'source': 'compressed' (no partitions, per-core CPU, counters or load average).
+"""
+import math
+import os
+import struct
+from threading import Lock
+
+from ring_buffer import format_timestamp
+from rollups import IO_SECTIONS, ROLLUP_METRICS, sample_values
+
+COMPRESSED_HISTORY_HOURS = float(os.environ.get('COMPRESSED_HISTORY_HOURS', 72))  # 0 disables
+CHUNK_SIZE = int(os.environ.get('COMPRESSED_CHUNK_SIZE', 720))  # samples per chunk (1 hour at 5s)
+
+NAN = float('nan')
+DOUBLE = struct.Struct('>d')
+QWORD = struct.Struct('>Q')
+
+# (prefix, prefix length, value bits) of the delta-of-delta buckets
+DOD_BUCKETS = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12))
+
+
+class BitWriter:
+    """Appends bit fields to a growing integer"""
+
+    def __init__(self):
+        self.value = 0
+        self.length = 0
+
+    def write(self, bits, count):
+        self.value = (self.value << count) | bits
+        self.length += count
+
+    def to_bytes(self):
+        padding = -self.length % 8
+        return (self.value << padding).to_bytes((self.length + padding) // 8, 'big')
+
+
+class BitReader:
+    """Reads bit fields from bytes"""
+
+    def __init__(self, data):
+        self.bits = format(int.from_bytes(data, 'big'), f'0{len(data) * 8}b') if data else ''
+        self.position = 0
+
+    def read(self, count):
+        if count == 0:
+            return 0
+        start = self.position
+        self.position += count
+        return int(self.bits[start:self.position], 2)
+
+    def read_bit(self):
+        self.position += 1
+        return self.bits[self.position - 1] == '1'
+
+
+def encode_timestamps(timestamps):
+    """Delta-of-delta encoding of millisecond timestamps"""
+    writer = BitWriter()
+    previous = previous_delta = 0
+    for i, timestamp in enumerate(timestamps):
+        if i == 0:
+            writer.write(timestamp & 0xFFFFFFFFFFFFFFFF, 64)
+        else:
+            delta = timestamp - previous
+            dod = delta - previous_delta
+            if dod == 0:
+                writer.write(0, 1)
+            else:
+                for prefix, prefix_length, bits in DOD_BUCKETS:
+                    if -(1 << (bits - 1)) <= dod < 1 << (bits - 1):
+                        writer.write(prefix, prefix_length)
+                        writer.write(dod & ((1 << bits) - 1), bits)
+                        break
+                else:
+                    writer.write(0b1111, 4)
+                    writer.write(dod & 0xFFFFFFFFFFFFFFFF, 64)
+            previous_delta = delta
+        previous = timestamp
+    return writer.to_bytes()
+
+
+def signed(value, bits):
+    """Two's complement value of a bit field"""
+    return value - (1 << bits) if value >= 1 << (bits - 1) else value
+
+
+def decode_timestamps(data, count):
+    reader = BitReader(data)
+    timestamps = []
+    previous = previous_delta = 0
+    for i in range(count):
+        if i == 0:
+            previous = signed(reader.read(64), 64)
+        else:
+            if not reader.read_bit():
+                dod = 0
+            elif not reader.read_bit():
+                dod = signed(reader.read(7), 7)
+            elif not reader.read_bit():
+                dod = signed(reader.read(9), 9)
+            elif not reader.read_bit():
+                dod = signed(reader.read(12), 12)
+            else:
+                dod = signed(reader.read(64), 64)
+            previous_delta += dod
+            previous += previous_delta
+        timestamps.append(previous)
+    return timestamps
+
+
+def encode_values(values):
+    """XOR encoding of float values"""
+    writer = BitWriter()
+    previous = 0
+    leading = trailing = -1  # no zero window yet
+    for i, value in enumerate(values):
+        bits = QWORD.unpack(DOUBLE.pack(value))[0]
+        if i == 0:
+            writer.write(bits, 64)
+        else:
+            xor = bits ^ previous
+            if xor == 0:
+                writer.write(0, 1)
+            else:
+                new_leading = min(64 - xor.bit_length(), 31)
+                new_trailing = (xor & -xor).bit_length() - 1
+                if leading >= 0 and new_leading >= leading and new_trailing >= trailing:
+                    writer.write(0b10, 2)
+                    writer.write(xor >> trailing, 64 - leading - trailing)
+                else:
+                    leading, trailing = new_leading, new_trailing
+                    length = 64 - leading - trailing
+                    writer.write(0b11, 2)
+                    writer.write(leading, 5)
+                    writer.write(length - 1, 6)
+                    writer.write(xor >> trailing, length)
+        previous = bits
+    return writer.to_bytes()
+
+
+def decode_values(data, count):
+    reader = BitReader(data)
+    values = []
+    previous = 0
+    leading = trailing = 0
+    for i in range(count):
+        if i == 0:
+            previous = reader.read(64)
+        elif reader.read_bit():
+            if reader.read_bit():
+                leading = reader.read(5)
+                trailing = 64 - leading - (reader.read(6) + 1)
+            previous ^= reader.read(64 - leading - trailing) << trailing
+        values.append(DOUBLE.unpack(QWORD.pack(previous))[0])
+    return values
+
+
+def stored_epoch(epoch):
+    """An epoch rounded to milliseconds like the timestamps kept here
+
+    Window bounds taken from another store (the ring's oldest sample) must be rounded the same
+    way, or the copy of that sample kept here falls just inside the window.
+    """
+    return round(epoch * 1000) / 1000 if math.isfinite(epoch) else epoch
+
+
+def series_entry(hostname, epoch, values):
+    """History entry of a sample held here: the rolled-up series in the sample layout
+
+    Only ROLLUP_METRICS are kept, `source` tells clients the entry has this reduced shape.
+    """
+    entry = {'timestamp': format_timestamp(epoch), 'hostname': hostname, 'source': 'compressed'}
+    for name, value in zip(ROLLUP_METRICS, values):
+        section, key = name.split('.', 1)
+        target = entry.setdefault('io', {}) if section in IO_SECTIONS else entry
+        target.setdefault(section, {})[key] = value if value == value else None
+    return entry
+
+
+class Chunk:
+    """A closed chunk: compressed timestamps and one compressed stream per metric"""
+
+    __slots__ = ('start', 'end', 'count', 'timestamps', 'values')
+
+    def __init__(self, timestamps, columns):
+        self.start = timestamps[0] / 1000
+        self.end = timestamps[-1] / 1000
+        self.count = len(timestamps)
+        self.timestamps = encode_timestamps(timestamps)
+        self.values = [encode_values(column) for column in columns]
+
+    def nbytes(self):
+        return len(self.timestamps) + sum(len(stream) for stream in self.values)
+
+    def decode(self):
+        """(epoch seconds, columns)"""
+        timestamps = [timestamp / 1000 for timestamp in decode_timestamps(self.timestamps, self.count)]
+        return timestamps, [decode_values(stream, self.count) for stream in self.values]
+
+    def decode_column(self, index):
+        """(epoch seconds, values) of one metric"""
+        timestamps = [timestamp / 1000 for timestamp in decode_timestamps(self.timestamps, self.count)]
+        return timestamps, decode_values(self.values[index], self.count)
+
+
+class HostSeries:
+    """Closed chunks plus the active (uncompressed) chunk of one host
+
+    One writer per host (the metric store's shard lock guarantees it). The lock is held only to
+    publish changes and to take a reader's snapshot: a full active chunk is encoded outside it,
+    and the chunk list is replaced rather than modified, so readers decode without it.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.chunks = []
+        self.timestamps = []  # active chunk, milliseconds
+        self.columns = [[] for _ in ROLLUP_METRICS]
+
+    def append(self, epoch, values, chunk_size, retention):
+        timestamp = int(round(epoch * 1000))
+        with self.lock:
+            if self.timestamps and timestamp < self.timestamps[-1]:
+                # Keep timestamps non-decreasing (delta-of-delta and window search rely on it)
+                timestamp = self.timestamps[-1]
+            for column, value in zip(self.columns, values):
+                column.append(NAN if value is None else value)
+            self.timestamps.append(timestamp)
+            if len(self.timestamps) < chunk_size:
+                return
+
+        # Only this writer modifies the active chunk, readers keep seeing it until it is replaced
+        chunk = Chunk(self.timestamps, self.columns)
+        cutoff = epoch - retention
+        with self.lock:
+            self.chunks = [kept for kept in self.chunks if kept.end >= cutoff] + [chunk]
+            self.timestamps = []
+            self.columns = [[] for _ in ROLLUP_METRICS]
+
+    def evict_oldest(self):
+        """Drop the oldest closed chunk, returns it (None if there is none left)"""
+        with self.lock:
+            if not self.chunks:
+                return None
+            chunk, self.chunks = self.chunks[0], self.chunks[1:]
+            return chunk
+
+    def read(self, since, before, limit):
+        """The last `limit` (epoch, values) pairs with since <= epoch < before, oldest first"""
+        with self.lock:
+            chunks = self.chunks
+            timestamps = list(self.timestamps)
+            columns = [column[:len(timestamps)] for column in self.columns]
+
+        samples = [(timestamp / 1000, [column[k] for column in columns])
+                   for k, timestamp in enumerate(timestamps) if since <= timestamp / 1000 < before]
+
+        # Newest chunk first, decode only those overlapping the window until `limit` is reached
+        for chunk in reversed(chunks):
+            if len(samples) >= limit or chunk.end < since:
+                break
+            if chunk.start >= before:
+                continue
+            timestamps, columns = chunk.decode()
+            samples = [(timestamp, [column[k] for column in columns])
+                       for k, timestamp in enumerate(timestamps) if since <= timestamp < before] + samples
+
+        return samples[-limit:] if limit > 0 else []
+
+    def read_column(self, index, since, before):
+        """(timestamps, values) of one metric with since <= epoch < before, oldest first"""
+        with self.lock:
+            chunks = self.chunks
+            active = list(self.timestamps)
+            column = self.columns[index][:len(active)]
+
+        timestamps, values = [], []
+        for chunk in chunks:
+            if chunk.end < since or chunk.start >= before:
+                continue
+            chunk_timestamps, chunk_values = chunk.decode_column(index)
+            for timestamp, value in zip(chunk_timestamps, chunk_values):
+                if since <= timestamp < before:
+                    timestamps.append(timestamp)
+                    values.append(value)
+        for timestamp, value in zip(active, column):
+            if since <= timestamp / 1000 < before:
+                timestamps.append(timestamp / 1000)
+                values.append(value)
+        return timestamps, values
+
+    def nbytes(self):
+        """Approximate memory of the compressed data plus the active chunk"""
+        return sum(chunk.nbytes() for chunk in self.chunks) + len(self.timestamps) * 8 * (len(self.columns) + 1)
+
+
+class CompressedHistory:
+    """Gorilla-compressed series of every host (one writer per host: the metric store)"""
+
+    def __init__(self, hours=COMPRESSED_HISTORY_HOURS, chunk_size=CHUNK_SIZE):
+        self.retention = hours * 3600
+        self.chunk_size = chunk_size
+        self.hosts = {}
+
+    def append(self, hostname, epoch, metrics):
+        """Add a sample's rolled-up series to its host (closing and encoding a full active chunk)"""
+        series = self.hosts.get(hostname)
+        if series is None:
+            series = self.hosts.setdefault(hostname, HostSeries())
+        series.append(epoch, sample_values(metrics), self.chunk_size, self.retention)
+
+    def nbytes(self):
+        """Approximate memory of every host's series"""
+        return sum(series.nbytes() for series in list(self.hosts.values()))
+
+    def evict(self, target_bytes, priorities):
+        """Drop the oldest closed chunks until target_bytes are freed, lowest-priority hosts first
+
+        `priorities` maps hostnames to a priority (missing hosts count as 0). Returns
+        (chunks, samples, bytes) freed.
+        """
+        hosts = list(self.hosts.items())
+        candidates = sorted((priorities.get(hostname, 0), chunk.end, hostname)
+                            for hostname, series in hosts for chunk in series.chunks)
+        chunks = samples = freed = 0
+        for _, _, hostname in candidates:
+            if freed >= target_bytes:
+                break
+            # A host's chunks come up oldest first
+            chunk = self.hosts[hostname].evict_oldest()
+            if chunk is None:
+                continue
+            chunks += 1
+            samples += chunk.count
+            freed += chunk.nbytes()
+        return chunks, samples, freed
+
+    def read(self, hostname, since, before, limit):
+        """History entries of a host with since <= timestamp < before, the last `limit`, oldest first"""
+        series = self.hosts.get(hostname)
+        if series is None:
+            return []
+        return [series_entry(hostname, epoch, values)
+                for epoch, values in series.read(stored_epoch(since), stored_epoch(before), limit)]
+
+    def read_series(self, hostname, name, since, before):
+        """(timestamps, values) of one ROLLUP_METRICS series of a host, since <= timestamp < before
+
+        Timestamps are non-decreasing, missing values are NaN.
+        """
+        series = self.hosts.get(hostname)
+        if series is None:
+            return [], []
+        return series.read_column(ROLLUP_METRICS.index(name), stored_epoch(since), stored_epoch(before))
+
+    def get_stats(self):
+        series_list = list(self.hosts.values())
+        chunks = [chunk for series in series_list for chunk in series.chunks]
+        compressed = sum(chunk.nbytes() for chunk in chunks)
+        compressed_samples = sum(chunk.count for chunk in chunks)
+        return {
+            'hosts': len(series_list),
+            'samples': compressed_samples + sum(len(series.timestamps) for series in series_list),
+            'bytes': sum(series.nbytes() for series in series_list),
+            'compressed_bytes_per_sample': round(compressed / compressed_samples, 2) if compressed_samples else None,
+            'retention_hours': self.retention / 3600,
+            'chunk_size': self.chunk_size
+        }
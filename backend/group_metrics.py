@@ -0,0 +1,230 @@
+"""
+Group metrics
+Aggregate series of every host group, built as host samples arrive. A sample only replaces its
+host's latest values in the group (O(1)); once per GROUP_STEP seconds a point is taken over the
+members that reported within GROUP_ONLINE_TIMEOUT: average and max CPU and memory, summed
+network and disk throughput, online and member counts. Like a rollup bucket, a step is closed by
+the first member sample of the next step, so queries never walk the members.
+
+Points are kept in memory for GROUP_HISTORY_POINTS steps and handed to the history writer, which
+merges them into the 1m/5m/1h buckets of the group_rollups table. Bucket aggregates have the
+rollups.py layout (count, sum, min, max per GROUP_FIELDS entry).
+
+Group membership comes from hosts.group_id; app.py pushes it with set_host_groups.
+"""
+import os
+import struct
+from collections import deque
+from threading import Lock
+
+import rollups
+from ring_buffer import format_timestamp
+
+GROUP_STEP = int(os.environ.get('GROUP_STEP', 60))  # seconds per point
+GROUP_HISTORY_POINTS = int(os.environ.get('GROUP_HISTORY_POINTS', 1440))  # in memory per group
+GROUP_ONLINE_TIMEOUT = float(os.environ.get('GROUP_ONLINE_TIMEOUT', 60))  # seconds
+
+# Append only: stored buckets are decoded by position
+GROUP_FIELDS = (
+    'cpu_avg',
+    'cpu_max',
+    'memory_avg',
+    'memory_max',
+    'network_sent_per_sec',
+    'network_recv_per_sec',
+    'disk_read_per_sec',
+    'disk_write_per_sec',
+    'online',
+    'hosts',
+)
+
+# Member values, from a sample's rolled-up series (see rollups.ROLLUP_METRICS)
+MEMBER_METRICS = (
+    'cpu.cpu_percent_total',
+    'memory.memory_percent',
+    'network.bytes_sent_per_sec',
+    'network.bytes_recv_per_sec',
+    'disk_io.read_bytes_per_sec',
+    'disk_io.write_bytes_per_sec',
+)
+MEMBER_INDEXES = [rollups.ROLLUP_METRICS.index(name) for name in MEMBER_METRICS]
+
+
+def member_values(metrics):
+    """Values of MEMBER_METRICS in a sample, None where missing"""
+    values = rollups.sample_values(metrics)
+    return tuple(values[index] for index in MEMBER_INDEXES)
+
+
+def group_point(members, end):
+    """GROUP_FIELDS values over the members that reported within GROUP_ONLINE_TIMEOUT of `end`"""
+    online = [values for epoch, values in members.values() if epoch >= end - GROUP_ONLINE_TIMEOUT]
+    columns = [[value[i] for value in online if value[i] is not None] for i in range(len(MEMBER_METRICS))]
+    cpu, memory, sent, recv, read, write = columns
+    return [
+        sum(cpu) / len(cpu) if cpu else None,
+        max(cpu) if cpu else None,
+        sum(memory) / len(memory) if memory else None,
+        max(memory) if memory else None,
+        sum(sent) if sent else None,
+        sum(recv) if recv else None,
+        sum(read) if read else None,
+        sum(write) if write else None,
+        float(len(online)),
+        float(len(members))
+    ]
+
+
+def new_aggregates():
+    return [0.0, 0.0, rollups.INF, -rollups.INF] * len(GROUP_FIELDS)
+
+
+def point_aggregates(values):
+    """Aggregates of a single point"""
+    aggregates = new_aggregates()
+    rollups.update(aggregates, values)
+    return aggregates
+
+
+def decode_aggregates(data):
+    """Aggregates from rollups.encode_aggregates, fields added since the bucket was written are empty"""
+    values = list(struct.unpack(f'<{len(data) // 8}d', data))
+    return values + new_aggregates()[len(values):]
+
+
+def summarize(aggregates):
+    """{field: {count, average, min, max}} of the fields with at least one value"""
+    summary = {}
+    for i, name in enumerate(GROUP_FIELDS):
+        count, total, low, high = aggregates[4 * i:4 * i + 4]
+        if count:
+            summary[name] = {'count': int(count), 'average': total / count, 'min': low, 'max': high}
+    return summary
+
+
+def point_entry(start, values):
+    entry = dict(zip(GROUP_FIELDS, values))
+    entry['timestamp'] = format_timestamp(start)
+    return entry
+
+
+def bucket_entry(start, aggregates):
+    """Series entry of a stored bucket: averages of every field"""
+    entry = {name: values['average'] for name, values in summarize(aggregates).items()}
+    entry['timestamp'] = format_timestamp(start)
+    return entry
+
+
+class GroupState:
+    """Latest values of a group's members, its open step and its recent points"""
+
+    __slots__ = ('lock', 'members', 'step', 'points')
+
+    def __init__(self):
+        self.lock = Lock()  # members of a group are stored under different shard locks
+        self.members = {}  # hostname -> (epoch, member values)
+        self.step = None  # start of the open step
+        self.points = deque(maxlen=GROUP_HISTORY_POINTS)  # (start, GROUP_FIELDS values)
+
+
+class GroupAggregator:
+    """Group series of every group (see the module docstring)
+
+    Closed points go to `sink` as (group_id, resolution, start, aggregates) rows, one per
+    resolution; the rows of a point share its aggregates list.
+    """
+
+    def __init__(self, sink=None):
+        self.host_groups = {}  # hostname -> group id
+        self.groups = {}  # group id -> GroupState
+        self.sink = sink
+
+    def set_host_groups(self, mapping):
+        """Replace the membership of every host ({hostname: group id or None})"""
+        for hostname in list(self.host_groups):
+            if hostname not in mapping:
+                self.set_host_group(hostname, None)
+        for hostname, group_id in mapping.items():
+            self.set_host_group(hostname, group_id)
+        # Members restored from a snapshot may have moved while the server was down
+        for group_id, state in list(self.groups.items()):
+            with state.lock:
+                for hostname in [hostname for hostname in state.members if self.host_groups.get(hostname) != group_id]:
+                    del state.members[hostname]
+
+    def set_host_group(self, hostname, group_id):
+        """Move a host to a group (None: no group), its values follow with its next sample"""
+        previous = self.host_groups.get(hostname)
+        if previous == group_id:
+            return
+        if group_id is None:
+            self.host_groups.pop(hostname, None)
+        else:
+            self.host_groups[hostname] = group_id
+        state = self.groups.get(previous)
+        if state is not None:
+            with state.lock:
+                state.members.pop(hostname, None)
+
+    def update(self, hostname, epoch, metrics):
+        """Take a host sample into its group, closing the group's step when it moved past it"""
+        group_id = self.host_groups.get(hostname)
+        if group_id is None:
+            return
+        state = self.groups.get(group_id)
+        if state is None:
+            state = self.groups.setdefault(group_id, GroupState())
+
+        step = epoch - epoch % GROUP_STEP
+        rows = []
+        with state.lock:
+            if state.step is None:
+                state.step = step
+            elif step > state.step:
+                values = group_point(state.members, state.step + GROUP_STEP)
+                state.points.append((state.step, values))
+                aggregates = point_aggregates(values)
+                rows = [(group_id, name, state.step - state.step % seconds, aggregates)
+                        for name, seconds in rollups.RESOLUTIONS]
+                state.step = step
+            # Samples of an already closed step count towards the open one
+            state.members[hostname] = (epoch, member_values(metrics))
+
+        if rows and self.sink is not None:
+            self.sink(rows)
+
+    def read(self, group_id, since):
+        """Points of a group with start >= since, oldest first"""
+        state = self.groups.get(group_id)
+        if state is None:
+            return []
+        return [(start, values) for start, values in list(state.points) if start >= since]
+
+    def oldest(self, group_id):
+        """Start of the oldest point held for a group, None if there is none"""
+        state = self.groups.get(group_id)
+        try:
+            return state.points[0][0] if state is not None else None
+        except IndexError:
+            return None
+
+    def export(self):
+        """JSON-able state of every group (for snapshots)"""
+        state = {}
+        for group_id, group in list(self.groups.items()):
+            with group.lock:
+                state[str(group_id)] = {
+                    'step': group.step,
+                    'members': {hostname: [epoch, list(values)] for hostname, (epoch, values) in group.members.items()},
+                    'points': [[start, values] for start, values in group.points]
+                }
+        return state
+
+    def restore(self, state):
+        for group_id, saved in state.items():
+            group = self.groups.setdefault(int(group_id), GroupState())
+            with group.lock:
+                group.step = saved.get('step')
+                group.members.update({hostname: (epoch, tuple(values))
+                                      for hostname, (epoch, values) in saved.get('members', {}).items()})
+                group.points.extend((start, values) for start, values in saved.get('points', []))
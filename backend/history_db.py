@@ -0,0 +1,488 @@
+"""
+Durable metric history in SQLite
+Samples are queued by the metric store and written by a background thread in one
+transaction every few seconds; a retention job deletes data past a configurable age in
+bounded chunks. The database runs in WAL mode so the history endpoints of every worker
+can read it while the writer appends. /api/servers/<hostname>/history falls back to it
+when the requested window reaches past the in-memory ring.
+
+Closed rollup buckets (see rollups.py) go through the same writer into the rollups table,
+merged with any bucket already stored for the same host, resolution and start. Quantile
+sketches and group buckets (see group_metrics.py) are merged the same way into the sketches
+and group_rollups tables.
+"""
+import json
+import os
+import sqlite3
+import time
+import zlib
+from collections import deque
+from threading import Condition, Thread
+
+import group_metrics
+import quantile_sketch
+import rollups
+from ring_buffer import format_timestamp
+
+# Empty HISTORY_DB disables persistence
+HISTORY_DB = os.environ.get('HISTORY_DB', os.path.join('data', 'metrics.db'))
+HISTORY_FLUSH_INTERVAL = float(os.environ.get('HISTORY_FLUSH_INTERVAL', 5))  # seconds
+HISTORY_RETENTION_DAYS = float(os.environ.get('HISTORY_RETENTION_DAYS', 30))  # 0 keeps everything
+HISTORY_RETENTION_CHUNK = int(os.environ.get('HISTORY_RETENTION_CHUNK', 5000))  # rows per delete transaction
+HISTORY_MAX_PENDING = int(os.environ.get('HISTORY_MAX_PENDING', 200000))  # queued samples before dropping
+
+RETENTION_INTERVAL = 600  # seconds between retention runs
+
+# Sections of a sample kept on disk (the same ones a history entry has)
+PERSISTED_SECTIONS = ('cpu', 'memory', 'disk', 'io')
+
+
+def connect(path=HISTORY_DB):
+    """Open the history database (WAL, relaxed fsync: a crash loses at most the last flush)"""
+    db = sqlite3.connect(path, timeout=30)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+
+def init_history_db(path=HISTORY_DB):
+    """Create the samples table"""
+    db = connect(path)
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS samples (
+            hostname TEXT NOT NULL,
+            ts REAL NOT NULL,
+            data BLOB NOT NULL
+        )
+    ''')
+    db.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_samples_host_ts ON samples (hostname, ts)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_samples_ts ON samples (ts)')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS rollups (
+            hostname TEXT NOT NULL,
+            resolution TEXT NOT NULL,
+            ts REAL NOT NULL,
+            data BLOB NOT NULL
+        )
+    ''')
+    db.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_rollups_host_res_ts ON rollups (hostname, resolution, ts)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_rollups_res_ts ON rollups (resolution, ts)')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS sketches (
+            hostname TEXT NOT NULL,
+            resolution TEXT NOT NULL,
+            ts REAL NOT NULL,
+            data BLOB NOT NULL
+        )
+    ''')
+    db.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_sketches_host_res_ts ON sketches (hostname, resolution, ts)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_sketches_res_ts ON sketches (resolution, ts)')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS group_rollups (
+            group_id INTEGER NOT NULL,
+            resolution TEXT NOT NULL,
+            ts REAL NOT NULL,
+            data BLOB NOT NULL
+        )
+    ''')
+    db.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_group_rollups_group_res_ts ON group_rollups (group_id, resolution, ts)')
+    db.commit()
+    db.close()
+
+
+def encode_sample(metrics):
+    """Compressed JSON of the persisted sections of a sample"""
+    data = {section: metrics[section] for section in PERSISTED_SECTIONS if section in metrics}
+    return zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'), 1)
+
+
+def decode_sample(hostname, ts, data):
+    """History entry from a stored row"""
+    entry = json.loads(zlib.decompress(data))
+    entry['timestamp'] = format_timestamp(ts)
+    entry['hostname'] = hostname
+    return entry
+
+
+def read_samples(hostname, since, before, limit, path=HISTORY_DB):
+    """The last `limit` stored entries of a host with since <= ts < before, oldest first"""
+    if not path or not os.path.exists(path) or limit <= 0:
+        return []
+
+    db = sqlite3.connect(path, timeout=30)
+    try:
+        rows = db.execute(
+            'SELECT ts, data FROM samples WHERE hostname = ? AND ts >= ? AND ts < ? ORDER BY ts DESC LIMIT ?',
+            (hostname, since, before, limit)
+        ).fetchall()
+    except sqlite3.OperationalError:
+        # Table not created yet
+        return []
+    finally:
+        db.close()
+
+    return [decode_sample(hostname, ts, data) for ts, data in reversed(rows)]
+
+
+def read_rollups(hostname, resolution, since, limit, path=HISTORY_DB):
+    """The last `limit` stored buckets of a host at a resolution with ts >= since, oldest first
+
+    Returns (start, aggregates) pairs.
+    """
+    if not path or not os.path.exists(path) or limit <= 0:
+        return []
+
+    db = sqlite3.connect(path, timeout=30)
+    try:
+        rows = db.execute(
+            'SELECT ts, data FROM rollups WHERE hostname = ? AND resolution = ? AND ts >= ? ORDER BY ts DESC LIMIT ?',
+            (hostname, resolution, since, limit)
+        ).fetchall()
+    except sqlite3.OperationalError:
+        # Table not created yet
+        return []
+    finally:
+        db.close()
+
+    return [(ts, rollups.decode_aggregates(data)) for ts, data in reversed(rows)]
+
+
+def read_rollup_range(hostnames, resolution, since, before, path=HISTORY_DB):
+    """Stored buckets of several hosts at a resolution with since <= ts < before, in one query
+
+    Returns {hostname: [(start, aggregates)]}, oldest first.
+    """
+    hostnames = list(hostnames)
+    if not path or not os.path.exists(path) or not hostnames or since >= before:
+        return {}
+
+    db = sqlite3.connect(path, timeout=30)
+    try:
+        rows = db.execute(
+            f"SELECT hostname, ts, data FROM rollups WHERE hostname IN ({','.join('?' * len(hostnames))}) "
+            'AND resolution = ? AND ts >= ? AND ts < ? ORDER BY hostname, ts',
+            hostnames + [resolution, since, before]
+        ).fetchall()
+    except sqlite3.OperationalError:
+        # Table not created yet
+        return {}
+    finally:
+        db.close()
+
+    buckets = {}
+    for hostname, ts, data in rows:
+        buckets.setdefault(hostname, []).append((ts, rollups.decode_aggregates(data)))
+    return buckets
+
+
+def read_group_rollups(group_id, resolution, since, limit, path=HISTORY_DB):
+    """The last `limit` stored buckets of a group at a resolution with ts >= since, oldest first
+
+    Returns (start, aggregates) pairs (see group_metrics.GROUP_FIELDS).
+    """
+    if not path or not os.path.exists(path) or limit <= 0:
+        return []
+
+    db = sqlite3.connect(path, timeout=30)
+    try:
+        rows = db.execute(
+            'SELECT ts, data FROM group_rollups WHERE group_id = ? AND resolution = ? AND ts >= ? '
+            'ORDER BY ts DESC LIMIT ?',
+            (group_id, resolution, since, limit)
+        ).fetchall()
+    except sqlite3.OperationalError:
+        # Table not created yet
+        return []
+    finally:
+        db.close()
+
+    return [(ts, group_metrics.decode_aggregates(data)) for ts, data in reversed(rows)]
+
+
+def read_sketches(resolution, since, hostnames=None, path=HISTORY_DB):
+    """Stored sketches at a resolution with ts >= since, merged per host
+
+    Returns {hostname: sketches}, for the given hosts or every host when hostnames is None.
+    """
+    if not path or not os.path.exists(path):
+        return {}
+
+    query = 'SELECT hostname, data FROM sketches WHERE resolution = ? AND ts >= ?'
+    params = [resolution, since]
+    if hostnames is not None:
+        hostnames = list(hostnames)
+        if not hostnames:
+            return {}
+        query += f" AND hostname IN ({','.join('?' * len(hostnames))})"
+        params.extend(hostnames)
+
+    db = sqlite3.connect(path, timeout=30)
+    try:
+        rows = db.execute(query, params).fetchall()
+    except sqlite3.OperationalError:
+        # Table not created yet
+        return {}
+    finally:
+        db.close()
+
+    merged = {}
+    for hostname, data in rows:
+        sketches = rollups.decode_sketches(data)
+        if hostname in merged:
+            quantile_sketch.merge_sketches(merged[hostname], sketches)
+        else:
+            merged[hostname] = sketches
+    return merged
+
+
+class HistoryWriter:
+    """Background writer that batches samples into large SQLite transactions"""
+
+    def __init__(self, path=HISTORY_DB, interval=HISTORY_FLUSH_INTERVAL, retention_days=HISTORY_RETENTION_DAYS,
+                 retention_chunk=HISTORY_RETENTION_CHUNK, max_pending=HISTORY_MAX_PENDING):
+        self.path = path
+        self.interval = interval
+        self.retention_days = retention_days
+        self.retention_chunk = retention_chunk
+        self.max_pending = max_pending
+        self.pending = deque()  # (hostname, ts, sample) not yet written
+        self.pending_rollups = {}  # (hostname, resolution, start) -> aggregates not yet written
+        self.pending_sketches = {}  # (hostname, resolution, start) -> sketches not yet written
+        self.pending_group_rollups = {}  # (group id, resolution, start) -> aggregates not yet written
+        # Buckets taken by the flush in progress, readable until it commits (see unwritten)
+        self.writing = {'rollups': {}, 'sketches': {}, 'group_rollups': {}}
+        self.generation = 0  # flushes finished, readers retry when it changed under them
+        self.condition = Condition()
+        self.running = False
+        self.writer_thread = None
+        self.last_retention = 0
+        self.stats = {
+            'rows_written': 0,
+            'duplicates': 0,  # samples not written, their host already had one with the same timestamp
+            'flushes': 0,
+            'errors': 0,
+            'dropped': 0,  # samples discarded because the queue was full
+            'rows_deleted': 0,
+            'rollups_written': 0,
+            'sketches_written': 0,
+            'group_rollups_written': 0,
+            'last_flush_seconds': 0.0
+        }
+
+    def add(self, hostname, ts, metrics):
+        """Queue a sample (serialized later by the writer thread)"""
+        with self.condition:
+            if len(self.pending) >= self.max_pending:
+                self.pending.popleft()
+                self.stats['dropped'] += 1
+            self.pending.append((hostname, ts, metrics))
+
+    def add_rollups(self, buckets):
+        """Queue closed rollup buckets, (hostname, resolution, start, aggregates) each"""
+        with self.condition:
+            for hostname, resolution, start, aggregates in buckets:
+                key = (hostname, resolution, start)
+                if key in self.pending_rollups:
+                    rollups.merge(self.pending_rollups[key], aggregates)
+                else:
+                    self.pending_rollups[key] = list(aggregates)
+
+    def add_sketches(self, buckets):
+        """Queue closed sketches, (hostname, resolution, start, sketches) each"""
+        with self.condition:
+            for hostname, resolution, start, sketches in buckets:
+                key = (hostname, resolution, start)
+                if key in self.pending_sketches:
+                    quantile_sketch.merge_sketches(self.pending_sketches[key], sketches)
+                else:
+                    # The same sketches come for every resolution, merges must not modify them
+                    self.pending_sketches[key] = [sketch.copy() for sketch in sketches]
+
+    def add_group_rollups(self, buckets):
+        """Queue closed group points, (group id, resolution, start, aggregates) each"""
+        with self.condition:
+            for group_id, resolution, start, aggregates in buckets:
+                key = (group_id, resolution, start)
+                if key in self.pending_group_rollups:
+                    rollups.merge(self.pending_group_rollups[key], aggregates)
+                else:
+                    # The rows of a point share its aggregates, merges must not modify them
+                    self.pending_group_rollups[key] = list(aggregates)
+
+    def unwritten(self, kind, resolution, since, owners=None):
+        """Closed buckets not committed yet: (generation, [(owner, start, value)])
+
+        kind is 'rollups', 'sketches' or 'group_rollups', owners the hostnames (group ids) to
+        return or None for all. Values are copies. A reader that read the table before calling
+        this must read again if the generation changed since, a flush may have committed between.
+        """
+        owners = set(owners) if owners is not None else None
+        copy = (lambda sketches: [sketch.copy() for sketch in sketches]) if kind == 'sketches' else list
+        with self.condition:
+            batches = (self.writing[kind], getattr(self, 'pending_' + kind))
+            entries = [(key[0], key[2], copy(value)) for batch in batches for key, value in batch.items()
+                       if key[1] == resolution and key[2] >= since and (owners is None or key[0] in owners)]
+            return self.generation, entries
+
+    def write_group_rollups(self, db, buckets):
+        """Merge group buckets into the group_rollups table (caller owns the transaction)"""
+        for (group_id, resolution, start), aggregates in buckets.items():
+            row = db.execute('SELECT data FROM group_rollups WHERE group_id = ? AND resolution = ? AND ts = ?',
+                             (group_id, resolution, start)).fetchone()
+            if row is not None:
+                aggregates = rollups.merge(group_metrics.decode_aggregates(row[0]), aggregates)
+            db.execute('INSERT OR REPLACE INTO group_rollups (group_id, resolution, ts, data) VALUES (?, ?, ?, ?)',
+                       (group_id, resolution, start, rollups.encode_aggregates(aggregates)))
+
+    def write_sketches(self, db, buckets):
+        """Merge sketches into the sketches table (caller owns the transaction)"""
+        for (hostname, resolution, start), sketches in buckets.items():
+            row = db.execute('SELECT data FROM sketches WHERE hostname = ? AND resolution = ? AND ts = ?',
+                             (hostname, resolution, start)).fetchone()
+            if row is not None:
+                sketches = quantile_sketch.merge_sketches(rollups.decode_sketches(row[0]), sketches)
+            db.execute('INSERT OR REPLACE INTO sketches (hostname, resolution, ts, data) VALUES (?, ?, ?, ?)',
+                       (hostname, resolution, start, quantile_sketch.encode_sketches(sketches)))
+
+    def write_rollups(self, db, buckets):
+        """Merge buckets into the rollups table (caller owns the transaction)"""
+        for (hostname, resolution, start), aggregates in buckets.items():
+            row = db.execute('SELECT data FROM rollups WHERE hostname = ? AND resolution = ? AND ts = ?',
+                             (hostname, resolution, start)).fetchone()
+            if row is not None:
+                aggregates = rollups.merge(rollups.decode_aggregates(row[0]), aggregates)
+            db.execute('INSERT OR REPLACE INTO rollups (hostname, resolution, ts, data) VALUES (?, ?, ?, ?)',
+                       (hostname, resolution, start, rollups.encode_aggregates(aggregates)))
+
+    def flush(self):
+        """Write all queued samples and rollup buckets in a single transaction"""
+        with self.condition:
+            rows = list(self.pending)
+            self.pending.clear()
+            buckets, self.pending_rollups = self.pending_rollups, {}
+            sketches, self.pending_sketches = self.pending_sketches, {}
+            group_buckets, self.pending_group_rollups = self.pending_group_rollups, {}
+            self.writing = {'rollups': buckets, 'sketches': sketches, 'group_rollups': group_buckets}
+        if not rows and not buckets and not sketches and not group_buckets:
+            return 0
+
+        started = time.time()
+        try:
+            data = [(hostname, ts, encode_sample(metrics)) for hostname, ts, metrics in rows]
+            db = connect(self.path)
+            with db:
+                # A second sample of a host with the same timestamp (a replayed batch) is kept out
+                # instead of overwriting the first one, and counted
+                inserted = db.executemany('INSERT OR IGNORE INTO samples (hostname, ts, data) VALUES (?, ?, ?)',
+                                          data).rowcount
+                self.write_rollups(db, buckets)
+                self.write_sketches(db, sketches)
+                self.write_group_rollups(db, group_buckets)
+            db.close()
+        except Exception as e:
+            print(f"[ERROR] Failed to write {len(rows)} samples to {self.path}: {e}")
+            with self.condition:
+                # Retry with the next flush, the oldest samples go first if the queue overflows
+                self.pending.extendleft(reversed(rows))
+                while len(self.pending) > self.max_pending:
+                    self.pending.popleft()
+                    self.stats['dropped'] += 1
+                self.add_rollups([key + (aggregates,) for key, aggregates in buckets.items()])
+                self.add_sketches([key + (merged,) for key, merged in sketches.items()])
+                self.add_group_rollups([key + (aggregates,) for key, aggregates in group_buckets.items()])
+                self.writing = {'rollups': {}, 'sketches': {}, 'group_rollups': {}}
+                self.generation += 1
+                self.stats['errors'] += 1
+            return 0
+
+        with self.condition:
+            self.writing = {'rollups': {}, 'sketches': {}, 'group_rollups': {}}
+            self.generation += 1
+            self.stats['rows_written'] += inserted
+            self.stats['duplicates'] += len(rows) - inserted
+            self.stats['rollups_written'] += len(buckets)
+            self.stats['sketches_written'] += len(sketches)
+            self.stats['group_rollups_written'] += len(group_buckets)
+            self.stats['flushes'] += 1
+            self.stats['last_flush_seconds'] = round(time.time() - started, 4)
+        return len(rows)
+
+    def delete_chunked(self, db, table, where, params):
+        """Delete matching rows one bounded chunk per transaction, returns the count"""
+        deleted = 0
+        while True:
+            with db:
+                count = db.execute(
+                    f'DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE {where} LIMIT ?)',
+                    params + (self.retention_chunk,)
+                ).rowcount
+            deleted += count
+            if count < self.retention_chunk or not self.running:
+                return deleted
+            # Let the flushes and readers in between chunks
+            time.sleep(0.05)
+
+    def apply_retention(self):
+        """Delete samples, rollup buckets, sketches and group buckets older than their retention period"""
+        now = time.time()
+        deleted = 0
+        db = connect(self.path)
+        try:
+            if self.retention_days > 0:
+                count = self.delete_chunked(db, 'samples', 'ts < ?', (now - self.retention_days * 86400,))
+                if count:
+                    print(f"[HISTORY] Retention removed {count} samples older than {self.retention_days} days")
+                deleted += count
+
+            for resolution, days in rollups.RETENTION_DAYS.items():
+                if days > 0:
+                    for table in ('rollups', 'sketches', 'group_rollups'):
+                        deleted += self.delete_chunked(db, table, 'resolution = ? AND ts < ?',
+                                                       (resolution, now - days * 86400))
+        finally:
+            db.close()
+
+        if deleted:
+            with self.condition:
+                self.stats['rows_deleted'] += deleted
+        return deleted
+
+    def writer_loop(self):
+        """Writer thread body: flush every interval, run retention every RETENTION_INTERVAL"""
+        while self.running:
+            with self.condition:
+                self.condition.wait(timeout=self.interval)
+            try:
+                self.flush()
+                if time.time() - self.last_retention >= RETENTION_INTERVAL:
+                    self.last_retention = time.time()
+                    self.apply_retention()
+            except Exception as e:
+                print(f"[ERROR] History writer: {e}")
+
+    def start(self):
+        """Create the table and start the writer thread"""
+        init_history_db(self.path)
+        self.running = True
+        self.writer_thread = Thread(target=self.writer_loop, daemon=True)
+        self.writer_thread.start()
+        print(f"[HISTORY] History writer started ({self.path}, flushing every {self.interval}s, "
+              f"retention {self.retention_days or 'unlimited'} days)")
+
+    def stop(self):
+        """Stop the writer thread and write what is still queued"""
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.writer_thread is not None:
+            self.writer_thread.join(timeout=30)
+        self.flush()
+
+    def get_stats(self):
+        """Write counters and queue length"""
+        with self.condition:
+            return dict(self.stats, pending=len(self.pending), pending_rollups=len(self.pending_rollups),
+                        pending_sketches=len(self.pending_sketches),
+                        pending_group_rollups=len(self.pending_group_rollups),
+                        interval=self.interval, retention_days=self.retention_days,
+                        rollup_retention_days=rollups.RETENTION_DAYS)
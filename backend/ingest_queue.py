@@ -0,0 +1,187 @@
+"""
+Asynchronous ingest queue
+Metric POSTs enqueue validated samples and return immediately; a consumer thread
+drains the queue in batches into storage. When the queue is full, live samples are
+coalesced per host (the newest sample wins) so request latency stays flat under
+overload instead of growing with the backlog. Batches of backlogged samples are never
+coalesced: a batch that does not fit is refused whole, and the agent keeps its backlog
+and retries.
+"""
+import time
+from collections import OrderedDict
+from threading import Condition, Thread
+
+
+class IngestQueue:
+    """Bounded per-host FIFO of (sample, enqueued_at, live) with newest-wins coalescing of live samples"""
+
+    def __init__(self, store_batch, maxsize=10000, batch_size=500):
+        """
+        Args:
+            store_batch: Callable receiving a list of (hostname, sample) in arrival order per host
+            maxsize: Samples held before coalescing starts
+            batch_size: Maximum samples handed to store_batch at once
+        """
+        self.store_batch = store_batch
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.pending = OrderedDict()  # hostname -> list of (sample, enqueued_at, live), oldest host first
+        self.depth = 0
+        self.dropped_by_host = {}  # hostname -> samples discarded by coalescing
+        self.condition = Condition()
+        self.running = False
+        self.consumer_thread = None
+        self.stats = {
+            'enqueued': 0,
+            'stored': 0,
+            'dropped': 0,  # older live samples discarded by coalescing
+            'refused_batches': 0,  # batches that did not fit, the sender keeps and retries them
+            'refused_samples': 0,
+            'batches': 0,
+            'store_errors': 0,
+            'max_depth': 0,
+            'last_batch_size': 0,
+            'last_lag_seconds': 0.0  # enqueue -> stored delay of the oldest sample in the last batch
+        }
+
+    def put(self, hostname, sample):
+        """Enqueue one sample, never blocks"""
+        self.put_many([(hostname, sample)])
+
+    def put_many(self, items, live=True):
+        """Enqueue (hostname, sample) pairs under a single lock acquisition
+
+        Live samples (the newest of each host) make room by coalescing when the queue is full.
+        Otherwise (a backlog sent as a batch) the pairs are enqueued only if they all fit.
+        Returns False when they were refused, nothing is enqueued then.
+        """
+        now = time.time()
+
+        with self.condition:
+            # An empty queue takes any batch, or one larger than maxsize would never fit
+            if not live and self.depth and self.depth + len(items) > self.maxsize:
+                self.stats['refused_batches'] += 1
+                self.stats['refused_samples'] += len(items)
+                return False
+
+            for hostname, sample in items:
+                if live and self.depth >= self.maxsize:
+                    self._coalesce_locked(hostname)
+
+                queued = self.pending.get(hostname)
+                if queued is None:
+                    queued = self.pending[hostname] = []
+                queued.append((sample, now, live))
+                self.depth += 1
+
+            self.stats['enqueued'] += len(items)
+            self.stats['max_depth'] = max(self.stats['max_depth'], self.depth)
+            self.condition.notify()
+            return True
+
+    def _coalesce_locked(self, hostname):
+        """Make room by discarding older queued live samples of one host
+
+        The incoming host's own live samples are discarded first (its new sample supersedes
+        them), otherwise the host with the longest backlog keeps only its newest live sample.
+        Samples of accepted batches are never discarded, so the queue may go past maxsize.
+        """
+        queued = self.pending.get(hostname)
+        if queued and any(live for _, _, live in queued):
+            kept = [entry for entry in queued if not entry[2]]
+        else:
+            hostname = max(self.pending, key=lambda h: len(self.pending[h]), default=None)
+            if hostname is None:
+                return
+            queued = self.pending[hostname]
+            newest = max((index for index, entry in enumerate(queued) if entry[2]), default=None)
+            kept = [entry for index, entry in enumerate(queued) if not entry[2] or index == newest]
+
+        dropped = len(queued) - len(kept)
+        if not dropped:
+            return
+        if kept:
+            self.pending[hostname] = kept
+        else:
+            del self.pending[hostname]
+        self.depth -= dropped
+        self.stats['dropped'] += dropped
+        self.dropped_by_host[hostname] = self.dropped_by_host.get(hostname, 0) + dropped
+
+    def _take_batch_locked(self):
+        """Pop up to batch_size samples, whole hosts at a time in arrival order"""
+        batch = []
+        while self.pending and len(batch) < self.batch_size:
+            hostname, queued = self.pending.popitem(last=False)
+            batch.extend((hostname, sample, enqueued_at) for sample, enqueued_at, _ in queued)
+        self.depth -= len(batch)
+        return batch
+
+    def drain(self):
+        """Store everything currently queued (used by the consumer and at shutdown)"""
+        while True:
+            with self.condition:
+                batch = self._take_batch_locked()
+            if not batch:
+                return
+            self._store(batch)
+
+    def _store(self, batch):
+        """Hand a batch to storage and record lag"""
+        oldest = min(enqueued_at for _, _, enqueued_at in batch)
+
+        try:
+            self.store_batch([(hostname, sample) for hostname, sample, _ in batch])
+        except Exception as e:
+            print(f"[INGEST] Failed to store batch of {len(batch)} samples: {e}")
+            with self.condition:
+                self.stats['store_errors'] += 1
+            return
+
+        with self.condition:
+            self.stats['stored'] += len(batch)
+            self.stats['batches'] += 1
+            self.stats['last_batch_size'] = len(batch)
+            self.stats['last_lag_seconds'] = round(time.time() - oldest, 4)
+
+    def consume_loop(self):
+        """Consumer thread body: wait for samples and store them in batches"""
+        while self.running:
+            with self.condition:
+                while self.running and not self.depth:
+                    self.condition.wait(timeout=1.0)
+                batch = self._take_batch_locked()
+
+            if batch:
+                self._store(batch)
+
+    def start(self):
+        """Start the consumer thread"""
+        self.running = True
+        self.consumer_thread = Thread(target=self.consume_loop, daemon=True)
+        self.consumer_thread.start()
+        print(f"[INGEST] Ingest queue started (max {self.maxsize} samples, batches of {self.batch_size})")
+
+    def stop(self):
+        """Stop the consumer and store whatever is still queued"""
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.consumer_thread is not None:
+            self.consumer_thread.join(timeout=10)
+        self.drain()
+
+    def get_stats(self):
+        """Queue depth, drop counts (in total and for the 10 hosts that lost the most) and consumer lag"""
+        now = time.time()
+        with self.condition:
+            oldest = min((queued[0][1] for queued in self.pending.values()), default=None)
+            most_dropped = sorted(self.dropped_by_host.items(), key=lambda item: item[1], reverse=True)[:10]
+            return dict(
+                self.stats,
+                dropped_by_host=dict(most_dropped),
+                depth=self.depth,
+                hosts_queued=len(self.pending),
+                maxsize=self.maxsize,
+                lag_seconds=round(now - oldest, 4) if oldest is not None else 0.0
+            )
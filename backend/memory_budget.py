@@ -0,0 +1,146 @@
+"""
+Global memory budget for the metric store
+Every MEMORY_CHECK_INTERVAL seconds the store's approximate memory use is added up (mapped ring
+files, compressed series, streaming statistics, latest samples). When it exceeds MEMORY_BUDGET_MB, retention shrinks:
+first the oldest compressed chunks are evicted, starting with ordinary hosts, then busy hosts,
+then flagged hosts; if that is not enough the ring capacity (samples per host) is lowered,
+never below MIN_HISTORY_SIZE. With room to spare the ring capacity grows back to HISTORY_SIZE.
+Long-term data is not lost by this: rollups and segment files live on disk.
+
+A host is flagged when it raised an alert within the last hour, busy when its latest CPU usage
+is at least BUSY_CPU_PERCENT.
+"""
+import json
+import os
+from datetime import datetime, timedelta
+from threading import Event, Thread
+
+import alert_system
+
+MEMORY_BUDGET_MB = float(os.environ.get('MEMORY_BUDGET_MB', 0))  # 0: only measure
+MEMORY_CHECK_INTERVAL = float(os.environ.get('MEMORY_CHECK_INTERVAL', 30))  # seconds
+MIN_HISTORY_SIZE = int(os.environ.get('MIN_HISTORY_SIZE', 60))  # ring capacity floor
+
+BUSY_CPU_PERCENT = 80
+FLAG_WINDOW = timedelta(hours=1)
+
+# Python dicts of a parsed sample take about 5x its JSON size
+SAMPLE_OVERHEAD = 5
+
+# Capacity changes smaller than this are skipped: every change migrates each ring once
+CAPACITY_STEP = 0.2
+
+PRIORITY_NORMAL, PRIORITY_BUSY, PRIORITY_FLAGGED = 0, 1, 2
+
+
+def host_priorities(current_metrics):
+    """Eviction priority of every host with metrics (higher is kept longer)"""
+    since = datetime.utcnow() - FLAG_WINDOW
+    # Alert cooldown keys start with '<hostname>_'
+    recent = [key for key, when in list(alert_system.alert_states.items()) if when >= since]
+
+    priorities = {}
+    for hostname, metrics in current_metrics.items():
+        if any(key.startswith(hostname + '_') for key in recent):
+            priorities[hostname] = PRIORITY_FLAGGED
+        elif (metrics.get('cpu') or {}).get('cpu_percent_total', 0) >= BUSY_CPU_PERCENT:
+            priorities[hostname] = PRIORITY_BUSY
+        else:
+            priorities[hostname] = PRIORITY_NORMAL
+    return priorities
+
+
+class MemoryBudget:
+    """Keeps a MetricStore inside a memory budget by adapting retention"""
+
+    def __init__(self, store, budget_mb=MEMORY_BUDGET_MB, interval=MEMORY_CHECK_INTERVAL,
+                 max_history=None, min_history=MIN_HISTORY_SIZE):
+        self.store = store
+        self.budget = int(budget_mb * 1024 * 1024)
+        self.interval = interval
+        self.max_history = max_history or store.rings.capacity
+        self.min_history = min(min_history, self.max_history)
+        self.stop_event = Event()
+        self.thread = None
+        self.usage = {}
+        self.ring_bytes_per_sample = 0  # all rings together, see measure()
+        self.stats = {'checks': 0, 'evicted_chunks': 0, 'evicted_samples': 0, 'evicted_bytes': 0,
+                      'capacity_changes': 0}
+
+    def measure(self):
+        """Approximate bytes used per component"""
+        store = self.store
+        current = list(store.snapshot_current().values())
+        rings, slots = store.rings.nbytes()
+        ring_count = len(store.rings.rings)
+        compressed = store.compressed.nbytes() if store.compressed is not None else 0
+        # Stored samples are never modified, no lock needed
+        samples = sum(len(json.dumps(metrics, default=str)) for metrics in current) * SAMPLE_OVERHEAD
+        # Bytes the rings take per sample of capacity once all of them have the current capacity
+        self.ring_bytes_per_sample = rings / slots * ring_count if slots else 0
+        return {'rings': rings, 'compressed_history': compressed, 'current_metrics': samples,
+                'streaming_stats': store.stream_stats.nbytes() + store.fleet.nbytes() + store.top.nbytes()}
+
+    def check(self):
+        """Measure and, when over budget, shrink retention (grow it back when there is room)"""
+        store = self.store
+        self.usage = usage = self.measure()
+        self.stats['checks'] += 1
+        if self.budget <= 0:
+            return
+
+        # Rings still being migrated to a new capacity count at that capacity
+        capacity = store.rings.capacity
+        rings = self.ring_bytes_per_sample * capacity
+        fixed = usage['current_metrics'] + usage['streaming_stats']
+        excess = rings + usage['compressed_history'] + fixed - self.budget
+        if excess > 0 and store.compressed is not None:
+            priorities = host_priorities(store.snapshot_current())
+            chunks, samples, freed = store.compressed.evict(excess, priorities)
+            if chunks:
+                self.stats['evicted_chunks'] += chunks
+                self.stats['evicted_samples'] += samples
+                self.stats['evicted_bytes'] += freed
+                print(f"[STORE] Memory budget: evicted {chunks} compressed chunks ({samples} samples, {freed} bytes)")
+            usage['compressed_history'] -= freed
+            excess -= freed
+
+        # Ring capacity scales with the room left for the rings
+        if not rings:
+            return
+        room = self.budget - usage['compressed_history'] - fixed
+        if excess > 0:
+            target = max(room, 0) / self.ring_bytes_per_sample
+        elif excess < -self.budget * 0.2:
+            target = room * 0.9 / self.ring_bytes_per_sample
+        else:
+            return
+        target = int(min(max(target, self.min_history), self.max_history))
+        if target != capacity and (abs(target - capacity) >= capacity * CAPACITY_STEP
+                                   or target in (self.min_history, self.max_history)):
+            # Read by the writers on their next append
+            store.rings.capacity = target
+            self.stats['capacity_changes'] += 1
+            print(f"[STORE] Memory budget: history per host {capacity} -> {target} samples")
+
+    def run(self):
+        """Budget thread body"""
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                print(f"[ERROR] Memory budget check failed: {e}")
+
+    def start(self):
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+        budget = f"{self.budget // (1024 * 1024)} MB" if self.budget > 0 else 'unlimited'
+        print(f"[STORE] Memory budget {budget}, checked every {self.interval}s")
+
+    def stop(self):
+        self.stop_event.set()
+
+    def get_stats(self):
+        return dict(self.stats, budget_bytes=self.budget, used_bytes=sum(self.usage.values()),
+                    usage=self.usage, history_size=self.store.rings.capacity,
+                    history_size_range=[self.min_history, self.max_history])
@@ -0,0 +1,539 @@
+"""
+Metric store
+Holds the latest sample and recent history of every host. app.py uses a local instance in
+development; serve.py runs a single instance in a store process and hands the worker
+processes a proxy to it, so every worker sees every host. Methods return plain data so
+they work the same through a proxy.
+
+Writes are serialized per host by striped shard locks (SHARD_COUNT of them), so samples of
+different hosts are stored concurrently. Reads do not take them: stored samples are never
+modified, current_metrics is read through atomic dict copies, history comes from the rings
+(seqlock) and the compressed series (copy-on-write chunk lists). Every shard lock counts how
+often and how long writers waited for it (see get_stats).
+"""
+import base64
+import logging
+import os
+import time
+from contextlib import ExitStack
+from threading import Lock
+
+import history_db
+import memory_budget
+import quantile_sketch
+import segment_store
+import snapshot
+import wire_format
+from fleet_summary import FleetTable
+from gorilla import COMPRESSED_HISTORY_HOURS, CompressedHistory
+from group_metrics import GroupAggregator
+from ingest_queue import IngestQueue
+from ring_buffer import RingDirectory, format_timestamp, parse_timestamp
+from rollups import ROLLUP_METRICS, RollupEngine, decode_sketches
+from streaming_stats import STATS_METRICS, StreamingStats
+from top_hosts import TopHosts
+
+# Written through request_log's queue handler (see request_log.configure)
+logger = logging.getLogger('monitoring.store')
+
+# Samples kept per host
+HISTORY_SIZE = int(os.environ.get('HISTORY_SIZE', 1000))
+
+# Memory-mapped per-host ring buffers (see ring_buffer.py)
+RING_DIR = os.environ.get('RING_DIR', os.path.join('data', 'rings'))
+
+# Lock stripes for writers, hosts are spread over them by hash
+SHARD_COUNT = int(os.environ.get('STORE_SHARDS', 64))
+
+# Seconds an agent's clock may run ahead of the server's, later timestamps are replaced by the receive time
+MAX_CLOCK_SKEW = float(os.environ.get('MAX_CLOCK_SKEW', 300))
+
+
+class InstrumentedLock:
+    """Lock that counts acquisitions and the time spent waiting for it"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.acquisitions = 0
+        self.contended = 0  # acquisitions that had to wait
+        self.wait_seconds = 0.0
+        self.max_wait = 0.0
+        self.out_of_order = 0  # per-shard counter, updated under the lock
+        self.rejected = 0  # samples that failed to store, per shard, updated under the lock
+        self.future = 0  # samples timestamped past MAX_CLOCK_SKEW, per shard, updated under the lock
+
+    def __enter__(self):
+        if not self.lock.acquire(blocking=False):
+            started = time.perf_counter()
+            self.lock.acquire()
+            waited = time.perf_counter() - started
+            # Counters are only updated while holding the lock
+            self.contended += 1
+            self.wait_seconds += waited
+            self.max_wait = max(self.max_wait, waited)
+        self.acquisitions += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+class MetricStore:
+    """Latest samples and static-section caches in memory, history in per-host ring buffers"""
+
+    def __init__(self, history_size=HISTORY_SIZE, ring_dir=RING_DIR):
+        self.rings = RingDirectory(ring_dir, capacity=history_size, writable=True)  # Numeric history per server
+        self.current_metrics = {}  # Latest metrics per server
+        self.system_info_cache = {}  # Cache system info (OS, kernel, etc) - updated every 5 minutes
+        self.partition_layout_cache = {}  # Static part of each partition (device, mountpoint, fstype, total) per server
+        self.static_section_hashes = {}  # hostname -> {'system': hash, 'disk': hash} of the cached static sections
+        self.shards = [InstrumentedLock() for _ in range(max(SHARD_COUNT, 1))]
+        self.restored_out_of_order = 0  # out-of-order count of the snapshot loaded at startup
+        self.rollups = RollupEngine()  # 1m/5m/1h buckets, closed ones go to the history writer
+        # Days of the rolled-up series at full resolution, Gorilla-compressed (None when disabled)
+        self.compressed = CompressedHistory() if COMPRESSED_HISTORY_HOURS > 0 else None
+        self.stream_stats = StreamingStats(history_size)  # running mean/variance/min/max per host
+        self.fleet = FleetTable()  # latest values of every host in columns, for the fleet summary
+        self.top = TopHosts(STATS_METRICS)  # hosts ranked by metric, current and windowed
+        self.groups = GroupAggregator()  # per-minute series of every host group
+
+        self.ingest_queue = None  # IngestQueue, created by start_ingest_queue()
+        self.history_writer = None  # history_db.HistoryWriter, created by start_history_writer()
+        self.segment_writer = None  # segment_store.SegmentWriter, created by start_segment_writer()
+        self.snapshotter = None  # snapshot.Snapshotter, created by start_snapshotter()
+        self.memory_budget = None  # memory_budget.MemoryBudget, created by start_memory_budget()
+
+        # Static sections found missing by the consumer, reported on the host's next POST
+        self.pending_resync = {}
+        self.pending_resync_lock = Lock()
+
+    # ==================== INGEST ====================
+
+    def start_ingest_queue(self, maxsize, batch_size):
+        """Create the ingest queue and start its consumer thread (maxsize <= 0 keeps ingest synchronous)"""
+        if maxsize <= 0:
+            print("[INGEST] Ingest queue disabled, storing samples synchronously")
+            return
+
+        self.ingest_queue = IngestQueue(self.store_batch, maxsize=maxsize, batch_size=batch_size)
+        self.ingest_queue.start()
+
+    def start_history_writer(self, path=history_db.HISTORY_DB):
+        """Persist every stored sample to SQLite in the background (empty path disables it)"""
+        if not path:
+            print("[HISTORY] History persistence disabled")
+            return
+
+        self.history_writer = history_db.HistoryWriter(path)
+        self.history_writer.start()
+        self.rollups.sink = self.history_writer.add_rollups
+        self.rollups.sketch_sink = self.history_writer.add_sketches
+        self.groups.sink = self.history_writer.add_group_rollups
+
+    def start_segment_writer(self, directory=segment_store.SEGMENT_DIR):
+        """Keep raw samples in per-host day segment files (empty directory disables it)"""
+        if not directory:
+            print("[HISTORY] Segment storage disabled")
+            return
+
+        self.segment_writer = segment_store.SegmentWriter(directory)
+        self.segment_writer.start()
+        print(f"[HISTORY] Segment storage in {directory} "
+              f"(retention {self.segment_writer.retention_days or 'unlimited'} days)")
+
+    def start_snapshotter(self, path=snapshot.SNAPSHOT_PATH, interval=snapshot.SNAPSHOT_INTERVAL):
+        """Reload the last snapshot, then snapshot the in-memory state periodically (empty path disables it)
+
+        Call before the ingest queue and the alert monitor start.
+        """
+        if not path:
+            print("[STORE] Snapshots disabled")
+            return
+
+        self.snapshotter = snapshot.Snapshotter(self, path, interval)
+        self.snapshotter.load()
+        self.snapshotter.start()
+
+    def start_memory_budget(self, budget_mb=memory_budget.MEMORY_BUDGET_MB):
+        """Measure memory use periodically and adapt retention to stay within budget_mb (0: measure only)"""
+        self.memory_budget = memory_budget.MemoryBudget(self, budget_mb)
+        self.memory_budget.start()
+
+    def shard(self, hostname):
+        """Lock serializing the writes of a host"""
+        return self.shards[hash(hostname) % len(self.shards)]
+
+    def all_shards(self):
+        """Context manager holding every shard lock (shutdown and snapshot restore only)"""
+        stack = ExitStack()
+        for shard in self.shards:
+            stack.enter_context(shard)
+        return stack
+
+    def export_state(self):
+        """Copy of the in-memory state for a snapshot
+
+        Stored samples are never modified and open rollup buckets are copy-on-write, so atomic
+        shallow copies are enough and no lock is taken.
+        """
+        rollups = {}
+        for hostname, buckets in list(self.rollups.open.items()):
+            # A bucket is replaced, never emptied, so (start, aggregates) always match
+            rollups[hostname] = {name: [start, list(aggregates)]
+                                 for name, (start, aggregates) in list(buckets.items())}
+        sketches = {hostname: [start, base64.b64encode(quantile_sketch.encode_sketches(open_sketches)).decode('ascii')]
+                    for hostname, (start, open_sketches) in list(self.rollups.sketches.items())}
+
+        return {
+            'current_metrics': dict(self.current_metrics),
+            'system_info_cache': dict(self.system_info_cache),
+            'partition_layout_cache': dict(self.partition_layout_cache),
+            'static_section_hashes': {hostname: dict(hashes)
+                                      for hostname, hashes in list(self.static_section_hashes.items())},
+            'rollups': rollups,
+            'sketches': sketches,
+            'groups': self.groups.export(),
+            'out_of_order': self.count_out_of_order()
+        }
+
+    def restore_state(self, state):
+        """Load a snapshot's state (updates the dicts in place, others may hold references)"""
+        with self.all_shards():
+            self.current_metrics.update(state.get('current_metrics', {}))
+            self.system_info_cache.update(state.get('system_info_cache', {}))
+            self.partition_layout_cache.update(state.get('partition_layout_cache', {}))
+            self.static_section_hashes.update(state.get('static_section_hashes', {}))
+            self.rollups.open.update(state.get('rollups', {}))
+            for hostname, metrics in state.get('current_metrics', {}).items():
+                epoch = parse_timestamp(metrics.get('timestamp'))
+                if epoch is not None:
+                    self.fleet.update(hostname, epoch, metrics)
+            for hostname, (start, data) in state.get('sketches', {}).items():
+                self.rollups.sketches.setdefault(hostname, (start, decode_sketches(base64.b64decode(data))))
+            self.groups.restore(state.get('groups', {}))
+            self.restored_out_of_order += state.get('out_of_order', 0)
+
+    def save_to_file(self, hostname, metrics, epoch):
+        """Append a sample to its host's segment of the day (raw long-term storage)"""
+        if self.segment_writer is not None:
+            self.segment_writer.append(hostname, metrics, epoch)
+
+    def stop(self):
+        """Store whatever is still queued, write it to disk and flush the rings"""
+        if self.ingest_queue is not None:
+            self.ingest_queue.stop()
+        if self.memory_budget is not None:
+            self.memory_budget.stop()
+        # Open buckets go to disk before the final snapshot, which must not hold them as well
+        with self.all_shards():
+            self.rollups.close_all()
+        if self.snapshotter is not None:
+            self.snapshotter.stop()
+        if self.history_writer is not None:
+            self.history_writer.stop()
+        if self.segment_writer is not None:
+            self.segment_writer.stop()
+        with self.all_shards():
+            self.rings.close()
+
+    def submit(self, items, live=True):
+        """Store (hostname, sample) pairs, through the ingest queue when it is running
+
+        Returns (status_code, resync): 202 when the samples were queued, 200 when they were stored
+        synchronously, 503 when a batch (live=False, see IngestQueue.put_many) did not fit in the
+        queue and nothing was stored. Queued samples are checked by the consumer, so resync
+        requests for static sections reach the agent with the response to its next POST.
+        """
+        hostnames = set(hostname for hostname, _ in items)
+
+        if self.ingest_queue is not None:
+            if not self.ingest_queue.put_many(items, live):
+                return 503, []
+            with self.pending_resync_lock:
+                resync = set()
+                for hostname in hostnames:
+                    resync.update(self.pending_resync.pop(hostname, ()))
+            return 202, sorted(resync)
+
+        resync = set()
+        for hostname, metrics in items:
+            with self.shard(hostname):
+                resync.update(self._store_checked(hostname, metrics))
+        return 200, sorted(resync)
+
+    def store_batch(self, items):
+        """Ingest queue consumer: store a batch, one lock acquisition per shard it touches"""
+        by_shard = {}
+        for hostname, metrics in items:
+            by_shard.setdefault(self.shard(hostname), []).append((hostname, metrics))
+
+        resync = {}
+        for shard, group in by_shard.items():
+            with shard:
+                for hostname, metrics in group:
+                    missing = self._store_checked(hostname, metrics)
+                    if missing:
+                        resync.setdefault(hostname, set()).update(missing)
+
+        if resync:
+            with self.pending_resync_lock:
+                for hostname, missing in resync.items():
+                    self.pending_resync.setdefault(hostname, set()).update(missing)
+
+    def _store_checked(self, hostname, metrics):
+        """_store_locked for one sample of a batch: a sample that fails is counted and skipped"""
+        try:
+            return self._store_locked(hostname, metrics)
+        except Exception as e:
+            self.shard(hostname).rejected += 1
+            print(f"[INGEST] Rejected sample from {hostname}: {e}")
+            return []
+
+    def _expand_static_sections(self, hostname, metrics):
+        """Fill in static sections the agent left out because they did not change
+
+        Agents using the delta protocol send `static` with a content hash per static section
+        ({'system': ..., 'disk': ...}). A section is sent in full when it changed (or every few
+        cycles); otherwise `system` is replaced by its `uptime` and `disk` by `usage`, a list of
+        [used, free, percent] in partition order. Returns the sections that could not be filled
+        from the caches, which the agent must resend in full. Caller must hold the host's shard lock.
+        """
+        hashes = metrics.pop('static', None)
+        if not isinstance(hashes, dict):
+            return []
+
+        known = self.static_section_hashes.setdefault(hostname, {})
+        resync = []
+
+        uptime = metrics.pop('uptime', None)
+        if 'system' in metrics:
+            known['system'] = hashes.get('system')
+        elif hashes.get('system') is not None and known.get('system') == hashes.get('system') \
+                and hostname in self.system_info_cache:
+            metrics['system'] = dict(self.system_info_cache[hostname], uptime=uptime)
+        else:
+            resync.append('system')
+
+        disk = metrics.get('disk') or {}
+        if 'partitions' in disk:
+            self.partition_layout_cache[hostname] = [
+                {key: partition.get(key) for key in ('device', 'mountpoint', 'fstype', 'total')}
+                for partition in disk['partitions']
+            ]
+            known['disk'] = hashes.get('disk')
+        elif hashes.get('disk') is not None and known.get('disk') == hashes.get('disk') \
+                and len(disk.get('usage') or []) == len(self.partition_layout_cache.get(hostname, [])):
+            metrics['disk'] = {'partitions': [
+                dict(layout, used=used, free=free, percent=percent)
+                for layout, (used, free, percent) in zip(self.partition_layout_cache[hostname], disk['usage'])
+            ]}
+        else:
+            metrics.pop('disk', None)
+            resync.append('disk')
+
+        return resync
+
+    def _store_locked(self, hostname, metrics):
+        """Store one sample in memory (caller must hold the host's shard lock)
+
+        The sample is validated and its timestamp parsed before anything is changed, so a sample
+        that raises (wire_format.InvalidSample) leaves every structure as it was. Timestamps more
+        than MAX_CLOCK_SKEW ahead of the server's clock are replaced by the receive time. Returns the
+        static sections the agent must resend in full (see _expand_static_sections).
+        """
+        wire_format.validate_sample(metrics)
+        epoch = parse_timestamp(metrics.get('timestamp'))
+        now = time.time()
+        if epoch is None:
+            epoch = now
+        elif epoch > now + MAX_CLOCK_SKEW:
+            # Rings keep a host's timestamps non-decreasing: one sample from the future would
+            # pin every later one to its timestamp until the ring wraps
+            epoch = now
+            metrics['timestamp'] = format_timestamp(epoch)
+            self.shard(hostname).future += 1
+
+        resync = self._expand_static_sections(hostname, metrics)
+
+        # Cache system info if present
+        if 'system' in metrics:
+            self.system_info_cache[hostname] = metrics['system']
+            # Every sample carries it (delta samples get it expanded from this cache)
+            logger.debug('System info cached for %s', hostname)
+
+        # Always include cached system info in current metrics
+        if hostname in self.system_info_cache:
+            metrics['system'] = self.system_info_cache[hostname]
+
+        # Numeric series go to the host's ring, the full sample is kept as the current one
+        if hostname not in self.stream_stats.hosts:
+            # First sample since startup: pick up the statistics of the history kept in the ring
+            self.stream_stats.seed(hostname, [(parse_timestamp(entry['timestamp']), entry)
+                                              for entry in self.rings.read(hostname)])
+        self.stream_stats.add(hostname, epoch, metrics)
+        self.top.update(hostname, epoch, self.stream_stats.hosts[hostname])
+        if self.rings.append(hostname, metrics, epoch):
+            self.shard(hostname).out_of_order += 1
+        self.current_metrics[hostname] = metrics
+        self.fleet.update(hostname, epoch, metrics)
+        self.groups.update(hostname, epoch, metrics)
+
+        self.rollups.add(hostname, epoch, metrics)
+        if self.compressed is not None:
+            self.compressed.append(hostname, epoch, metrics)
+        if self.history_writer is not None:
+            self.history_writer.add(hostname, epoch, metrics)
+        self.save_to_file(hostname, metrics, epoch)
+
+        return resync
+
+    # ==================== GROUPS ====================
+
+    def set_host_groups(self, mapping):
+        """Replace the group membership of every host ({hostname: group id or None})"""
+        self.groups.set_host_groups(mapping)
+
+    def set_host_group(self, hostname, group_id):
+        """Move a host to a group (None: no group)"""
+        self.groups.set_host_group(hostname, group_id)
+
+    # ==================== READS ====================
+
+    def get_current(self, hostname):
+        """Latest sample of a host, or None"""
+        return self.current_metrics.get(hostname)
+
+    def get_history(self, hostname, since=None, limit=None):
+        """History entries held in the host's ring, oldest first (see RingBuffer.read)"""
+        return self.rings.read(hostname, since, limit)
+
+    def get_compressed_history(self, hostname, since, before, limit):
+        """Entries of the compressed series with since <= timestamp < before, oldest first"""
+        if self.compressed is None:
+            return []
+        return self.compressed.read(hostname, since, before, limit)
+
+    def get_compressed_series(self, hostname, name, since, before):
+        """(timestamps, values) of one series of the compressed history, ([], []) if it is not kept"""
+        if self.compressed is None or name not in ROLLUP_METRICS:
+            return [], []
+        return self.compressed.read_series(hostname, name, since, before)
+
+    def get_open_rollup(self, hostname, resolution):
+        """(start, aggregates) of the bucket a host is still filling at a resolution, or None"""
+        return self.rollups.get_open(hostname, resolution)
+
+    def get_stream_stats(self, hostname, window):
+        """Running statistics of a host over a streaming_stats window, None if it has no samples"""
+        return self.stream_stats.get(hostname, window)
+
+    def get_open_sketches(self, hostnames=None):
+        """{hostname: (start, encoded sketches)} of the minute each host is still filling
+
+        For the given hosts or every host; encoded so they pass through a proxy
+        (see rollups.decode_sketches).
+        """
+        sketches = self.rollups.sketches
+        if hostnames is None:
+            hostnames = list(sketches)
+        result = {}
+        for hostname in hostnames:
+            current = sketches.get(hostname)
+            if current is not None:
+                result[hostname] = (current[0], quantile_sketch.encode_sketches(current[1]))
+        return result
+
+    def get_history_generation(self):
+        """Flushes the history writer finished (see history_db.HistoryWriter.unwritten)"""
+        return self.history_writer.generation if self.history_writer is not None else 0
+
+    def get_unwritten(self, kind, resolution, since, owners=None):
+        """(generation, [(owner, start, value)]) of the closed buckets not in the history database yet
+
+        kind: 'rollups', 'sketches' (encoded, see rollups.decode_sketches) or 'group_rollups'.
+        """
+        if self.history_writer is None:
+            return 0, []
+        generation, entries = self.history_writer.unwritten(kind, resolution, since, owners)
+        if kind == 'sketches':
+            entries = [(owner, start, quantile_sketch.encode_sketches(sketches)) for owner, start, sketches in entries]
+        return generation, entries
+
+    def get_fleet_summary(self, thresholds, down_timeout):
+        """Aggregates of the latest samples of the online hosts (see fleet_summary.FleetTable.summary)"""
+        return self.fleet.summary(thresholds, down_timeout)
+
+    def get_group_points(self, group_id, since):
+        """(start, group_metrics.GROUP_FIELDS values) of a group's points held in memory, oldest first"""
+        return self.groups.read(group_id, since)
+
+    def get_group_oldest(self, group_id):
+        """Start of the oldest point of a group held in memory, None if there is none"""
+        return self.groups.oldest(group_id)
+
+    def get_top(self, metric, window, k, since):
+        """[(hostname, value, epoch)] of the k highest hosts of a top_hosts ranking that reported since `since`"""
+        return self.top.top(metric, window, k, since)
+
+    def snapshot_current(self):
+        """Copy of current_metrics (one atomic dict copy, safe while writers store)"""
+        return dict(self.current_metrics)
+
+    def list_servers(self):
+        """Summary of the latest sample of every host"""
+        return [{
+            'hostname': hostname,
+            'last_update': metrics.get('timestamp'),
+            'cpu_percent': metrics.get('cpu', {}).get('cpu_percent_total', 0),
+            'memory_percent': metrics.get('memory', {}).get('memory_percent', 0)
+        } for hostname, metrics in self.snapshot_current().items()]
+
+    def count(self):
+        """Number of hosts with metrics"""
+        return len(self.current_metrics)
+
+    def count_out_of_order(self):
+        """Samples older than their host's newest one, stored with its timestamp"""
+        return self.restored_out_of_order + sum(shard.out_of_order for shard in self.shards)
+
+    def get_lock_stats(self):
+        """Acquisitions of the shard locks and the time writers waited for them"""
+        acquisitions = sum(shard.acquisitions for shard in self.shards)
+        return {
+            'shards': len(self.shards),
+            'acquisitions': acquisitions,
+            'contended': sum(shard.contended for shard in self.shards),
+            'wait_seconds': round(sum(shard.wait_seconds for shard in self.shards), 6),
+            'max_wait_ms': round(max(shard.max_wait for shard in self.shards) * 1000, 3),
+            'busiest_shard_acquisitions': max(shard.acquisitions for shard in self.shards)
+        }
+
+    def get_stats(self):
+        """Store size, lock contention and ingest queue statistics"""
+        stats = {
+            'hosts': len(self.current_metrics),
+            'samples': self.rings.sample_count(),
+            'out_of_order': self.count_out_of_order(),
+            'rejected_samples': sum(shard.rejected for shard in self.shards),
+            'future_timestamps': sum(shard.future for shard in self.shards),
+            'late_rollup_samples': self.rollups.late,
+            'locks': self.get_lock_stats()
+        }
+
+        if self.history_writer is not None:
+            stats['history_writer'] = self.history_writer.get_stats()
+        if self.segment_writer is not None:
+            stats['segments'] = self.segment_writer.get_stats()
+        if self.snapshotter is not None:
+            stats['snapshot'] = self.snapshotter.get_stats()
+        if self.compressed is not None:
+            stats['compressed_history'] = self.compressed.get_stats()
+        if self.memory_budget is not None:
+            stats['memory'] = self.memory_budget.get_stats()
+
+        if self.ingest_queue is not None:
+            stats['ingest_queue'] = dict(self.ingest_queue.get_stats(), enabled=True)
+        else:
+            stats['ingest_queue'] = {'enabled': False}
+
+        return stats
@@ -0,0 +1,174 @@
+"""
+Mergeable quantile sketches
+A DDSketch per rolled-up series (see rollups.py) answers p50/p95/p99 with a relative
+error of at most SKETCH_ACCURACY. A value v > 0 is counted in bin ceil(log_gamma(v)) with
+gamma = (1 + accuracy) / (1 - accuracy), negative values in a mirrored set of bins and values
+near zero in a zero bin. Merging two sketches adds their bins, so the sketch of an hour is the
+merge of its minutes and the sketch of a group the merge of its hosts, with the same accuracy.
+
+Encoded sketch (little-endian): Q zero count, d min, d max, I positive bins, I negative bins,
+then (i key, I count) per bin. A list of sketches is encoded as I length + encoded sketch each.
+"""
+import math
+import os
+import struct
+
+SKETCH_ACCURACY = float(os.environ.get('SKETCH_ACCURACY', 0.01))
+MAX_BINS = 2048  # per sign, the lowest bins are collapsed beyond it
+
+GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+MIN_VALUE = 1e-9  # smaller magnitudes count as zero
+
+PERCENTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+
+HEADER = struct.Struct('<QddII')
+BIN = struct.Struct('<iI')
+LENGTH = struct.Struct('<I')
+
+
+def bin_key(value):
+    return math.ceil(math.log(value) / LOG_GAMMA)
+
+
+def bin_value(key):
+    """Representative value of a bin (relative error at most SKETCH_ACCURACY over the bin)"""
+    return 2 * GAMMA ** key / (GAMMA + 1)
+
+
+def collapse(bins):
+    """Fold the lowest bins into one until at most MAX_BINS are left"""
+    keys = sorted(bins)
+    excess = keys[:len(keys) - MAX_BINS + 1]
+    bins[excess[-1]] = sum(bins.pop(key) for key in excess)
+
+
+class DDSketch:
+    """Quantile sketch with relative accuracy, see the module docstring"""
+
+    __slots__ = ('positive', 'negative', 'zeros', 'count', 'min', 'max')
+
+    def __init__(self):
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        """Count a value, non-finite ones are ignored (they have no bin)"""
+        if not math.isfinite(value):
+            return
+        if value > MIN_VALUE:
+            bins = self.positive
+            key = bin_key(value)
+            bins[key] = bins.get(key, 0) + 1
+            if len(bins) > MAX_BINS:
+                collapse(bins)
+        elif value < -MIN_VALUE:
+            bins = self.negative
+            key = bin_key(-value)
+            bins[key] = bins.get(key, 0) + 1
+            if len(bins) > MAX_BINS:
+                collapse(bins)
+        else:
+            self.zeros += 1
+        self.count += 1
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """Add other's counts to this sketch, returns self"""
+        for bins, other_bins in ((self.positive, other.positive), (self.negative, other.negative)):
+            for key, count in other_bins.items():
+                bins[key] = bins.get(key, 0) + count
+            if len(bins) > MAX_BINS:
+                collapse(bins)
+        self.zeros += other.zeros
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def copy(self):
+        sketch = DDSketch()
+        sketch.positive = dict(self.positive)
+        sketch.negative = dict(self.negative)
+        sketch.zeros, sketch.count, sketch.min, sketch.max = self.zeros, self.count, self.min, self.max
+        return sketch
+
+    def quantile(self, q):
+        """Value at quantile q (0..1), None when empty"""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        # Most negative first: largest keys of the negative bins
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return max(-bin_value(key), self.min)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return min(bin_value(key), self.max)
+        return self.max
+
+    def encode(self):
+        parts = [HEADER.pack(self.zeros, self.min, self.max, len(self.positive), len(self.negative))]
+        parts.extend(BIN.pack(key, count) for key, count in self.positive.items())
+        parts.extend(BIN.pack(key, count) for key, count in self.negative.items())
+        return b''.join(parts)
+
+    @staticmethod
+    def decode(data, offset=0):
+        """(sketch, offset past it) from encode()'s bytes"""
+        sketch = DDSketch()
+        sketch.zeros, sketch.min, sketch.max, positive, negative = HEADER.unpack_from(data, offset)
+        offset += HEADER.size
+        for bins, length in ((sketch.positive, positive), (sketch.negative, negative)):
+            for key, count in BIN.iter_unpack(data[offset:offset + length * BIN.size]):
+                bins[key] = count
+            offset += length * BIN.size
+        sketch.count = sketch.zeros + sum(sketch.positive.values()) + sum(sketch.negative.values())
+        return sketch, offset
+
+
+def new_sketches(count):
+    return [DDSketch() for _ in range(count)]
+
+
+def merge_sketches(sketches, other):
+    """Merge a list of sketches into another, position by position, returns sketches"""
+    for sketch, other_sketch in zip(sketches, other):
+        sketch.merge(other_sketch)
+    return sketches
+
+
+def encode_sketches(sketches):
+    return b''.join(LENGTH.pack(len(encoded)) + encoded for encoded in (sketch.encode() for sketch in sketches))
+
+
+def decode_sketches(data, count):
+    """`count` sketches from encode_sketches, metrics added since they were written are empty"""
+    sketches = []
+    offset = 0
+    while offset < len(data):
+        length, = LENGTH.unpack_from(data, offset)
+        sketch, _ = DDSketch.decode(data, offset + LENGTH.size)
+        sketches.append(sketch)
+        offset += LENGTH.size + length
+    return sketches + new_sketches(count - len(sketches))
+
+
+def percentiles(names, sketches):
+    """{name: {p50, p95, p99, count}} of the sketches with at least one value"""
+    result = {}
+    for name, sketch in zip(names, sketches):
+        if sketch.count:
+            result[name] = dict({label: sketch.quantile(q) for label, q in PERCENTILES}, count=sketch.count)
+    return result
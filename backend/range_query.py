@@ -0,0 +1,108 @@
+"""
+Range queries
+Step-bucketed series of one metric for many hosts, for /api/query. Buckets start at multiples
+of the step (epoch-aligned), so the series of every host share the same timestamps.
+
+Each host's series is filled from sources that never overlap, newest first:
+
+    ring samples        the columns of the host's ring
+    compressed samples  the older samples still in the Gorilla-compressed series (metrics in
+                        ROLLUP_METRICS, see gorilla.py)
+    rollup buckets      history_db rollups for the part older than both (metrics in
+                        ROLLUP_METRICS), see rollup_resolution
+
+Steps with no data in any source are empty (None); the first step holding data is reported so
+callers can tell a range reaching past the data available from a series that is only sparse.
+
+Ring timestamps are non-decreasing, so a bucket's samples are one slice found by binary search
+and reduced with builtins (sum/min/max over the slice) instead of a Python step per sample.
+"""
+import math
+from array import array
+from bisect import bisect_left
+
+import rollups
+from wire_format import SAMPLE_FIELDS
+
+# Single-width ring columns (see ring_buffer.column_specs)
+QUERY_METRICS = tuple(f'{section}.{key}' for section, key, _ in SAMPLE_FIELDS)
+
+AGGREGATIONS = ('avg', 'min', 'max', 'sum', 'count')
+
+INF = float('inf')
+
+
+def rollup_resolution(metric, step):
+    """Rollup resolution read for a step, None if there is none
+
+    The coarsest resolution whose buckets fit whole in a step, else the finest one not longer
+    than the step: its buckets are rebucketed into the step they start in (a bucket straddling
+    a step boundary counts whole in the earlier step).
+    """
+    if metric not in rollups.ROLLUP_METRICS:
+        return None
+    for name, seconds in reversed(rollups.RESOLUTIONS):
+        if step % seconds == 0:
+            return name
+    name, seconds = rollups.RESOLUTIONS[0]
+    return name if seconds <= step else None
+
+
+class StepBuckets:
+    """count/sum/min/max of one series per step bucket from `start` (aligned) to `end`"""
+
+    __slots__ = ('start', 'step', 'size', 'counts', 'totals', 'lows', 'highs')
+
+    def __init__(self, start, end, step):
+        self.start = start
+        self.step = step
+        self.size = max(math.ceil((end - start) / step), 0)
+        self.counts = array('d', bytes(8 * self.size))
+        self.totals = array('d', bytes(8 * self.size))
+        self.lows = array('d', [INF]) * self.size
+        self.highs = array('d', [-INF]) * self.size
+
+    def add(self, index, count, total, low, high):
+        self.counts[index] += count
+        self.totals[index] += total
+        self.lows[index] = min(self.lows[index], low)
+        self.highs[index] = max(self.highs[index], high)
+
+    def add_samples(self, timestamps, values):
+        """Samples (timestamps non-decreasing) inside the range; NaN values are skipped"""
+        end = self.start + self.size * self.step
+        first = bisect_left(timestamps, self.start)
+        stop = bisect_left(timestamps, end, first)
+        while first < stop:
+            index = int((timestamps[first] - self.start) // self.step)
+            following = bisect_left(timestamps, self.start + (index + 1) * self.step, first, stop)
+            chunk = [value for value in values[first:following] if value == value]
+            if chunk:
+                self.add(index, len(chunk), sum(chunk), min(chunk), max(chunk))
+            first = following
+
+    def add_rollups(self, metric, buckets):
+        """Rollup buckets (start, aggregates), each counted in the step it starts in"""
+        offset = 4 * rollups.ROLLUP_METRICS.index(metric)
+        for start, aggregates in buckets:
+            index = int((start - self.start) // self.step)
+            count, total, low, high = aggregates[offset:offset + 4]
+            if count and 0 <= index < self.size:
+                self.add(index, count, total, low, high)
+
+    def values(self, agg):
+        """Value of every bucket for an aggregation, None for empty buckets"""
+        counts = self.counts
+        if agg == 'count':
+            return [int(count) for count in counts]
+        if agg == 'avg':
+            return [total / count if count else None for count, total in zip(counts, self.totals)]
+        column = {'sum': self.totals, 'min': self.lows, 'max': self.highs}[agg]
+        return [value if count else None for count, value in zip(counts, column)]
+
+    def first_filled(self):
+        """Index of the first bucket holding data, None if every bucket is empty"""
+        return next((index for index, count in enumerate(self.counts) if count), None)
+
+    def timestamps(self):
+        return [self.start + index * self.step for index in range(self.size)]
@@ -0,0 +1,220 @@
+"""
+Structured request logging
+One JSON line per request (level, route, status, latency) written through a bounded
+queue, so request threads never block on stdout. High-volume routes are sampled,
+errors are always logged, headers and bodies only at DEBUG with secrets masked.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+from threading import Lock
+
+# LOG_LEVEL=DEBUG adds (masked) headers and a body preview to sampled requests
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+# Records held for the writer thread; further records are dropped rather than blocking a request
+REQUEST_LOG_BUFFER = int(os.environ.get('REQUEST_LOG_BUFFER', 10000))
+
+# Fraction of successful requests logged per route (longest prefix wins, unlisted routes: 1.0).
+# Override with REQUEST_LOG_SAMPLE_RATES="/api/metrics=0.01,/api/hosts=1"
+DEFAULT_SAMPLE_RATES = {
+    '/api/metrics': 0.001,
+    '/api/metrics/batch': 0.01,
+    '/api/health': 0.01,
+    '/static': 0.01,
+}
+
+# Header values and JSON body fields (at any depth) never written to the log; alert channel
+# credentials come with the notification config endpoints
+MASKED_HEADERS = ('x-api-key', 'authorization', 'cookie', 'set-cookie')
+MASKED_FIELDS = ('password', 'current_password', 'new_password', 'api_key', 'auth_token', 'bot_token')
+
+BODY_PREVIEW_SIZE = 500
+
+# Records of every 'monitoring.*' logger (request records here, store events in metric_store)
+# go through the parent's queue handler
+parent_logger = logging.getLogger('monitoring')
+logger = logging.getLogger('monitoring.request')
+
+stats = {'logged': 0, 'sampled_out': 0, 'dropped': 0}
+stats_lock = Lock()
+
+listener = None
+
+
+def parse_sample_rates(value):
+    """Parse 'route=rate,route=rate' into a dict, ignoring malformed entries"""
+    rates = {}
+    for entry in (value or '').split(','):
+        route, _, rate = entry.strip().partition('=')
+        try:
+            rates[route.strip()] = min(max(float(rate), 0.0), 1.0)
+        except ValueError:
+            continue
+    return rates
+
+
+SAMPLE_RATES = dict(DEFAULT_SAMPLE_RATES, **parse_sample_rates(os.environ.get('REQUEST_LOG_SAMPLE_RATES')))
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as a single JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the queue is full instead of blocking"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with stats_lock:
+                stats['dropped'] += 1
+
+
+def configure(level=LOG_LEVEL, stream=None):
+    """Attach the queue handler and start the writer thread (idempotent)"""
+    global listener
+
+    if listener is not None:
+        return
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter())
+
+    records = queue.Queue(maxsize=REQUEST_LOG_BUFFER)
+    parent_logger.addHandler(DroppingQueueHandler(records))
+    parent_logger.setLevel(getattr(logging, level, logging.INFO))
+    parent_logger.propagate = False
+
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+
+    # Write out whatever is still buffered on shutdown
+    atexit.register(stop)
+
+
+def stop():
+    """Flush buffered records and stop the writer thread"""
+    global listener
+
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+def restart_after_fork():
+    """Threads do not survive fork: give a forked worker its own queue and writer thread"""
+    global listener
+
+    if listener is None:
+        return
+
+    records = queue.Queue(maxsize=REQUEST_LOG_BUFFER)
+    for handler in parent_logger.handlers:
+        if isinstance(handler, DroppingQueueHandler):
+            handler.queue = records
+
+    listener = logging.handlers.QueueListener(records, *listener.handlers)
+    listener.start()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=restart_after_fork)
+
+
+def sample_rate(path):
+    """Sampling rate of the longest configured route prefix matching path"""
+    best, rate = -1, 1.0
+    for route, route_rate in SAMPLE_RATES.items():
+        if len(route) > best and (path == route or path.startswith(route.rstrip('/') + '/')):
+            best, rate = len(route), route_rate
+    return rate
+
+
+def mask_headers(headers):
+    """Copy of headers with secret values replaced by '***'"""
+    return {name: '***' if name.lower() in MASKED_HEADERS else value for name, value in headers.items()}
+
+
+def mask_secrets(value):
+    """Copy of a JSON value with MASKED_FIELDS masked at any depth (batch bodies are arrays of samples)"""
+    if isinstance(value, dict):
+        return {key: '***' if key in MASKED_FIELDS else mask_secrets(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [mask_secrets(item) for item in value]
+    return value
+
+
+def body_preview(request):
+    """First BODY_PREVIEW_SIZE characters of a JSON body with secret fields masked"""
+    try:
+        body = json.loads(request.get_data())
+    except ValueError:
+        return None
+    return json.dumps(mask_secrets(body))[:BODY_PREVIEW_SIZE]
+
+
+def log_request(request, response, started):
+    """Log one finished request, subject to level and per-route sampling
+
+    Client and server errors are always logged; successful requests are logged with the
+    probability configured for their route.
+    """
+    if response.status_code >= 500:
+        level = logging.ERROR
+    elif response.status_code >= 400:
+        level = logging.WARNING
+    else:
+        level = logging.INFO
+
+    if not logger.isEnabledFor(level):
+        return
+
+    rate = sample_rate(request.path)
+    if level == logging.INFO and rate < 1.0 and random.random() >= rate:
+        with stats_lock:
+            stats['sampled_out'] += 1
+        return
+
+    fields = {
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        'duration_ms': round((time.perf_counter() - started) * 1000, 2),
+        'remote_addr': request.remote_addr,
+        'bytes_in': request.content_length or 0,
+        'sample_rate': rate
+    }
+
+    if logger.isEnabledFor(logging.DEBUG):
+        fields['headers'] = mask_headers(request.headers)
+        if request.method in ('POST', 'PUT', 'PATCH') and request.mimetype == 'application/json' \
+                and not request.headers.get('Content-Encoding'):
+            fields['body'] = body_preview(request)
+
+    logger.log(level, 'request', extra={'fields': fields})
+    with stats_lock:
+        stats['logged'] += 1
+
+
+def get_stats():
+    """Counters of logged, sampled-out and dropped request records"""
+    with stats_lock:
+        return dict(stats, level=logging.getLevelName(logger.getEffectiveLevel()), sample_rates=SAMPLE_RATES)
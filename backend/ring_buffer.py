@@ -0,0 +1,563 @@
+"""
+Per-host columnar ring buffers in memory-mapped files
+Each host's history lives in data/rings/<host>.ring as typed columns: timestamp, one column
+per SAMPLE_FIELDS entry of wire_format, load average, per-core CPU and per-partition usage.
+The metric store is the only writer; any process can map the same file and read it without
+copying through the store or taking its lock, and history survives a restart.
+
+File layout (little-endian):
+
+    header   4s magic 'MRNG', H version, H field count, I capacity, H core count,
+             H partition count, I layout length, at WRITE_INDEX_OFFSET Q write index
+             (number of samples ever appended), padded to HEADER_SIZE
+    layout   UTF-8 JSON list of the static partition fields (device, mountpoint, fstype)
+    columns  one array of capacity x width items per column (see column_specs), each 8-byte aligned
+
+Sample i lives in slot i % capacity of every column. The writer sets the slot's sequence to
+2i+1 while it writes and to 2i+2 when done (a seqlock); a reader keeps a slot only if it sees
+2i+2 both before and after copying the columns, so it never returns a torn or overwritten
+sample. The per-core and per-partition widths and the partition layout are fixed per file;
+when a host's hardware changes the writer migrates the ring to a new file. Partition sizes are
+columns: on ZFS or btrfs datasets `total` changes with nearly every sample.
+
+Version 2 files (partition total in the layout, no partition_total column) are still read; the
+writer migrates a host's ring to the current version on its next sample.
+
+Timestamps are epoch seconds parsed once at ingest and kept non-decreasing, so a time window
+is found by binary search on the timestamp column: O(log n + k) per query.
+"""
+import json
+import mmap
+import os
+import struct
+from datetime import datetime, timezone
+from threading import Lock
+from urllib.parse import quote
+
+from wire_format import SAMPLE_FIELDS, SECTION_SLICES
+
+RING_MAGIC = b'MRNG'
+RING_VERSION = 3
+READABLE_VERSIONS = (2, 3)
+
+HEADER = struct.Struct('<4sHHIHHI')
+WRITE_INDEX = struct.Struct('<Q')
+WRITE_INDEX_OFFSET = 24
+HEADER_SIZE = 32
+
+# Missing-value bits beyond the SAMPLE_FIELDS bits
+LOAD_AVERAGE_BIT = len(SAMPLE_FIELDS)
+PER_CORE_BIT = len(SAMPLE_FIELDS) + 1
+
+# Per-core and partition percentages are stored in hundredths, this marks an absent partition
+PERCENT_MISSING = 0xFFFF
+
+LAYOUT_KEYS = ('device', 'mountpoint', 'fstype')
+
+NAN = float('nan')
+
+
+def parse_timestamp(value):
+    """Convert an ISO timestamp to epoch seconds (naive timestamps are UTC), None if invalid"""
+    try:
+        dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def format_timestamp(epoch):
+    """Convert epoch seconds back to the naive UTC ISO format the agent sends"""
+    return datetime.fromtimestamp(epoch, timezone.utc).replace(tzinfo=None).isoformat()
+
+
+def ring_path(directory, hostname):
+    """File of a host's ring (hostnames are percent-encoded)"""
+    return os.path.join(directory, quote(hostname, safe='') + '.ring')
+
+
+def column_specs(core_count, partition_count, version=RING_VERSION):
+    """(name, typecode, width) of every column of a ring"""
+    specs = [('sequence', 'Q', 1), ('timestamp', 'd', 1), ('missing', 'Q', 1)]
+    specs.extend((f'{section}.{key}', 'q' if kind == 'i' else 'd', 1) for section, key, kind in SAMPLE_FIELDS)
+    specs.extend([
+        ('load_average', 'd', 3),
+        ('cpu_percent_per_core', 'H', core_count),
+        ('partition_used', 'Q', partition_count),
+        ('partition_free', 'Q', partition_count),
+        ('partition_percent', 'H', partition_count)
+    ])
+    if version >= 3:
+        specs.append(('partition_total', 'Q', partition_count))
+    return specs
+
+
+def column_offsets(capacity, core_count, partition_count, layout_length, version=RING_VERSION):
+    """Byte offset of every column and the total file size"""
+    offset = align8(HEADER_SIZE + layout_length)
+    offsets = []
+    for name, typecode, width in column_specs(core_count, partition_count, version):
+        offsets.append((name, typecode, width, offset))
+        offset = align8(offset + capacity * width * struct.calcsize(typecode))
+    return offsets, offset
+
+
+def align8(offset):
+    return (offset + 7) & ~7
+
+
+def partition_layout(metrics):
+    """Static partition fields of a sample, None if it carries no partitions"""
+    partitions = (metrics.get('disk') or {}).get('partitions')
+    if not isinstance(partitions, list):
+        return None
+    return [{key: partition.get(key) for key in LAYOUT_KEYS} for partition in partitions]
+
+
+def per_core(metrics):
+    """Per-core CPU list of a sample, None if absent"""
+    cores = (metrics.get('cpu') or {}).get('cpu_percent_per_core')
+    return cores if isinstance(cores, list) else None
+
+
+def to_hundredths(value):
+    """Percentage as an unsigned 16-bit count of hundredths"""
+    return min(max(int(round(float(value) * 100)), 0), PERCENT_MISSING - 1)
+
+
+class RingBuffer:
+    """Fixed-capacity columnar history of one host in a memory-mapped file"""
+
+    def __init__(self, path, hostname, writable):
+        header = read_header(path)
+        if header is None:
+            raise ValueError(f"Not a ring file: {path}")
+
+        self.path = path
+        self.hostname = hostname
+        self.writable = writable
+        self.version = header['version']
+        self.capacity = header['capacity']
+        self.core_count = header['core_count']
+        self.layout = header['layout']
+        self.layout_key = [tuple(partition.get(key) for key in LAYOUT_KEYS) for partition in self.layout]
+        self.mountpoints = [partition.get('mountpoint') for partition in self.layout]
+
+        offsets, size = column_offsets(self.capacity, self.core_count, len(self.layout), header['layout_length'],
+                                       self.version)
+
+        with open(path, 'r+b' if writable else 'rb') as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self.mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+
+        self.buffer = memoryview(self.mm)
+        self.columns = {}
+        self.widths = {}
+        for name, typecode, width, offset in offsets:
+            length = self.capacity * width * struct.calcsize(typecode)
+            self.columns[name] = self.buffer[offset:offset + length].cast(typecode)
+            self.widths[name] = width
+        self.field_columns = [self.columns[f'{section}.{key}'] for section, key, _ in SAMPLE_FIELDS]
+
+    @staticmethod
+    def initialize(path, capacity, core_count, layout):
+        """Write an empty ring file"""
+        layout_data = json.dumps(layout).encode('utf-8')
+        _, size = column_offsets(capacity, core_count, len(layout), len(layout_data))
+
+        with open(path, 'wb') as f:
+            f.truncate(size)
+            f.write(HEADER.pack(RING_MAGIC, RING_VERSION, len(SAMPLE_FIELDS), capacity, core_count,
+                                len(layout), len(layout_data)))
+            f.seek(HEADER_SIZE)
+            f.write(layout_data)
+
+    def accepts(self, metrics):
+        """True if the sample fits this ring's version, core count and partition layout"""
+        if self.version != RING_VERSION:
+            return False
+        cores = per_core(metrics)
+        if cores is not None and len(cores) != self.core_count:
+            return False
+        layout = partition_layout(metrics)
+        if layout is not None and [tuple(p.get(key) for key in LAYOUT_KEYS) for p in layout] != self.layout_key:
+            return False
+        return True
+
+    def write_index(self):
+        """Number of samples ever appended"""
+        return WRITE_INDEX.unpack_from(self.mm, WRITE_INDEX_OFFSET)[0]
+
+    def __len__(self):
+        return min(self.write_index(), self.capacity)
+
+    def append(self, metrics, epoch):
+        """Write one sample into the next slot of every column (single writer)
+
+        Timestamps are kept non-decreasing so window queries can binary-search them: a sample
+        older than the newest one held (clock stepped back) is stored with the newest timestamp.
+        Returns True if the timestamp had to be adjusted.
+        """
+        index = self.write_index()
+        slot = index % self.capacity
+        columns = self.columns
+        missing = 0
+
+        adjusted = False
+        if index:
+            newest = columns['timestamp'][(index - 1) % self.capacity]
+            if epoch < newest:
+                epoch = newest
+                adjusted = True
+
+        columns['sequence'][slot] = 2 * index + 1
+        columns['timestamp'][slot] = epoch
+
+        cpu = metrics.get('cpu') or {}
+        io = metrics.get('io') or {}
+        sections = {
+            'cpu': cpu,
+            'memory': metrics.get('memory') or {},
+            'network': io.get('network') or {},
+            'disk_io': io.get('disk_io') or {}
+        }
+        for bit, ((section, key, kind), column) in enumerate(zip(SAMPLE_FIELDS, self.field_columns)):
+            value = sections[section].get(key)
+            try:
+                column[slot] = int(value) if kind == 'i' else float(value)
+            except (TypeError, ValueError, OverflowError):
+                column[slot] = 0 if kind == 'i' else NAN
+                missing |= 1 << bit
+
+        load_average = cpu.get('load_average')
+        try:
+            for i in range(3):
+                columns['load_average'][slot * 3 + i] = float(load_average[i])
+        except (TypeError, ValueError, IndexError):
+            missing |= 1 << LOAD_AVERAGE_BIT
+
+        cores = per_core(metrics)
+        try:
+            for i in range(self.core_count):
+                columns['cpu_percent_per_core'][slot * self.core_count + i] = to_hundredths(cores[i])
+        except (TypeError, ValueError, IndexError):
+            missing |= 1 << PER_CORE_BIT
+        if cores is None:
+            missing |= 1 << PER_CORE_BIT
+
+        # Partitions are matched by mountpoint so migrated history keeps its disks
+        partitions = {}
+        for partition in (metrics.get('disk') or {}).get('partitions') or []:
+            if isinstance(partition, dict):
+                partitions[partition.get('mountpoint')] = partition
+        width = len(self.layout)
+        for i, mountpoint in enumerate(self.mountpoints):
+            partition = partitions.get(mountpoint)
+            try:
+                columns['partition_used'][slot * width + i] = int(partition['used'])
+                columns['partition_free'][slot * width + i] = int(partition['free'])
+                columns['partition_percent'][slot * width + i] = to_hundredths(partition['percent'])
+                columns['partition_total'][slot * width + i] = int(partition.get('total') or 0)
+            except (TypeError, ValueError, KeyError, OverflowError):
+                columns['partition_percent'][slot * width + i] = PERCENT_MISSING
+
+        columns['missing'][slot] = missing
+        columns['sequence'][slot] = 2 * index + 2
+        WRITE_INDEX.pack_into(self.mm, WRITE_INDEX_OFFSET, index + 1)
+
+        return adjusted
+
+    def oldest_timestamp(self):
+        """Timestamp of the oldest sample held, None if empty"""
+        end = self.write_index()
+        if not end:
+            return None
+        return self.columns['timestamp'][max(0, end - self.capacity) % self.capacity]
+
+    def find(self, epoch):
+        """Number of the first held sample with a timestamp >= epoch (binary search)"""
+        end = self.write_index()
+        low, high = max(0, end - self.capacity), end
+        column = self.columns['timestamp']
+
+        while low < high:
+            middle = (low + high) // 2
+            if column[middle % self.capacity] < epoch:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def window(self, since=None, limit=None):
+        """(first, end) sample numbers of the held samples newer than `since`, at most `limit` of them"""
+        end = self.write_index()
+        first = max(0, end - self.capacity)
+        if since is not None:
+            first = self.find(since)
+        if limit is not None:
+            first = max(first, end - limit)
+        return first, end
+
+    def read(self, since=None, limit=None):
+        """History entries newer than `since` (epoch seconds), the last `limit` of them, oldest first"""
+        return self.read_range(*self.window(since, limit))
+
+    def read_columns(self, names, since=None, limit=None):
+        """Values of single-width columns for the window, {name: list} plus 'timestamp'
+
+        Missing doubles are NaN, missing integers 0 (see the 'missing' column).
+        """
+        first, end = self.window(since, limit)
+        first = max(first, self.write_index() - self.capacity, 0)
+        names = ['timestamp'] + [name for name in names if name != 'timestamp']
+        if first >= end:
+            return {name: [] for name in names}
+
+        runs = self._runs(first, end)
+        sequences = self._gather('sequence', runs)
+        values = {name: self._gather(name, runs) for name in names}
+        sequences_after = self._gather('sequence', runs)
+
+        keep = [k for k in range(end - first)
+                if sequences[k] == sequences_after[k] == 2 * (first + k) + 2]
+        if len(keep) == end - first:
+            return values
+        return {name: [column[k] for k in keep] for name, column in values.items()}
+
+    def _runs(self, first, end):
+        """Slot ranges of samples first..end-1: a wrapped range is at most two contiguous runs"""
+        runs = []
+        index = first
+        while index < end:
+            slot = index % self.capacity
+            count = min(end - index, self.capacity - slot)
+            runs.append((slot, slot + count))
+            index += count
+        return runs
+
+    def _gather(self, name, runs):
+        """Copy a column's values for the given slot runs"""
+        column, width = self.columns[name], self.widths[name]
+        values = []
+        for start, stop in runs:
+            values.extend(column[start * width:stop * width].tolist())
+        return values
+
+    def read_range(self, first, end):
+        """History entries of samples first..end-1 (sample numbers, not slots) still held"""
+        first = max(first, self.write_index() - self.capacity, 0)
+        if first >= end:
+            return []
+
+        runs = self._runs(first, end)
+
+        def gather(name):
+            return self._gather(name, runs)
+
+        sequences = gather('sequence')
+        timestamps = gather('timestamp')
+        missing = gather('missing')
+        fields = [gather(f'{section}.{key}') for section, key, _ in SAMPLE_FIELDS]
+        load_average = gather('load_average')
+        cores = gather('cpu_percent_per_core')
+        used = gather('partition_used')
+        free = gather('partition_free')
+        percent = gather('partition_percent')
+        # Version 2 files keep the total in the layout
+        total = gather('partition_total') if 'partition_total' in self.columns else None
+        sequences_after = gather('sequence')
+
+        core_count = self.core_count
+        width = len(self.layout)
+        entries = []
+
+        for k in range(end - first):
+            expected = 2 * (first + k) + 2
+            # Skip slots being rewritten or overwritten while we copied them
+            if sequences[k] != expected or sequences_after[k] != expected:
+                continue
+
+            sections = {}
+            for section, keys, start, stop in SECTION_SLICES:
+                sections[section] = {key: fields[j][k] for key, j in zip(keys, range(start, stop))}
+
+            mask = missing[k]
+            if mask:
+                for bit, (section, key, kind) in enumerate(SAMPLE_FIELDS):
+                    if mask >> bit & 1:
+                        if kind == 'o':
+                            del sections[section][key]
+                        else:
+                            sections[section][key] = None
+
+            cpu = sections['cpu']
+            cpu['load_average'] = None if mask >> LOAD_AVERAGE_BIT & 1 else load_average[k * 3:k * 3 + 3]
+            if not mask >> PER_CORE_BIT & 1:
+                cpu['cpu_percent_per_core'] = [value / 100 for value in cores[k * core_count:(k + 1) * core_count]]
+
+            partitions = []
+            for i, layout in enumerate(self.layout):
+                j = k * width + i
+                if percent[j] != PERCENT_MISSING:
+                    partition = dict(layout, used=used[j], free=free[j], percent=percent[j] / 100)
+                    if total is not None:
+                        partition['total'] = total[j]
+                    partitions.append(partition)
+
+            entries.append({
+                'timestamp': format_timestamp(timestamps[k]),
+                'hostname': self.hostname,
+                'cpu': cpu,
+                'memory': sections['memory'],
+                'disk': {'partitions': partitions},
+                'io': {'network': sections['network'], 'disk_io': sections['disk_io']}
+            })
+
+        return entries
+
+    def is_stale(self):
+        """True if the file was replaced since it was mapped"""
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except OSError:
+            return True
+
+    def flush(self):
+        """Write the writer's changes to the file"""
+        if self.writable:
+            self.mm.flush()
+
+    def close(self):
+        """Unmap the file now; only when no other thread can be reading the ring (see RingDirectory)"""
+        for column in self.columns.values():
+            column.release()
+        self.field_columns = []
+        self.buffer.release()
+        self.flush()
+        self.mm.close()
+
+
+def read_header(path):
+    """Header fields and partition layout of a ring file, None if missing or not a readable ring"""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read(HEADER_SIZE)
+            if len(data) < HEADER_SIZE:
+                return None
+            magic, version, field_count, capacity, core_count, partition_count, layout_length = HEADER.unpack_from(data)
+            if magic != RING_MAGIC or version not in READABLE_VERSIONS or field_count != len(SAMPLE_FIELDS):
+                return None
+            layout = json.loads(f.read(layout_length).decode('utf-8'))
+            size = os.fstat(f.fileno()).st_size
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(layout, list) or len(layout) != partition_count \
+            or size < column_offsets(capacity, core_count, partition_count, layout_length, version)[1]:
+        return None
+
+    return {
+        'version': version,
+        'capacity': capacity,
+        'core_count': core_count,
+        'layout': layout,
+        'layout_length': layout_length
+    }
+
+
+class RingDirectory:
+    """The rings of all hosts under one directory, mapped on first use
+
+    A ring that is replaced (stale file, migration) or dropped at shutdown is never closed here:
+    another request thread may still be reading it. Its mapping is released when the last
+    reference to it goes away.
+    """
+
+    def __init__(self, directory, capacity=None, writable=False):
+        self.directory = directory
+        self.capacity = capacity
+        self.writable = writable
+        self.rings = {}
+        self.lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, hostname):
+        """Ring of a host, None if it has none"""
+        ring = self.rings.get(hostname)
+        if ring is not None and (self.writable or not ring.is_stale()):
+            return ring
+
+        with self.lock:
+            if ring is not None:
+                # Dropped by reference only, readers holding it keep a valid mapping
+                self.rings.pop(hostname, None)
+            try:
+                ring = RingBuffer(ring_path(self.directory, hostname), hostname, self.writable)
+            except (OSError, ValueError):
+                return None
+            self.rings[hostname] = ring
+            return ring
+
+    def append(self, hostname, metrics, epoch):
+        """Append a sample to a host's ring (writers only)
+
+        Creates the ring on first use and migrates it to a new file when the host's core count,
+        partition layout or the configured capacity changed. Returns True if the sample was older
+        than the host's newest one (see RingBuffer.append).
+        """
+        ring = self.get(hostname)
+        if ring is None or ring.capacity != self.capacity or not ring.accepts(metrics):
+            ring = self.rebuild(hostname, metrics, ring)
+        return ring.append(metrics, epoch)
+
+    def rebuild(self, hostname, metrics, old_ring):
+        """Create a ring shaped for `metrics`, copying the history of old_ring into it"""
+        path = ring_path(self.directory, hostname)
+        tmp_path = path + '.tmp'
+
+        cores = per_core(metrics)
+        layout = partition_layout(metrics)
+        if old_ring is not None:
+            cores = cores if cores is not None else [None] * old_ring.core_count
+            layout = layout if layout is not None else [{key: partition.get(key) for key in LAYOUT_KEYS}
+                                                        for partition in old_ring.layout]
+            print(f"[STORE] Ring of {hostname} resized, its layout or version changed, "
+                  f"migrating {len(old_ring)} samples")
+
+        RingBuffer.initialize(tmp_path, self.capacity, len(cores or []), layout or [])
+        ring = RingBuffer(tmp_path, hostname, writable=True)
+
+        if old_ring is not None:
+            entries = old_ring.read()
+            for entry in entries[-self.capacity:]:
+                ring.append(entry, parse_timestamp(entry['timestamp']))
+
+        with self.lock:
+            os.replace(tmp_path, path)
+            ring.path = path
+            self.rings[hostname] = ring
+
+        return ring
+
+    def read(self, hostname, since=None, limit=None):
+        """History entries of a host, oldest first (empty if it has no ring), see RingBuffer.read"""
+        ring = self.get(hostname)
+        return ring.read(since, limit) if ring is not None else []
+
+    def nbytes(self):
+        """(bytes, slots) of the rings mapped so far"""
+        rings = list(self.rings.values())
+        return sum(len(ring.mm) for ring in rings), sum(ring.capacity for ring in rings)
+
+    def sample_count(self):
+        """Samples held by the rings mapped so far"""
+        return sum(len(ring) for ring in list(self.rings.values()))
+
+    def close(self):
+        """Flush every ring and forget them (mappings go away with their last reader)"""
+        with self.lock:
+            for ring in self.rings.values():
+                ring.flush()
+            self.rings.clear()
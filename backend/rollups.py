@@ -0,0 +1,283 @@
+"""
+Multi-resolution rollups
+Keeps count/sum/min/max of the main numeric series of every host in 1-minute, 5-minute and
+1-hour buckets. Buckets are updated incrementally as the metric store stores each sample and
+handed to the history writer when they close, which merges them into the rollups table of the
+history database. A 30-day chart then reads 720 hourly rows instead of half a million samples.
+
+Aggregates of a bucket are a flat list of 4 floats per ROLLUP_METRICS entry:
+count, sum, min, max (min/max are +inf/-inf while count is 0).
+
+Percentiles come from quantile sketches (see quantile_sketch.py), one per ROLLUP_METRICS entry.
+Only the current minute's sketches are kept in memory; when the minute closes they are handed
+to the history writer once per resolution, which merges them into the stored sketches of the
+1-minute, 5-minute and 1-hour buckets they belong to.
+"""
+import math
+import os
+import struct
+
+import quantile_sketch
+from ring_buffer import format_timestamp
+
+# (name, bucket seconds), finest first
+RESOLUTIONS = (('1m', 60), ('5m', 300), ('1h', 3600))
+RESOLUTION_SECONDS = dict(RESOLUTIONS)
+
+# Days of buckets kept per resolution
+# Override with ROLLUP_RETENTION_DAYS="1m=2,5m=30,1h=400" (0 keeps everything)
+DEFAULT_RETENTION_DAYS = {'1m': 2, '5m': 30, '1h': 400}
+
+# Rolled-up series as 'section.key' (network and disk_io live under 'io' in a sample).
+# Append only: stored buckets and sketches are decoded by position.
+ROLLUP_METRICS = (
+    'cpu.cpu_percent_total',
+    'memory.memory_percent',
+    'memory.swap_percent',
+    'network.bytes_sent_per_sec',
+    'network.bytes_recv_per_sec',
+    'disk_io.read_bytes_per_sec',
+    'disk_io.write_bytes_per_sec',
+)
+
+IO_SECTIONS = ('network', 'disk_io')
+
+INF = float('inf')
+
+# Resolution of the in-memory sketches, coarser buckets merge them as they close
+SKETCH_RESOLUTION = RESOLUTIONS[0][0]
+
+
+def parse_retention_days(value):
+    """Parse 'resolution=days,...' into a dict, ignoring malformed entries and unknown resolutions"""
+    days = {}
+    for entry in (value or '').split(','):
+        name, _, count = entry.strip().partition('=')
+        try:
+            if name.strip() in RESOLUTION_SECONDS:
+                days[name.strip()] = max(float(count), 0.0)
+        except ValueError:
+            continue
+    return days
+
+
+RETENTION_DAYS = dict(DEFAULT_RETENTION_DAYS, **parse_retention_days(os.environ.get('ROLLUP_RETENTION_DAYS')))
+
+
+def new_aggregates():
+    """Empty aggregates for every rolled-up metric"""
+    return [0.0, 0.0, INF, -INF] * len(ROLLUP_METRICS)
+
+
+def sample_values(metrics):
+    """Values of the rolled-up metrics in a sample, None where missing or not finite"""
+    io = metrics.get('io') or {}
+    values = []
+    for name in ROLLUP_METRICS:
+        section, key = name.split('.', 1)
+        source = io.get(section) if section in IO_SECTIONS else metrics.get(section)
+        try:
+            value = float((source or {}).get(key))
+        except (TypeError, ValueError):
+            value = None
+        values.append(value if value is not None and math.isfinite(value) else None)
+    return values
+
+
+def update(aggregates, values):
+    """Add one sample's values to aggregates in place"""
+    for i, value in enumerate(values):
+        if value is None:
+            continue
+        base = 4 * i
+        aggregates[base] += 1
+        aggregates[base + 1] += value
+        if value < aggregates[base + 2]:
+            aggregates[base + 2] = value
+        if value > aggregates[base + 3]:
+            aggregates[base + 3] = value
+
+
+def merge(aggregates, other):
+    """Merge other into aggregates in place"""
+    for base in range(0, len(aggregates), 4):
+        aggregates[base] += other[base]
+        aggregates[base + 1] += other[base + 1]
+        aggregates[base + 2] = min(aggregates[base + 2], other[base + 2])
+        aggregates[base + 3] = max(aggregates[base + 3], other[base + 3])
+    return aggregates
+
+
+def encode_aggregates(aggregates):
+    """Packed little-endian doubles"""
+    return struct.pack(f'<{len(aggregates)}d', *aggregates)
+
+
+def decode_aggregates(data):
+    """Aggregates from encode_aggregates, metrics added since the bucket was written are empty"""
+    values = list(struct.unpack(f'<{len(data) // 8}d', data))
+    return values + new_aggregates()[len(values):]
+
+
+def new_sketches():
+    """Empty sketches for every rolled-up metric"""
+    return quantile_sketch.new_sketches(len(ROLLUP_METRICS))
+
+
+def decode_sketches(data):
+    return quantile_sketch.decode_sketches(data, len(ROLLUP_METRICS))
+
+
+def sketch_rows(hostname, start, sketches):
+    """Rows merging a closed minute's sketches into the buckets of every resolution"""
+    return [(hostname, name, start - start % seconds, sketches) for name, seconds in RESOLUTIONS]
+
+
+def summarize(aggregates):
+    """{metric: {count, average, min, max}} of the metrics with at least one value"""
+    summary = {}
+    for i, name in enumerate(ROLLUP_METRICS):
+        count, total, low, high = aggregates[4 * i:4 * i + 4]
+        if count:
+            summary[name] = {'count': int(count), 'average': total / count, 'min': low, 'max': high}
+    return summary
+
+
+def rollup_entry(hostname, resolution, start, aggregates):
+    """History entry for a bucket: averages in the sample layout, plus min/max per metric"""
+    entry = {
+        'timestamp': format_timestamp(start),
+        'hostname': hostname,
+        'resolution': resolution,
+        'samples': 0,
+        'min': {},
+        'max': {}
+    }
+    for name, values in summarize(aggregates).items():
+        section, key = name.split('.', 1)
+        target = entry.setdefault('io', {}) if section in IO_SECTIONS else entry
+        target.setdefault(section, {})[key] = values['average']
+        entry['min'][name] = values['min']
+        entry['max'][name] = values['max']
+        entry['samples'] = max(entry['samples'], values['count'])
+    return entry
+
+
+def choose_resolution(window, points):
+    """Coarsest resolution giving at least `points` buckets over `window` seconds
+
+    Returns None when even 1-minute buckets are too coarse and raw samples should be used.
+    """
+    if points <= 0:
+        return None
+    for name, seconds in reversed(RESOLUTIONS):
+        if window / seconds >= points:
+            return name
+    return None
+
+
+class RollupEngine:
+    """Open buckets of every host at every resolution (single writer: the metric store)
+
+    Closed buckets are passed to `sink` as (hostname, resolution, start, aggregates) rows, closed
+    sketches to `sketch_sink` as (hostname, resolution, start, sketches) rows.
+    """
+
+    def __init__(self, sink=None, sketch_sink=None):
+        self.open = {}  # hostname -> {resolution: [start, aggregates]}
+        self.sketches = {}  # hostname -> (start, sketches) of the open SKETCH_RESOLUTION bucket
+        self.sink = sink
+        self.sketch_sink = sketch_sink
+        self.late = 0  # samples older than their host's open bucket
+
+    def add(self, hostname, epoch, metrics):
+        """Add a sample to the open buckets of its host, closing those it moved past"""
+        values = sample_values(metrics)
+        buckets = self.open.setdefault(hostname, {})
+        closed = []
+
+        for name, seconds in RESOLUTIONS:
+            start = epoch - epoch % seconds
+            bucket = buckets.get(name)
+            if bucket is None or start > bucket[0]:
+                if bucket is not None:
+                    closed.append((hostname, name, bucket[0], bucket[1]))
+                bucket = buckets[name] = [start, new_aggregates()]
+            elif start < bucket[0]:
+                # The bucket already closed: a one-sample bucket is merged into it on disk
+                late = new_aggregates()
+                update(late, values)
+                closed.append((hostname, name, start, late))
+                self.late += 1
+                continue
+            # Copy-on-write: readers holding the previous aggregates never see a partial update
+            aggregates = list(bucket[1])
+            update(aggregates, values)
+            bucket[1] = aggregates
+
+        if closed and self.sink is not None:
+            self.sink(closed)
+
+        closed_sketches = self.add_sketches(hostname, epoch, values)
+        if closed_sketches and self.sketch_sink is not None:
+            self.sketch_sink(closed_sketches)
+
+    def add_sketches(self, hostname, epoch, values):
+        """Add a sample to its host's open sketches, returns the sketch rows this closed"""
+        seconds = RESOLUTION_SECONDS[SKETCH_RESOLUTION]
+        start = epoch - epoch % seconds
+        current = self.sketches.get(hostname)
+        rows = []
+
+        if current is not None and start < current[0]:
+            # The minute already closed: its one-sample sketches are merged on disk
+            late = new_sketches()
+            for sketch, value in zip(late, values):
+                if value is not None:
+                    sketch.add(value)
+            return sketch_rows(hostname, start, late)
+
+        if current is None or start > current[0]:
+            if current is not None:
+                rows = sketch_rows(hostname, *current)
+            sketches = new_sketches()
+        else:
+            sketches = current[1]
+
+        # Copy-on-write: published sketches are never modified
+        updated = []
+        for sketch, value in zip(sketches, values):
+            if value is not None:
+                sketch = sketch.copy()
+                sketch.add(value)
+            updated.append(sketch)
+        self.sketches[hostname] = (start, updated)
+        return rows
+
+    def get_open_sketches(self, hostname):
+        """(start, sketches) of a host's open minute, or None (the sketches must not be modified)"""
+        return self.sketches.get(hostname)
+
+    def get_open(self, hostname, resolution):
+        """(start, aggregates) of a host's open bucket, or None (safe while the writer adds samples)"""
+        bucket = self.open.get(hostname, {}).get(resolution)
+        if bucket is None:
+            return None
+        start, aggregates = bucket  # a new bucket is a new list, so start and aggregates match
+        return start, list(aggregates)
+
+    def close_all(self):
+        """Close every open bucket (at shutdown, a restart merges the rest of the bucket on disk)"""
+        closed = [(hostname, name, start, aggregates)
+                  for hostname, buckets in self.open.items()
+                  for name, (start, aggregates) in buckets.items()]
+        self.open = {}
+        if closed and self.sink is not None:
+            self.sink(closed)
+
+        closed_sketches = [row for hostname, (start, sketches) in self.sketches.items()
+                           for row in sketch_rows(hostname, start, sketches)]
+        self.sketches = {}
+        if closed_sketches and self.sketch_sink is not None:
+            self.sketch_sink(closed_sketches)
+        return len(closed)
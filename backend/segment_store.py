@@ -0,0 +1,375 @@
+"""
+Append-only segment files for raw long-term history
+One file per host per UTC day (<SEGMENT_DIR>/<hostname>/<YYYY-MM-DD>.seg) holding the numeric
+series of every sample as fixed-width records, so weeks of 5-second samples stay on local disk
+and a time range is read back with mmap at disk speed.
+
+File layout (little-endian):
+
+    header   4s magic 'MSEG', H version, H field count, I record size, I index stride,
+             I index capacity, padded to HEADER_SIZE
+    index    index capacity x d: timestamp of record n * stride (a sparse time index)
+    records  d timestamp, Q missing bits, one q/d per SAMPLE_FIELDS entry, 3d load average
+
+Records are only ever appended. The index slot of a block is written before its first record,
+so a reader only trusts the slots of records it can see. Timestamps are kept non-decreasing
+within a file, a time range is found by bisecting the index and then the records of one block.
+Per-core CPU and partitions have no fixed width and are not kept (the history database has them).
+
+The writer keeps the newest segment of each host open (up to SEGMENT_MAX_OPEN files), so an
+append is one pwrite under that host's lock; retention runs over the whole directory on a timer.
+"""
+import mmap
+import os
+import struct
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import datetime, timezone
+from threading import Event, Lock, Thread
+
+from ring_buffer import LOAD_AVERAGE_BIT, format_timestamp, ring_path
+from wire_format import SAMPLE_FIELDS, SECTION_SLICES
+
+# Empty SEGMENT_DIR disables segment storage
+SEGMENT_DIR = os.environ.get('SEGMENT_DIR', os.path.join('data', 'segments'))
+SEGMENT_RETENTION_DAYS = int(os.environ.get('SEGMENT_RETENTION_DAYS', 30))  # 0 keeps everything
+SEGMENT_MAX_OPEN = int(os.environ.get('SEGMENT_MAX_OPEN', 256))  # segment files kept open between appends
+SEGMENT_RETENTION_INTERVAL = 3600  # seconds between retention runs
+
+SEGMENT_MAGIC = b'MSEG'
+SEGMENT_VERSION = 1
+
+HEADER = struct.Struct('<4sHHIII')
+HEADER_SIZE = 32
+
+RECORD = struct.Struct('<dQ' + ''.join('q' if kind == 'i' else 'd' for _, _, kind in SAMPLE_FIELDS) + '3d')
+TIMESTAMP = struct.Struct('<d')
+
+INDEX_STRIDE = 256  # records per index entry
+INDEX_CAPACITY = 1024  # index entries: a day of samples every 0.33s before blocks go unindexed
+
+DATA_OFFSET = HEADER_SIZE + INDEX_CAPACITY * TIMESTAMP.size
+
+NAN = float('nan')
+
+
+def day_of(epoch):
+    """UTC day of an epoch timestamp, 'YYYY-MM-DD'"""
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d')
+
+
+def host_directory(directory, hostname):
+    """Directory of a host's segments (hostname percent-encoded like the ring files)"""
+    return ring_path(directory, hostname)[:-len('.ring')]
+
+
+def encode_record(metrics, epoch):
+    """Fixed-width record of a sample's numeric series"""
+    cpu = metrics.get('cpu') or {}
+    io = metrics.get('io') or {}
+    sections = {
+        'cpu': cpu,
+        'memory': metrics.get('memory') or {},
+        'network': io.get('network') or {},
+        'disk_io': io.get('disk_io') or {}
+    }
+    values = []
+    missing = 0
+    for bit, (section, key, kind) in enumerate(SAMPLE_FIELDS):
+        value = sections[section].get(key)
+        try:
+            values.append(int(value) if kind == 'i' else float(value))
+        except (TypeError, ValueError, OverflowError):
+            values.append(0 if kind == 'i' else NAN)
+            missing |= 1 << bit
+
+    try:
+        load_average = [float(cpu['load_average'][i]) for i in range(3)]
+    except (KeyError, TypeError, ValueError, IndexError):
+        load_average = [NAN] * 3
+        missing |= 1 << LOAD_AVERAGE_BIT
+
+    return RECORD.pack(epoch, missing, *values, *load_average)
+
+
+def decode_record(hostname, buffer, offset):
+    """History entry of the record at offset, marked 'source': 'segment' (no per-core CPU or partitions)"""
+    values = RECORD.unpack_from(buffer, offset)
+    epoch, mask, fields, load_average = values[0], values[1], values[2:-3], list(values[-3:])
+
+    sections = {}
+    for section, keys, start, stop in SECTION_SLICES:
+        sections[section] = dict(zip(keys, fields[start:stop]))
+    if mask:
+        for bit, (section, key, kind) in enumerate(SAMPLE_FIELDS):
+            if mask >> bit & 1:
+                if kind == 'o':
+                    del sections[section][key]
+                else:
+                    sections[section][key] = None
+
+    sections['cpu']['load_average'] = None if mask >> LOAD_AVERAGE_BIT & 1 else load_average
+    return {
+        'timestamp': format_timestamp(epoch),
+        'hostname': hostname,
+        'source': 'segment',
+        'cpu': sections['cpu'],
+        'memory': sections['memory'],
+        'io': {'network': sections['network'], 'disk_io': sections['disk_io']}
+    }
+
+
+class OpenSegment:
+    """Append state of a host's newest segment (guarded by its own lock)"""
+
+    __slots__ = ('lock', 'day', 'count', 'newest', 'fd')
+
+    def __init__(self):
+        self.lock = Lock()
+        self.day = None  # day of the segment appended to, None until the first append
+        self.count = 0  # records in it
+        self.newest = 0.0  # timestamp of its last record
+        self.fd = None  # kept open between appends, closed when evicted (see SegmentWriter)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class SegmentWriter:
+    """Appends samples to per-host day segments (single writer per host: the metric store)
+
+    The segment of every host is kept open between appends, the least recently used ones are
+    closed past max_open. An append holds only its host's OpenSegment lock while writing, the
+    writer's lock guards the bookkeeping, so hosts in different shards append concurrently.
+    A background thread deletes segments past the retention period, of every host in the
+    directory, including hosts that stopped reporting.
+    """
+
+    def __init__(self, directory=SEGMENT_DIR, retention_days=SEGMENT_RETENTION_DAYS, max_open=SEGMENT_MAX_OPEN,
+                 retention_interval=SEGMENT_RETENTION_INTERVAL):
+        self.directory = directory
+        self.retention_days = retention_days
+        self.max_open = max(max_open, 1)
+        self.retention_interval = retention_interval
+        self.lock = Lock()
+        self.hosts = {}  # hostname -> OpenSegment
+        self.open_files = OrderedDict()  # hostname -> OpenSegment with an open fd, least recently used first
+        self.stop_event = Event()
+        self.thread = None
+        self.stats = {'records': 0, 'segments_created': 0, 'segments_deleted': 0, 'files_closed': 0, 'errors': 0}
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, hostname, metrics, epoch):
+        """Append one sample to the host's segment of the sample's day"""
+        with self.lock:
+            segment = self.hosts.get(hostname)
+            if segment is None:
+                segment = self.hosts[hostname] = OpenSegment()
+
+        with segment.lock:
+            try:
+                created = self._append_locked(hostname, segment, metrics, epoch)
+            except OSError as e:
+                # Start over from the file on the next append
+                segment.close()
+                segment.day = None
+                with self.lock:
+                    self.stats['errors'] += 1
+                print(f"[ERROR] Failed to append to the segment of {hostname}: {e}")
+                return
+
+        evicted = []
+        with self.lock:
+            self.stats['records'] += 1
+            self.stats['segments_created'] += created
+            self.open_files[hostname] = segment
+            self.open_files.move_to_end(hostname)
+            while len(self.open_files) > self.max_open:
+                evicted.append(self.open_files.popitem(last=False)[1])
+            self.stats['files_closed'] += len(evicted)
+
+        # Outside the writer's lock: an evicted host may be appending, its lock waits for it
+        for segment in evicted:
+            with segment.lock:
+                segment.close()
+
+    def _append_locked(self, hostname, segment, metrics, epoch):
+        """Write one record (caller holds segment.lock), returns 1 if a segment was created"""
+        day = day_of(epoch)
+        if segment.day is not None and day == segment.day:
+            # Keep timestamps non-decreasing within the file
+            epoch = max(epoch, segment.newest)
+        elif segment.day is not None and day < segment.day:
+            # Clock stepped back across midnight: stay in the newest segment
+            day, epoch = segment.day, segment.newest
+
+        created = 0
+        if segment.fd is None or segment.day != day:
+            segment.close()
+            segment.day = None
+            path = os.path.join(host_directory(self.directory, hostname), f'{day}.seg')
+            segment.fd, segment.count, newest, created = self.open_segment(path)
+            segment.day = day
+            epoch = max(epoch, newest)
+
+        count = segment.count
+        if count % INDEX_STRIDE == 0 and count // INDEX_STRIDE < INDEX_CAPACITY:
+            os.pwrite(segment.fd, TIMESTAMP.pack(epoch), HEADER_SIZE + count // INDEX_STRIDE * TIMESTAMP.size)
+        os.pwrite(segment.fd, encode_record(metrics, epoch), DATA_OFFSET + count * RECORD.size)
+
+        segment.count = count + 1
+        segment.newest = epoch
+        return created
+
+    @staticmethod
+    def open_segment(path):
+        """Open (creating if needed) a day segment, returns (fd, record count, newest timestamp, created)"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            size = os.fstat(fd).st_size
+            if size < DATA_OFFSET:
+                header = HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, len(SAMPLE_FIELDS), RECORD.size,
+                                     INDEX_STRIDE, INDEX_CAPACITY)
+                os.pwrite(fd, header.ljust(DATA_OFFSET, b'\0'), 0)
+                return fd, 0, 0.0, 1
+
+            # A record cut short by a crash is overwritten by the next one
+            count = (size - DATA_OFFSET) // RECORD.size
+            newest = TIMESTAMP.unpack(os.pread(fd, TIMESTAMP.size, DATA_OFFSET + (count - 1) * RECORD.size))[0] \
+                if count else 0.0
+            return fd, count, newest, 0
+        except OSError:
+            os.close(fd)
+            raise
+
+    def apply_retention(self):
+        """Delete the segments of every host older than the retention period"""
+        if self.retention_days <= 0:
+            return
+        cutoff = day_of(datetime.now(timezone.utc).timestamp() - self.retention_days * 86400)
+        with self.lock:
+            segments = {host_directory(self.directory, hostname): segment for hostname, segment in self.hosts.items()}
+
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir():
+                continue
+            segment = segments.get(entry.path)
+            if segment is not None:
+                with segment.lock:
+                    if segment.day is not None and segment.day < cutoff:
+                        # Host stopped reporting: its open segment is about to go
+                        segment.close()
+                        segment.day = None
+            for name in os.listdir(entry.path):
+                if name.endswith('.seg') and name[:-len('.seg')] < cutoff:
+                    os.remove(os.path.join(entry.path, name))
+                    with self.lock:
+                        self.stats['segments_deleted'] += 1
+
+    def run(self):
+        """Retention thread body: one pass at startup, then every retention_interval"""
+        while True:
+            try:
+                self.apply_retention()
+            except OSError as e:
+                print(f"[ERROR] Segment retention failed: {e}")
+            if self.stop_event.wait(self.retention_interval):
+                return
+
+    def start(self):
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the retention thread and close every open segment"""
+        self.stop_event.set()
+        with self.lock:
+            segments = list(self.hosts.values())
+            self.open_files.clear()
+        for segment in segments:
+            with segment.lock:
+                segment.close()
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, hosts=len(self.hosts), open_files=len(self.open_files),
+                        retention_days=self.retention_days)
+
+
+class Segment:
+    """Read-only mapping of one segment file"""
+
+    def __init__(self, path, hostname):
+        self.hostname = hostname
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, field_count, record_size, self.stride, capacity = HEADER.unpack_from(self.mm, 0)
+        if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION or field_count != len(SAMPLE_FIELDS) \
+                or record_size != RECORD.size:
+            self.mm.close()
+            raise ValueError(f"{path} is not a version {SEGMENT_VERSION} segment")
+        self.count = max(len(self.mm) - DATA_OFFSET, 0) // RECORD.size
+        indexed = min(-(-self.count // self.stride), capacity)
+        self.index = struct.unpack_from(f'<{indexed}d', self.mm, HEADER_SIZE)
+
+    def timestamp(self, n):
+        return TIMESTAMP.unpack_from(self.mm, DATA_OFFSET + n * RECORD.size)[0]
+
+    def find(self, epoch):
+        """Number of the first record with timestamp >= epoch (count if none)"""
+        # Last block starting before epoch: the first match is in it or starts the next block
+        block = max(bisect_left(self.index, epoch) - 1, 0)
+        lo = block * self.stride
+        # Blocks past the index capacity are searched as one
+        hi = min((block + 1) * self.stride, self.count) if block + 1 < len(self.index) else self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp(mid) < epoch:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def read(self, first, end):
+        return [decode_record(self.hostname, self.mm, DATA_OFFSET + n * RECORD.size) for n in range(first, end)]
+
+    def close(self):
+        self.mm.close()
+
+
+def read_segments(hostname, since, before, limit, directory=SEGMENT_DIR):
+    """The last `limit` entries of a host with since <= timestamp < before, oldest first"""
+    if not directory or limit <= 0:
+        return []
+    host_dir = host_directory(directory, hostname)
+    try:
+        names = sorted(name for name in os.listdir(host_dir) if name.endswith('.seg'))
+    except OSError:
+        return []
+
+    first_day = day_of(since)
+    last_day = day_of(before) if before < float('inf') else None
+    entries = []
+    # Newest day first, stop once `limit` entries were found
+    for name in reversed(names):
+        day = name[:-len('.seg')]
+        if last_day is not None and day > last_day:
+            continue
+        if day < first_day or len(entries) >= limit:
+            break
+        try:
+            segment = Segment(os.path.join(host_dir, name), hostname)
+        except (OSError, ValueError) as e:
+            print(f"[ERROR] Skipping segment {name} of {hostname}: {e}")
+            continue
+        try:
+            end = segment.find(before)
+            first = max(segment.find(since), end - (limit - len(entries)))
+            entries = segment.read(first, end) + entries
+        finally:
+            segment.close()
+
+    return entries
@@ -0,0 +1,175 @@
+"""
+Production server (Linux/Unix)
+Runs N prefork worker processes that accept requests on one shared listening socket, and a
+single store process that owns the metric store, the ingest queue consumer and the alert
+monitor. Workers talk to the store through a multiprocessing manager, so a dashboard read
+on any worker sees every host and alerts are evaluated exactly once.
+
+Usage:
+    python serve.py --workers 16 --port 5000
+
+app.py keeps working as the single-process development server (and on Windows).
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import secrets
+import signal
+import sys
+import time
+from multiprocessing.managers import BaseManager
+
+from werkzeug.serving import make_server
+
+import alert_system
+import app as monitoring
+import request_log
+from metric_store import MetricStore
+
+
+class StoreManager(BaseManager):
+    """Serves the MetricStore of the store process to the workers"""
+
+
+# The store of the store process (set by init_store_process)
+store = None
+
+
+def get_store():
+    """Manager callable returning the store process's MetricStore"""
+    return store
+
+
+StoreManager.register('get_store', callable=get_store)
+
+
+def init_store_process():
+    """Store process initializer: create the store and start the background jobs"""
+    global store
+
+    # Ctrl+C reaches the whole process group; the master stops the store in order
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    store = MetricStore()
+    store.start_snapshotter()
+    store.set_host_groups(monitoring.read_host_groups())
+    store.start_memory_budget()
+    store.start_history_writer()
+    store.start_segment_writer()
+    store.start_ingest_queue(monitoring.INGEST_QUEUE_SIZE, monitoring.INGEST_BATCH_SIZE)
+
+    print("[STORE] Starting alert monitor...")
+    alert_system.start_alert_monitor(store.current_metrics, interval=30)
+
+
+def run_worker(server, address, authkey):
+    """Worker process body: serve requests against the shared store until told to stop"""
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    manager = StoreManager(address=address, authkey=authkey)
+    manager.connect()
+    monitoring.store = manager.get_store()
+    monitoring.start_last_seen_writer()
+
+    try:
+        server.serve_forever()
+    except (SystemExit, KeyboardInterrupt):
+        pass
+    finally:
+        monitoring.flush_last_seen()
+        request_log.stop()
+        # Skip the atexit handlers inherited from the master
+        os._exit(0)
+
+
+def spawn_worker(server, address, authkey):
+    """Fork one worker, returns its pid"""
+    pid = os.fork()
+    if pid == 0:
+        run_worker(server, address, authkey)
+    return pid
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Monitoring server (multi-process)')
+    parser.add_argument('--host', default=os.environ.get('MONITORING_HOST', '0.0.0.0'), help='Listen address')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('MONITORING_PORT', 5000)), help='Listen port')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('MONITORING_WORKERS', os.cpu_count() or 1)),
+                        help='Number of worker processes (default: number of CPUs)')
+    args = parser.parse_args()
+
+    if not hasattr(os, 'fork'):
+        print("[ERROR] serve.py needs fork(); use app.py on this platform")
+        sys.exit(1)
+
+    print("Starting Monitoring Server (production mode)...")
+    print("Initializing database...")
+    monitoring.init_db()
+
+    # Workers reload their API key registry when this counter changes
+    monitoring.api_key_registry_generation = multiprocessing.Value('L', 0)
+    monitoring.load_api_key_registry()
+
+    # The werkzeug request log would print every request, request_log already samples them
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    authkey = secrets.token_bytes(32)
+    manager = StoreManager(address=('127.0.0.1', 0), authkey=authkey, ctx=multiprocessing.get_context('fork'))
+    manager.start(init_store_process)
+    print("[STORE] Metric store process started")
+
+    # Bind once in the master, every worker accepts on the inherited socket
+    server = make_server(args.host, args.port, monitoring.app)
+
+    workers = set()
+    for _ in range(args.workers):
+        workers.add(spawn_worker(server, manager.address, authkey))
+    print(f"[SERVER] {args.workers} workers listening on http://{args.host}:{args.port}")
+
+    def shutdown(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    # Replace workers that die until asked to stop
+    try:
+        while True:
+            pid, status = os.waitpid(-1, 0)
+            if pid in workers:
+                workers.discard(pid)
+                print(f"[SERVER] Worker {pid} exited (status {status}), restarting")
+                time.sleep(1)
+                workers.add(spawn_worker(server, manager.address, authkey))
+    except (KeyboardInterrupt, ChildProcessError):
+        pass
+
+    print("[SERVER] Shutting down...")
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in workers:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+
+    server.server_close()
+
+    # Store what is still queued, then stop the store process
+    manager.get_store().stop()
+    manager.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Warm restart snapshots
+The history of every host survives a restart in its ring file, but the latest samples, the
+static-section caches, the open rollup buckets and sketches and the alert cooldowns only live
+in memory.
+A background thread writes them to a versioned, compressed snapshot file every
+SNAPSHOT_INTERVAL seconds (and once more at shutdown); the store reloads it at startup, before
+the ingest queue and the alert monitor start, so dashboards and the server-down check resume
+where they left off.
+
+File layout: 4s magic 'MSNP', H version, then zlib-compressed JSON of the state. The file is
+written next to its final name and renamed over it, so a crash never leaves a torn snapshot.
+"""
+import json
+import os
+import struct
+import time
+import zlib
+from datetime import datetime
+from threading import Event, Thread
+
+import alert_system
+
+# Empty SNAPSHOT_PATH disables snapshots
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH', os.path.join('data', 'state.snapshot'))
+SNAPSHOT_INTERVAL = float(os.environ.get('SNAPSHOT_INTERVAL', 30))  # seconds
+
+SNAPSHOT_MAGIC = b'MSNP'
+SNAPSHOT_VERSION = 1
+HEADER = struct.Struct('<4sH')
+
+
+def encode_snapshot(state):
+    """Snapshot file contents for a state dict"""
+    body = json.dumps(state, separators=(',', ':')).encode('utf-8')
+    return HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION) + zlib.compress(body, 1)
+
+
+def decode_snapshot(data):
+    """State dict of a snapshot file, ValueError if it is not a supported snapshot"""
+    magic, version = HEADER.unpack_from(data, 0)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError('not a snapshot file')
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"unsupported snapshot version {version}")
+    return json.loads(zlib.decompress(data[HEADER.size:]))
+
+
+class Snapshotter:
+    """Writes and reloads the in-memory state of a MetricStore"""
+
+    def __init__(self, store, path=SNAPSHOT_PATH, interval=SNAPSHOT_INTERVAL):
+        self.store = store
+        self.path = path
+        self.interval = interval
+        self.stop_event = Event()
+        self.thread = None
+        self.stats = {'written': 0, 'errors': 0, 'last_write_seconds': 0.0, 'last_size': 0,
+                      'loaded_hosts': 0, 'load_seconds': 0.0}
+
+    def write(self):
+        """Write a snapshot (see MetricStore.export_state for what is locked)"""
+        started = time.time()
+        state = self.store.export_state()
+        state['alert_states'] = {key: value.isoformat() for key, value in list(alert_system.alert_states.items())}
+        state['created'] = started
+
+        data = encode_snapshot(state)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+        self.stats['written'] += 1
+        self.stats['last_size'] = len(data)
+        self.stats['last_write_seconds'] = round(time.time() - started, 4)
+
+    def load(self):
+        """Restore the store and alert cooldowns from the last snapshot, False if there is none"""
+        started = time.time()
+        try:
+            with open(self.path, 'rb') as f:
+                state = decode_snapshot(f.read())
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, struct.error, zlib.error) as e:
+            print(f"[ERROR] Ignoring snapshot {self.path}: {e}")
+            return False
+
+        self.store.restore_state(state)
+        for key, value in state.get('alert_states', {}).items():
+            alert_system.alert_states.setdefault(key, datetime.fromisoformat(value))
+
+        self.stats['loaded_hosts'] = len(state.get('current_metrics', {}))
+        self.stats['load_seconds'] = round(time.time() - started, 4)
+        age = started - state.get('created', started)
+        print(f"[STORE] Snapshot loaded: {self.stats['loaded_hosts']} hosts in "
+              f"{self.stats['load_seconds']}s (taken {age:.0f}s ago)")
+        return True
+
+    def run(self):
+        """Snapshot thread body"""
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.write()
+            except Exception as e:
+                self.stats['errors'] += 1
+                print(f"[ERROR] Failed to write snapshot {self.path}: {e}")
+
+    def start(self):
+        if self.interval > 0:
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+        print(f"[STORE] Snapshotting to {self.path} " +
+              (f"every {self.interval}s" if self.interval > 0 else "at shutdown only"))
+
+    def stop(self):
+        """Stop the thread and write a final snapshot"""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=30)
+        try:
+            self.write()
+        except Exception as e:
+            print(f"[ERROR] Failed to write snapshot {self.path}: {e}")
+
+    def get_stats(self):
+        return dict(self.stats, interval=self.interval)
@@ -0,0 +1,246 @@
+"""
+Streaming statistics
+Running aggregates of the main series of every host, updated by the metric store as it stores
+each sample, so /api/servers/<hostname>/stats answers in O(1) for any of its windows:
+
+    mean/variance  Welford's algorithm, with the reverse update when a sample leaves the window
+    min/max        monotonic deques of (sequence, value), the front is the window's extreme;
+                   every sample is pushed and popped at most once
+
+Each host keeps its last `capacity` values per metric (the metric store uses its history size)
+in a circular buffer so a window knows which value leaves it. Windows end at the host's newest
+sample: '5m' and '1h' by time, 'all' holds the last `capacity` samples. Missing values are
+skipped. Samples are taken in arrival order; an out-of-order one simply counts as the newest.
+"""
+import time
+from array import array
+from collections import deque
+
+from rollups import IO_SECTIONS
+
+# Series as 'section.key' (network and disk_io live under 'io' in a sample),
+# cpu.load_* are the entries of cpu.load_average, disk.max_percent the fullest partition's percent
+STATS_METRICS = (
+    'cpu.cpu_percent_total',
+    'memory.memory_percent',
+    'memory.swap_percent',
+    'cpu.load_1m',
+    'cpu.load_5m',
+    'cpu.load_15m',
+    'network.bytes_sent_per_sec',
+    'network.bytes_recv_per_sec',
+    'disk_io.read_bytes_per_sec',
+    'disk_io.write_bytes_per_sec',
+    'disk.max_percent',
+)
+
+LOAD_METRICS = ('cpu.load_1m', 'cpu.load_5m', 'cpu.load_15m')
+
+# (name, seconds), None: the last `capacity` samples
+STATS_WINDOWS = (('5m', 300), ('1h', 3600), ('all', None))
+WINDOW_SECONDS = dict(STATS_WINDOWS)
+
+NAN = float('nan')
+
+
+def sample_values(metrics):
+    """Values of STATS_METRICS in a sample, NaN where missing"""
+    io = metrics.get('io') or {}
+    load_average = (metrics.get('cpu') or {}).get('load_average') or ()
+    values = []
+    for name in STATS_METRICS:
+        section, key = name.split('.', 1)
+        if name in LOAD_METRICS:
+            index = LOAD_METRICS.index(name)
+            value = load_average[index] if index < len(load_average) else None
+        elif name == 'disk.max_percent':
+            partitions = (metrics.get('disk') or {}).get('partitions') or []
+            value = max((partition['percent'] for partition in partitions if partition.get('percent') is not None),
+                        default=None)
+        else:
+            source = io.get(section) if section in IO_SECTIONS else metrics.get(section)
+            value = (source or {}).get(key)
+        try:
+            values.append(float(value))
+        except (TypeError, ValueError):
+            values.append(NAN)
+    return values
+
+
+class RunningStats:
+    """Count, mean, M2 and monotonic min/max deques of one metric over one window"""
+
+    __slots__ = ('count', 'mean', 'm2', 'minima', 'maxima')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minima = deque()  # (sequence, value), values increasing
+        self.maxima = deque()  # (sequence, value), values decreasing
+
+    def add(self, sequence, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+        while self.minima and self.minima[-1][1] >= value:
+            self.minima.pop()
+        self.minima.append((sequence, value))
+        while self.maxima and self.maxima[-1][1] <= value:
+            self.maxima.pop()
+        self.maxima.append((sequence, value))
+
+    def remove(self, sequence, value):
+        """Take out the oldest sample of the window (`value` at `sequence`)"""
+        if self.count <= 1:
+            self.count, self.mean, self.m2 = 0, 0.0, 0.0
+        else:
+            mean = (self.count * self.mean - value) / (self.count - 1)
+            # Rounding can leave M2 slightly negative once the values left are all equal
+            self.m2 = max(self.m2 - (value - self.mean) * (value - mean), 0.0)
+            self.mean = mean
+            self.count -= 1
+
+        if self.minima and self.minima[0][0] <= sequence:
+            self.minima.popleft()
+        if self.maxima and self.maxima[0][0] <= sequence:
+            self.maxima.popleft()
+
+    def result(self, current):
+        if not self.count:
+            return {'count': 0, 'current': current, 'average': None, 'stddev': None, 'min': None, 'max': None}
+        return {
+            'count': self.count,
+            'current': current,
+            'average': self.mean,
+            'stddev': (self.m2 / (self.count - 1)) ** 0.5 if self.count > 1 else 0.0,
+            'min': self.minima[0][1],
+            'max': self.maxima[0][1]
+        }
+
+
+class Window:
+    """Sequences first..next-1 of a host's samples, with running stats per metric"""
+
+    __slots__ = ('seconds', 'first', 'stats')
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.first = 0
+        self.stats = [RunningStats() for _ in STATS_METRICS]
+
+
+class HostStats:
+    """Last `capacity` values of every metric of a host and the windows over them
+
+    One writer per host (the metric store's shard lock guarantees it). Readers retry when
+    `version` changed or was odd while they read (a seqlock), so they never take a lock.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.epochs = array('d', bytes(8 * capacity))
+        self.values = [array('d', [NAN]) * capacity for _ in STATS_METRICS]
+        self.next = 0  # sequence of the next sample
+        self.latest = float('-inf')
+        self.version = 0
+        self.windows = {name: Window(seconds) for name, seconds in STATS_WINDOWS}
+
+    def add(self, epoch, values):
+        sequence = self.next
+        self.latest = latest = max(self.latest, epoch)
+        self.version += 1
+
+        # Expire before the new sample overwrites the slot of the oldest one
+        for window in self.windows.values():
+            while window.first < sequence and (
+                    window.first <= sequence - self.capacity
+                    or (window.seconds is not None and self.epochs[window.first % self.capacity] < latest - window.seconds)):
+                slot = window.first % self.capacity
+                for stats, column in zip(window.stats, self.values):
+                    value = column[slot]
+                    if value == value:
+                        stats.remove(window.first, value)
+                window.first += 1
+
+        slot = sequence % self.capacity
+        self.epochs[slot] = epoch
+        for column, value in zip(self.values, values):
+            column[slot] = value
+        for window in self.windows.values():
+            for stats, value in zip(window.stats, values):
+                if value == value:
+                    stats.add(sequence, value)
+
+        self.next = sequence + 1
+        self.version += 1
+
+    def result(self, window_name):
+        """{metric: stats} of a window plus its sample count, None while the writer interferes"""
+        version = self.version
+        if version % 2:
+            return None
+        window = self.windows[window_name]
+        slot = (self.next - 1) % self.capacity
+        result = {
+            'samples': self.next - window.first,
+            'latest': self.latest,
+            'metrics': {name: stats.result(column[slot] if column[slot] == column[slot] else None)
+                        for name, stats, column in zip(STATS_METRICS, window.stats, self.values)}
+        }
+        return result if self.version == version else None
+
+    def current(self):
+        """Values of the newest sample (NaN where missing)"""
+        slot = (self.next - 1) % self.capacity
+        return [column[slot] for column in self.values]
+
+    def means(self, window_name):
+        """Mean of every metric over a window (NaN where it has no values)"""
+        return [stats.mean if stats.count else NAN for stats in self.windows[window_name].stats]
+
+    def nbytes(self):
+        """Approximate memory of the circular buffers and the deques"""
+        deques = sum(len(stats.minima) + len(stats.maxima)
+                     for window in self.windows.values() for stats in window.stats)
+        return 8 * self.capacity * (len(self.values) + 1) + 64 * deques
+
+
+class StreamingStats:
+    """Streaming statistics of every host (one writer per host: the metric store)"""
+
+    def __init__(self, capacity):
+        self.capacity = max(capacity, 1)
+        self.hosts = {}
+
+    def add(self, hostname, epoch, metrics):
+        series = self.hosts.get(hostname)
+        if series is None:
+            series = self.hosts.setdefault(hostname, HostStats(self.capacity))
+        series.add(epoch, sample_values(metrics))
+
+    def seed(self, hostname, entries):
+        """Start a host's statistics from its stored history (oldest first), e.g. after a restart"""
+        series = self.hosts.setdefault(hostname, HostStats(self.capacity))
+        for epoch, metrics in entries[-self.capacity:]:
+            series.add(epoch, sample_values(metrics))
+
+    def get(self, hostname, window):
+        """Statistics of a host over a window (see HostStats.result), None if it has no samples"""
+        series = self.hosts.get(hostname)
+        if series is None or not series.next:
+            return None
+        for _ in range(100):
+            try:
+                result = series.result(window)
+            except IndexError:  # a deque emptied under the reader
+                result = None
+            if result is not None:
+                return result
+            time.sleep(0)
+        return None
+
+    def nbytes(self):
+        return sum(series.nbytes() for series in list(self.hosts.values()))
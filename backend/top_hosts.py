@@ -0,0 +1,123 @@
+"""
+Top hosts
+Hosts ranked by metric, for /api/top: one ordered index per (metric, window) kept sorted by
+the metric store as it stores each sample, so the K hottest hosts are the last K entries of a
+list instead of a sort of the whole fleet per request. Updating a host's rank is a binary search
+plus a list insert/delete (a memmove of pointers, microseconds for thousands of hosts).
+
+Windowed values are the host's mean over a streaming_stats window, which ends at its newest
+sample: the ranking changes only when a host reports. Hosts that stopped reporting keep their
+entries and are skipped when read.
+"""
+import math
+from bisect import bisect_left, insort
+from threading import Lock
+
+# Ranking name -> series summed into its value (see streaming_stats.STATS_METRICS)
+TOP_METRICS = {
+    'cpu': ('cpu.cpu_percent_total',),
+    'memory': ('memory.memory_percent',),
+    'swap': ('memory.swap_percent',),
+    'disk': ('disk.max_percent',),
+    'load': ('cpu.load_1m',),
+    'network': ('network.bytes_sent_per_sec', 'network.bytes_recv_per_sec'),
+    'network_sent': ('network.bytes_sent_per_sec',),
+    'network_recv': ('network.bytes_recv_per_sec',),
+}
+
+# 'current': the newest sample, others are streaming_stats windows
+TOP_WINDOWS = ('current', '5m', '1h')
+
+NAN = float('nan')
+
+
+class RankedIndex:
+    """Hosts in ascending order of one value, the hottest at the end
+
+    Writers of different hosts may update concurrently (they hold different shard locks), so
+    updates take the index's lock. Readers slice the list without it: a slice is atomic, a host
+    being moved may be missing from it or appear twice.
+    """
+
+    __slots__ = ('lock', 'keys', 'values')
+
+    def __init__(self):
+        self.lock = Lock()
+        self.keys = []  # (value, hostname), sorted
+        self.values = {}  # hostname -> its value in keys
+
+    def set(self, hostname, value):
+        """Move a host to its new value (NaN: take it out of the ranking)"""
+        with self.lock:
+            previous = self.values.get(hostname)
+            if previous == value:
+                return
+            if previous is not None:
+                del self.keys[bisect_left(self.keys, (previous, hostname))]
+            if value == value:
+                insort(self.keys, (value, hostname))
+                self.values[hostname] = value
+            else:
+                self.values.pop(hostname, None)
+
+    def top(self, k, include):
+        """[(hostname, value)] of the k highest hosts for which include(hostname) is true"""
+        result = []
+        seen = set()
+        size = 2 * k
+        while True:
+            keys = self.keys[-size:]
+            result.clear()
+            seen.clear()
+            for value, hostname in reversed(keys):
+                if hostname not in seen and include(hostname):
+                    seen.add(hostname)
+                    result.append((hostname, value))
+                    if len(result) == k:
+                        return result
+            if len(keys) < size:
+                return result
+            # Too many hosts skipped: look further down
+            size *= 4
+
+    def nbytes(self):
+        return 120 * len(self.values)
+
+
+def ranking_value(values, indexes):
+    """Sum of the series of a ranking, NaN if any is missing"""
+    total = 0.0
+    for index in indexes:
+        value = values[index]
+        if value != value:
+            return NAN
+        total += value
+    return total
+
+
+class TopHosts:
+    """Ordered indexes of every TOP_METRICS ranking over every TOP_WINDOWS window"""
+
+    def __init__(self, metric_names):
+        # Positions of the ranking series in streaming_stats.STATS_METRICS order
+        self.metric_indexes = {name: [metric_names.index(series) for series in series_names]
+                               for name, series_names in TOP_METRICS.items()}
+        self.indexes = {(name, window): RankedIndex() for name in TOP_METRICS for window in TOP_WINDOWS}
+        self.epochs = {}  # hostname -> epoch of its newest sample
+
+    def update(self, hostname, epoch, series):
+        """Re-rank a host after its sample went into its streaming_stats.HostStats `series`"""
+        self.epochs[hostname] = max(self.epochs.get(hostname, -math.inf), epoch)
+        for window in TOP_WINDOWS:
+            values = series.current() if window == 'current' else series.means(window)
+            for name, indexes in self.metric_indexes.items():
+                self.indexes[name, window].set(hostname, ranking_value(values, indexes))
+
+    def top(self, metric, window, k, since):
+        """[(hostname, value, epoch)] of the k hottest hosts that reported at or after `since`"""
+        epochs = self.epochs
+        ranked = self.indexes[metric, window].top(k, lambda hostname: epochs.get(hostname, -math.inf) >= since)
+        return [(hostname, value, epochs[hostname]) for hostname, value in ranked]
+
+    def nbytes(self):
+        return sum(index.nbytes() for index in self.indexes.values()) + 100 * len(self.epochs)
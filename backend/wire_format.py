@@ -0,0 +1,360 @@
+"""
+Wire format for agent payloads
+Decodes the Content-Encoding of metric POSTs with a hard limit on decompressed size,
+and the compact binary sample encoding (application/vnd.monitoring.sample)
+"""
+import json
+import math
+import os
+import struct
+import zlib
+from datetime import datetime, timezone
+
+# zstd is optional, gzip is always available
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
+# Largest body accepted after decompression (protects against decompression bombs)
+MAX_DECOMPRESSED_SIZE = int(os.environ.get('MAX_DECOMPRESSED_SIZE', 8 * 1024 * 1024))
+
+# Advertised to agents in the Accept-Encoding response header, preferred first
+SUPPORTED_ENCODINGS = ['zstd', 'gzip'] if HAS_ZSTD else ['gzip']
+
+CHUNK_SIZE = 64 * 1024
+
+# ==================== BINARY SAMPLE FORMAT ====================
+#
+# A body is one or more concatenated records (several only on /api/metrics/batch).
+# All integers are little-endian. Record layout:
+#
+#   header      4s magic 'MSMP', B version, B flags, I record length (incl. header)
+#   numbers     d timestamp (epoch seconds, UTC), Q missing-value mask (bit i = SAMPLE_FIELDS[i],
+#               bit len(SAMPLE_FIELDS) = load average), one q ('i' fields) or d per SAMPLE_FIELDS
+#               entry, 3d load average
+#   cores       H count, count x H per-core CPU percent in hundredths
+#   partitions  H count, per partition QQQ total/used/free, H percent in hundredths,
+#               H length + UTF-8 'device\0mountpoint\0fstype'
+#               or, with FLAG_PARTITION_USAGE (version 2), QQH used/free/percent only: the agent
+#               omitted the unchanged partition layout and the sample carries disk['usage'] instead
+#   extras      I length + UTF-8 JSON object with the remaining top-level sections (system, hostname)
+#
+# The agent (agent/monitor_agent.py) carries its own encoder and must be kept in sync.
+
+BINARY_CONTENT_TYPE = 'application/vnd.monitoring.sample'
+
+# Advertised to agents in the Accept-Post response header
+SUPPORTED_CONTENT_TYPES = ['application/json', BINARY_CONTENT_TYPE]
+
+BINARY_MAGIC = b'MSMP'
+BINARY_VERSIONS = (1, 2)
+
+# Version 2 flag: partitions carry usage only (delta protocol)
+FLAG_PARTITION_USAGE = 0x01
+
+# (section, key, kind): 'i' integer, 'f' float (None when missing), 'o' float omitted when missing.
+# Fields of a section must stay contiguous.
+SAMPLE_FIELDS = [
+    ('cpu', 'cpu_percent_total', 'f'),
+    ('cpu', 'cpu_count_logical', 'i'),
+    ('cpu', 'cpu_count_physical', 'i'),
+    ('cpu', 'cpu_freq_current', 'f'),
+    ('cpu', 'cpu_freq_min', 'f'),
+    ('cpu', 'cpu_freq_max', 'f'),
+    ('memory', 'memory_total', 'i'),
+    ('memory', 'memory_available', 'i'),
+    ('memory', 'memory_used', 'i'),
+    ('memory', 'memory_percent', 'f'),
+    ('memory', 'memory_free', 'i'),
+    ('memory', 'swap_total', 'i'),
+    ('memory', 'swap_used', 'i'),
+    ('memory', 'swap_free', 'i'),
+    ('memory', 'swap_percent', 'f'),
+    ('network', 'bytes_sent', 'i'),
+    ('network', 'bytes_recv', 'i'),
+    ('network', 'packets_sent', 'i'),
+    ('network', 'packets_recv', 'i'),
+    ('network', 'errin', 'i'),
+    ('network', 'errout', 'i'),
+    ('network', 'dropin', 'i'),
+    ('network', 'dropout', 'i'),
+    ('network', 'bytes_sent_per_sec', 'o'),
+    ('network', 'bytes_recv_per_sec', 'o'),
+    ('disk_io', 'read_count', 'i'),
+    ('disk_io', 'write_count', 'i'),
+    ('disk_io', 'read_bytes', 'i'),
+    ('disk_io', 'write_bytes', 'i'),
+    ('disk_io', 'read_time', 'i'),
+    ('disk_io', 'write_time', 'i'),
+    ('disk_io', 'read_bytes_per_sec', 'o'),
+    ('disk_io', 'write_bytes_per_sec', 'o'),
+]
+
+# Top-level keys described by the schema, everything else travels in extras
+SCHEMA_SECTIONS = ('timestamp', 'cpu', 'memory', 'disk', 'io')
+
+
+
+def _section_slices(fields):
+    """Group fields into [section, keys, start, stop] runs of the numeric block"""
+    slices = []
+    for index, (section, key, _) in enumerate(fields):
+        if slices and slices[-1][0] == section:
+            slices[-1][1].append(key)
+            slices[-1][3] = index + 1
+        else:
+            slices.append([section, [key], index, index + 1])
+    return slices
+
+
+SECTION_SLICES = _section_slices(SAMPLE_FIELDS)
+LOAD_AVERAGE_BIT = len(SAMPLE_FIELDS)
+
+HEADER = struct.Struct('<4sBBI')
+NUMBERS = struct.Struct('<dQ' + ''.join('q' if kind == 'i' else 'd' for _, _, kind in SAMPLE_FIELDS) + '3d')
+COUNT = struct.Struct('<H')
+PARTITION = struct.Struct('<QQQHH')
+PARTITION_USAGE = struct.Struct('<QQH')
+EXTRAS_LENGTH = struct.Struct('<I')
+
+
+class PayloadTooLarge(Exception):
+    """Decoded body exceeds the configured limit"""
+
+
+class UnsupportedEncoding(Exception):
+    """Content-Encoding the server cannot decode"""
+
+
+class InvalidSample(ValueError):
+    """Sample whose sections do not have the types the store reads them as"""
+
+
+# Sections the store reads as objects, top level and under 'io'
+OBJECT_SECTIONS = ('cpu', 'memory', 'disk', 'io', 'system', 'static')
+IO_OBJECT_SECTIONS = ('network', 'disk_io')
+
+# Partition values read as numbers, and as names
+PARTITION_NUMBERS = ('total', 'used', 'free', 'percent')
+PARTITION_NAMES = ('device', 'mountpoint', 'fstype')
+
+
+def is_number(value):
+    """Finite int or float that fits the 64-bit ring columns"""
+    if isinstance(value, float):
+        return math.isfinite(value)
+    return isinstance(value, int) and -2 ** 63 <= value < 2 ** 64
+
+
+def number_list(value, length=None):
+    return isinstance(value, list) and all(is_number(item) for item in value) \
+        and (length is None or len(value) == length)
+
+
+def validate_sample(sample):
+    """Raise InvalidSample unless every section the store reads has the expected type
+
+    Sections are optional; present ones must be objects, SAMPLE_FIELDS values numbers or null,
+    partitions a list of objects. Numbers must be finite (JSON accepts Infinity, NaN and 1e400).
+    """
+    for section in OBJECT_SECTIONS:
+        if section in sample and not isinstance(sample[section], dict):
+            raise InvalidSample(f"'{section}' must be an object")
+    io = sample.get('io', {})
+    for section in IO_OBJECT_SECTIONS:
+        if section in io and not isinstance(io[section], dict):
+            raise InvalidSample(f"'io.{section}' must be an object")
+
+    sections = {'cpu': sample.get('cpu', {}), 'memory': sample.get('memory', {}),
+                'network': io.get('network', {}), 'disk_io': io.get('disk_io', {})}
+    for section, key, _ in SAMPLE_FIELDS:
+        value = sections[section].get(key)
+        if value is not None and not is_number(value):
+            raise InvalidSample(f"'{section}.{key}' must be a finite number")
+
+    cpu = sections['cpu']
+    if cpu.get('load_average') is not None and not number_list(cpu['load_average']):
+        raise InvalidSample("'cpu.load_average' must be a list of finite numbers")
+    if cpu.get('cpu_percent_per_core') is not None and not number_list(cpu['cpu_percent_per_core']):
+        raise InvalidSample("'cpu.cpu_percent_per_core' must be a list of finite numbers")
+
+    disk = sample.get('disk', {})
+    if 'partitions' in disk:
+        partitions = disk['partitions']
+        if not isinstance(partitions, list) or not all(isinstance(partition, dict) for partition in partitions):
+            raise InvalidSample("'disk.partitions' must be a list of objects")
+        for partition in partitions:
+            for key in PARTITION_NUMBERS:
+                if partition.get(key) is not None and not is_number(partition[key]):
+                    raise InvalidSample(f"'disk.partitions[].{key}' must be a finite number")
+            for key in PARTITION_NAMES:
+                if partition.get(key) is not None and not isinstance(partition[key], str):
+                    raise InvalidSample(f"'disk.partitions[].{key}' must be a string")
+    if 'usage' in disk:
+        usage = disk['usage']
+        if not isinstance(usage, list) or not all(number_list(entry, 3) for entry in usage):
+            raise InvalidSample("'disk.usage' must be a list of [used, free, percent]")
+
+
+def decode_body(data, content_encoding=None, max_size=MAX_DECOMPRESSED_SIZE):
+    """Return the decompressed request body, never producing more than max_size bytes"""
+    encoding = (content_encoding or 'identity').strip().lower()
+
+    if encoding in ('', 'identity'):
+        if len(data) > max_size:
+            raise PayloadTooLarge(f"Body exceeds {max_size} bytes")
+        return data
+
+    if encoding in ('gzip', 'x-gzip'):
+        return _decode_gzip(data, max_size)
+
+    if encoding == 'zstd' and HAS_ZSTD:
+        return _decode_zstd(data, max_size)
+
+    raise UnsupportedEncoding(f"Unsupported Content-Encoding: {encoding}")
+
+
+def _decode_gzip(data, max_size):
+    """Inflate a gzip body in bounded steps"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    try:
+        body = decompressor.decompress(data, max_size + 1)
+    except zlib.error as e:
+        raise ValueError(f"Invalid gzip body: {e}")
+
+    if len(body) > max_size or decompressor.unconsumed_tail:
+        raise PayloadTooLarge(f"Decompressed body exceeds {max_size} bytes")
+
+    if not decompressor.eof:
+        raise ValueError("Truncated gzip body")
+
+    return body
+
+
+def _decode_zstd(data, max_size):
+    """Decompress a zstd body, reading at most max_size + 1 bytes"""
+    chunks = []
+    total = 0
+
+    try:
+        with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+            while True:
+                chunk = reader.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                total += len(chunk)
+                if total > max_size:
+                    raise PayloadTooLarge(f"Decompressed body exceeds {max_size} bytes")
+                chunks.append(chunk)
+    except zstandard.ZstdError as e:
+        raise ValueError(f"Invalid zstd body: {e}")
+
+    return b''.join(chunks)
+
+
+def decode_samples(data):
+    """Decode a body of concatenated binary records into sample dicts"""
+    samples = []
+    offset = 0
+
+    while offset < len(data):
+        sample, offset = decode_sample(data, offset)
+        samples.append(sample)
+
+    return samples
+
+
+def decode_sample(data, offset=0):
+    """Decode one binary record starting at offset, returns (sample, next_offset)"""
+    try:
+        magic, version, flags, length = HEADER.unpack_from(data, offset)
+    except struct.error:
+        raise ValueError("Truncated binary record header")
+
+    if magic != BINARY_MAGIC:
+        raise ValueError("Not a binary metrics record")
+    if version not in BINARY_VERSIONS:
+        raise ValueError(f"Unsupported binary record version {version}")
+
+    end = offset + length
+    if length < HEADER.size or end > len(data):
+        raise ValueError("Truncated binary record")
+
+    try:
+        sample = _decode_record(data, offset + HEADER.size, end, flags if version >= 2 else 0)
+    except (struct.error, UnicodeDecodeError, IndexError, OverflowError, OSError) as e:
+        raise ValueError(f"Corrupt binary record: {e}")
+
+    return sample, end
+
+
+def _decode_record(data, pos, end, flags):
+    """Decode the body of a record (after the header)"""
+    numbers = NUMBERS.unpack_from(data, pos)
+    pos += NUMBERS.size
+    timestamp, missing = numbers[0], numbers[1]
+    fields = numbers[2:]
+
+    sections = {}
+    for section, keys, start, stop in SECTION_SLICES:
+        sections[section] = dict(zip(keys, fields[start:stop]))
+
+    if missing:
+        for index, (section, key, kind) in enumerate(SAMPLE_FIELDS):
+            if missing >> index & 1:
+                if kind == 'o':
+                    del sections[section][key]
+                else:
+                    sections[section][key] = None
+
+    cpu = sections['cpu']
+    cpu['load_average'] = None if missing >> LOAD_AVERAGE_BIT & 1 else list(fields[-3:])
+
+    core_count, = COUNT.unpack_from(data, pos)
+    pos += COUNT.size
+    cores = struct.unpack_from('<%dH' % core_count, data, pos)
+    pos += 2 * core_count
+    cpu['cpu_percent_per_core'] = [value / 100 for value in cores]
+
+    partition_count, = COUNT.unpack_from(data, pos)
+    pos += COUNT.size
+    partitions = []
+    usage = []
+    for _ in range(partition_count if flags & FLAG_PARTITION_USAGE else 0):
+        used, free, percent = PARTITION_USAGE.unpack_from(data, pos)
+        pos += PARTITION_USAGE.size
+        usage.append([used, free, percent / 100])
+    for _ in range(0 if flags & FLAG_PARTITION_USAGE else partition_count):
+        total, used, free, percent, names_length = PARTITION.unpack_from(data, pos)
+        pos += PARTITION.size
+        device, mountpoint, fstype = data[pos:pos + names_length].decode('utf-8').split('\0')
+        pos += names_length
+        partitions.append({
+            'device': device,
+            'mountpoint': mountpoint,
+            'fstype': fstype,
+            'total': total,
+            'used': used,
+            'free': free,
+            'percent': percent / 100
+        })
+
+    extras_length, = EXTRAS_LENGTH.unpack_from(data, pos)
+    pos += EXTRAS_LENGTH.size
+    if pos + extras_length != end:
+        raise ValueError("Binary record length does not match its contents")
+    sample = json.loads(data[pos:pos + extras_length]) if extras_length else {}
+    if not isinstance(sample, dict):
+        raise ValueError("Binary record extras must be a JSON object")
+
+    sample.update({
+        'timestamp': datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None).isoformat(),
+        'cpu': cpu,
+        'memory': sections['memory'],
+        'disk': {'usage': usage} if flags & FLAG_PARTITION_USAGE else {'partitions': partitions},
+        'io': {'network': sections['network'], 'disk_io': sections['disk_io']}
+    })
+    return sample
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark: per-host history as a deque of sample dicts vs the columnar ring
+Measures bytes per stored sample and projects the total for a fleet
+
+Run with: python bench_store_memory.py [--cores 16] [--partitions 6] [--samples 1000] [--hosts 2000]
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+from collections import deque
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, 'backend'))
+
+import ring_buffer
+from bench_wire_format import build_sample
+
+
+def make_samples(template, count):
+    """Distinct samples as the server sees them after json.loads of an agent POST"""
+    body = json.dumps(template)
+    start = datetime(2026, 10, 18)
+    samples = []
+    for i in range(count):
+        sample = json.loads(body)
+        sample['timestamp'] = (start + timedelta(seconds=5 * i)).isoformat()
+        sample['cpu']['cpu_percent_total'] = (i * 7.3) % 100
+        sample['hostname'] = 'web-01'
+        sample['server_received_at'] = datetime.utcnow().isoformat()
+        samples.append(sample)
+    return samples
+
+
+def deque_bytes_per_sample(template, count):
+    """Python heap used by a deque(maxlen=count) full of sample dicts"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    history = deque(make_samples(template, count), maxlen=count)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(history) == count
+    return (after - before) / count
+
+
+def ring_bytes_per_sample(template, count):
+    """Size of a full ring file per sample (the mapped pages are the whole cost)"""
+    directory = tempfile.mkdtemp()
+    try:
+        rings = ring_buffer.RingDirectory(directory, capacity=count, writable=True)
+        for sample in make_samples(template, count):
+            rings.append('web-01', sample, ring_buffer.parse_timestamp(sample['timestamp']))
+        assert len(rings.read('web-01')) == count
+        rings.close()
+        return os.path.getsize(ring_buffer.ring_path(directory, 'web-01')) / count
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='History memory per sample: dict deque vs columnar ring')
+    parser.add_argument('--cores', type=int, default=16)
+    parser.add_argument('--partitions', type=int, default=6)
+    parser.add_argument('--samples', type=int, default=1000, help='History length per host')
+    parser.add_argument('--hosts', type=int, default=2000, help='Fleet size for the projection')
+    args = parser.parse_args()
+
+    template = build_sample(args.cores, args.partitions)
+    results = {
+        'dict deque': deque_bytes_per_sample(template, args.samples),
+        'columnar ring': ring_bytes_per_sample(template, args.samples)
+    }
+
+    print("=" * 60)
+    print(f"History memory ({args.cores} cores, {args.partitions} partitions, {args.samples} samples/host)")
+    print("=" * 60)
+    print(f"{'store':<14} {'bytes/sample':>13} {'per host':>12} {f'{args.hosts} hosts':>14}")
+    for name, per_sample in results.items():
+        per_host = per_sample * args.samples
+        print(f"{name:<14} {per_sample:>13.0f} {per_host / 1024:>9.0f} KiB {per_host * args.hosts / 1024 ** 3:>10.2f} GiB")
+    print("-" * 60)
+    print(f"ratio {results['dict deque'] / results['columnar ring']:.1f}x smaller")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark: JSON vs binary sample encoding
+Measures payload size and per-sample encode (agent) / decode (server) time
+
+Run with: python bench_wire_format.py [--cores 16] [--partitions 6] [--number 20000]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+import zlib
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, 'agent'))
+sys.path.insert(0, os.path.join(ROOT, 'backend'))
+
+import monitor_agent
+import wire_format
+from test_wire_format import make_sample
+
+
+def build_sample(cores, partitions):
+    """Scale the test sample to the requested core and partition count"""
+    sample = make_sample()
+    sample['cpu']['cpu_percent_per_core'] = [round(5.0 + i * 1.7 % 90, 1) for i in range(cores)]
+    template = sample['disk']['partitions'][0]
+    sample['disk']['partitions'] = [
+        dict(template, device=f'/dev/sd{chr(97 + i)}1', mountpoint='/' if i == 0 else f'/mnt/vol{i}')
+        for i in range(partitions)
+    ]
+    return sample
+
+
+def per_sample_us(func, number):
+    """Best-of-5 time per call in microseconds"""
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='JSON vs binary wire format microbenchmark')
+    parser.add_argument('--cores', type=int, default=16)
+    parser.add_argument('--partitions', type=int, default=6)
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    sample = build_sample(args.cores, args.partitions)
+    json_body = json.dumps(sample).encode('utf-8')
+    binary_body = monitor_agent.encode_binary_sample(sample)
+    assert wire_format.decode_samples(binary_body) == [sample]
+
+    results = {
+        'json': {
+            'size': len(json_body),
+            'gzip': len(zlib.compress(json_body, 6)),
+            'encode': per_sample_us(lambda: json.dumps(sample).encode('utf-8'), args.number),
+            'decode': per_sample_us(lambda: json.loads(json_body), args.number),
+        },
+        'binary': {
+            'size': len(binary_body),
+            'gzip': len(zlib.compress(binary_body, 6)),
+            'encode': per_sample_us(lambda: monitor_agent.encode_binary_sample(sample), args.number),
+            'decode': per_sample_us(lambda: wire_format.decode_samples(binary_body), args.number),
+        }
+    }
+
+    print("=" * 60)
+    print(f"Wire format benchmark ({args.cores} cores, {args.partitions} partitions, {args.number} iterations)")
+    print("=" * 60)
+    print(f"{'format':<8} {'bytes':>8} {'gzip':>8} {'encode us':>11} {'decode us':>11}")
+    for name, result in results.items():
+        print(f"{name:<8} {result['size']:>8} {result['gzip']:>8} {result['encode']:>11.2f} {result['decode']:>11.2f}")
+
+    json_result, binary_result = results['json'], results['binary']
+    print("-" * 60)
+    print(f"size ratio   {json_result['size'] / binary_result['size']:.2f}x smaller")
+    print(f"encode ratio {json_result['encode'] / binary_result['encode']:.2f}x")
+    print(f"decode ratio {json_result['decode'] / binary_result['decode']:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -474,15 +474,31 @@ function toggleGroup(groupId) {
 }
 
 // Update statistics
-function updateStats() {
-    const total = hosts.length;
-    const online = hosts.filter(h => h.status === 'online').length;
-    const offline = total - online;
+async function updateStats() {
+    let total = hosts.length;
+    let online = hosts.filter(h => h.status === 'online').length;
+    let groupCount = groups.length;
+    
+    // Counts come from the server-side fleet summary (cached there, same cost for any fleet size)
+    try {
+        const response = await fetch(`${API_BASE}/api/fleet/summary`, {
+            credentials: 'include'
+        });
+        
+        if (response.ok) {
+            const summary = await response.json();
+            total = summary.registered;
+            online = summary.status.online;
+            groupCount = summary.groups;
+        }
+    } catch (error) {
+        console.error('Error loading fleet summary:', error);
+    }
     
     document.getElementById('totalHosts').textContent = total;
     document.getElementById('onlineHosts').textContent = online;
-    document.getElementById('offlineHosts').textContent = offline;
-    document.getElementById('totalGroups').textContent = groups.length;
+    document.getElementById('offlineHosts').textContent = Math.max(total - online, 0);
+    document.getElementById('totalGroups').textContent = groupCount;
 }
 
 // Refresh current view (called during auto-refresh)
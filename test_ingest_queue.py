@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Tests for the asynchronous ingest queue
+Fills a queue without a consumer thread and checks what coalescing keeps
+
+Run with: python test_ingest_queue.py  (or pytest test_ingest_queue.py)
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, 'backend'))
+
+from ingest_queue import IngestQueue
+
+
+def drained(queue):
+    stored = []
+    queue.store_batch = stored.extend
+    queue.drain()
+    return stored
+
+
+def test_live_samples_coalesce_newest_wins():
+    queue = IngestQueue(None, maxsize=3)
+    for n in range(5):
+        queue.put('web-01', n)
+    assert drained(queue) == [('web-01', 3), ('web-01', 4)]
+    stats = queue.get_stats()
+    assert stats['dropped'] == 3
+    assert stats['dropped_by_host'] == {'web-01': 3}
+
+
+def test_batch_is_never_coalesced():
+    queue = IngestQueue(None, maxsize=60)
+    assert queue.put_many([('web-01', n) for n in range(50)], live=False)
+    # Live samples of other hosts past maxsize do not eat into the accepted batch
+    for n in range(20):
+        queue.put('db-01', n)
+    queue.put('web-01', 'live')
+    stored = drained(queue)
+    assert [sample for hostname, sample in stored if hostname == 'web-01'] == list(range(50)) + ['live']
+    assert queue.get_stats()['dropped_by_host'].get('web-01', 0) == 0
+
+
+def test_batch_that_does_not_fit_is_refused_whole():
+    queue = IngestQueue(None, maxsize=60)
+    assert queue.put_many([('web-01', n) for n in range(50)], live=False)
+    assert not queue.put_many([('web-02', n) for n in range(50)], live=False)
+    stats = queue.get_stats()
+    assert (stats['depth'], stats['refused_batches'], stats['refused_samples']) == (50, 1, 50)
+
+
+def test_empty_queue_takes_a_batch_larger_than_maxsize():
+    queue = IngestQueue(None, maxsize=10)
+    assert queue.put_many([('web-01', n) for n in range(50)], live=False)
+    assert len(drained(queue)) == 50
+
+
+if __name__ == '__main__':
+    tests = [(name, func) for name, func in sorted(globals().items()) if name.startswith('test_')]
+    failed = 0
+
+    for name, func in tests:
+        try:
+            func()
+            print(f"✓ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"✗ {name}: {type(e).__name__}: {e}")
+
+    print(f"\n{len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Tests for the global memory budget
+Fills a MetricStore over a temporary ring directory and runs budget checks against it, with the
+budget set in bytes relative to what the store measures
+
+Run with: python test_memory_budget.py  (or pytest test_memory_budget.py)
+"""
+import os
+import sys
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, 'backend'))
+
+import alert_system
+from gorilla import CompressedHistory
+from memory_budget import MemoryBudget, PRIORITY_BUSY, PRIORITY_FLAGGED, PRIORITY_NORMAL, host_priorities
+from test_metric_store import new_store, sample_at
+
+HOSTS = {'web-01': 10.0, 'busy-01': 95.0, 'flagged-01': 10.0}
+
+
+def filled_store(count=20):
+    """Store with three hosts, five closed compressed chunks each"""
+    store = new_store()
+    store.compressed = CompressedHistory(hours=10, chunk_size=4)
+    start = time.time() - count
+    for n in range(count):
+        store.submit([(hostname, sample_at(start + n, cpu=cpu)) for hostname, cpu in HOSTS.items()])
+    return store
+
+
+def budget_for(store, excess, **limits):
+    """MemoryBudget whose budget is `excess` bytes below what the store uses now"""
+    budget = MemoryBudget(store, 0, **limits)
+    usage = budget.measure()
+    used = budget.ring_bytes_per_sample * store.rings.capacity + sum(usage.values()) - usage['rings']
+    budget.budget = int(used - excess)
+    return budget
+
+
+def chunk_counts(store):
+    return {hostname: len(series.chunks) for hostname, series in store.compressed.hosts.items()}
+
+
+def with_flagged_host(test):
+    """Run `test` with an alert raised for flagged-01 just now"""
+    def run():
+        alert_system.alert_states['flagged-01_cpu'] = datetime.utcnow()
+        try:
+            test()
+        finally:
+            alert_system.alert_states.pop('flagged-01_cpu', None)
+    run.__name__ = test.__name__
+    return run
+
+
+@with_flagged_host
+def test_host_priorities():
+    store = filled_store(count=4)
+    assert host_priorities(store.snapshot_current()) == {
+        'web-01': PRIORITY_NORMAL, 'busy-01': PRIORITY_BUSY, 'flagged-01': PRIORITY_FLAGGED}
+
+
+def test_within_budget_nothing_changes():
+    store = filled_store()
+    budget = budget_for(store, excess=-1)
+    budget.check()
+    assert chunk_counts(store) == {hostname: 5 for hostname in HOSTS}
+    assert store.rings.capacity == 100 and budget.stats['capacity_changes'] == 0
+
+
+def test_measure_only_without_a_budget():
+    store = filled_store()
+    budget = MemoryBudget(store, 0)
+    budget.check()
+    assert budget.stats['checks'] == 1 and budget.stats['evicted_chunks'] == 0
+    assert set(budget.usage) == {'rings', 'compressed_history', 'current_metrics', 'streaming_stats'}
+    assert budget.usage['rings'] > 0 and budget.usage['compressed_history'] > 0
+
+
+@with_flagged_host
+def test_oldest_chunks_of_ordinary_hosts_go_first():
+    store = filled_store()
+    chunks = store.compressed.hosts['web-01'].chunks
+    budget = budget_for(store, excess=chunks[0].nbytes() + chunks[1].nbytes())
+    budget.check()
+
+    assert chunk_counts(store) == {'web-01': 3, 'busy-01': 5, 'flagged-01': 5}
+    assert store.compressed.hosts['web-01'].chunks[0] is chunks[2]
+    assert budget.stats['evicted_chunks'] == 2 and budget.stats['evicted_samples'] == 8
+    assert store.rings.capacity == 100
+
+
+@with_flagged_host
+def test_busy_hosts_before_flagged_hosts():
+    store = filled_store()
+    normal = sum(chunk.nbytes() for chunk in store.compressed.hosts['web-01'].chunks)
+    budget = budget_for(store, excess=normal + 1)
+    budget.check()
+    assert chunk_counts(store) == {'web-01': 0, 'busy-01': 4, 'flagged-01': 5}
+
+
+def test_ring_capacity_shrinks_when_eviction_is_not_enough():
+    store = filled_store()
+    compressed = store.compressed.nbytes()
+    probe = MemoryBudget(store, 0)
+    probe.measure()
+    # 40.5 samples of every ring on top of the chunks (half a sample keeps byte rounding out of it)
+    budget = budget_for(store, excess=compressed + 40.5 * probe.ring_bytes_per_sample, min_history=10)
+    budget.check()
+
+    # Every chunk is gone, the rings give up what is still missing
+    assert sum(chunk_counts(store).values()) == 0
+    assert store.rings.capacity == 59
+    assert budget.stats['capacity_changes'] == 1
+
+
+def test_small_capacity_changes_are_skipped():
+    store = filled_store()
+    budget = budget_for(store, excess=store.compressed.nbytes() + 1000)
+    budget.check()
+    assert sum(chunk_counts(store).values()) == 0
+    assert store.rings.capacity == 100 and budget.stats['capacity_changes'] == 0
+
+
+def test_ring_capacity_never_below_the_floor():
+    store = filled_store()
+    MemoryBudget(store, 0.001, min_history=30).check()
+    assert store.rings.capacity == 30
+
+    # The next sample of each host migrates its ring to the new capacity
+    store.submit([('web-01', sample_at(time.time(), cpu=1.0))])
+    assert store.rings.get('web-01').capacity == 30
+
+
+def test_ring_capacity_grows_back_with_room_to_spare():
+    store = filled_store()
+    MemoryBudget(store, 0.001, min_history=30).check()
+    assert store.rings.capacity == 30
+
+    budget = MemoryBudget(store, 1024, max_history=100, min_history=30)
+    budget.check()
+    assert store.rings.capacity == 100
+
+
+if __name__ == '__main__':
+    tests = [(name, func) for name, func in sorted(globals().items()) if name.startswith('test_')]
+    failed = 0
+
+    for name, func in tests:
+        try:
+            func()
+            print(f"✓ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"✗ {name}: {type(e).__name__}: {e}")
+
+    print(f"\n{len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
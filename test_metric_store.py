@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Tests for the metric store ingest path
+Stores samples in a MetricStore over a temporary ring directory
+
+Run with: python test_metric_store.py  (or pytest test_metric_store.py)
+"""
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, 'backend'))
+
+import metric_store
+from ring_buffer import parse_timestamp
+from test_wire_format import make_sample
+
+
+def sample_at(epoch, cpu=37.5):
+    sample = make_sample()
+    sample['timestamp'] = datetime.fromtimestamp(epoch, timezone.utc).replace(tzinfo=None).isoformat()
+    sample['cpu']['cpu_percent_total'] = cpu
+    return sample
+
+
+def new_store():
+    return metric_store.MetricStore(history_size=100, ring_dir=tempfile.mkdtemp())
+
+
+def test_future_timestamp_is_clamped_to_receive_time():
+    store = new_store()
+    now = time.time()
+    store.submit([('web-01', sample_at(now + 86400))])
+    stored = parse_timestamp(store.get_current('web-01')['timestamp'])
+    assert now - 1 <= stored <= time.time() + 1
+    assert store.get_stats()['future_timestamps'] == 1
+
+    # Later samples keep their own timestamps instead of being pinned to the future one
+    store.submit([('web-01', sample_at(now + 10, cpu=50.0))])
+    history = store.get_history('web-01')
+    assert [entry['cpu']['cpu_percent_total'] for entry in history] == [37.5, 50.0]
+    assert abs(parse_timestamp(history[-1]['timestamp']) - (now + 10)) < 0.001
+    assert store.count_out_of_order() == 0
+
+
+def test_timestamp_within_skew_is_kept():
+    store = new_store()
+    ahead = time.time() + metric_store.MAX_CLOCK_SKEW / 2
+    store.submit([('web-01', sample_at(ahead))])
+    assert abs(parse_timestamp(store.get_history('web-01')[-1]['timestamp']) - ahead) < 0.001
+    assert store.get_stats()['future_timestamps'] == 0
+
+
+def test_invalid_sample_changes_nothing():
+    store = new_store()
+    sample = sample_at(time.time())
+    sample['cpu']['cpu_percent_total'] = float('nan')
+    store.submit([('web-01', sample)])
+    assert store.get_current('web-01') is None
+    assert store.get_history('web-01') == []
+    assert store.get_stats()['rejected_samples'] == 1
+
+
+if __name__ == '__main__':
+    tests = [(name, func) for name, func in sorted(globals().items()) if name.startswith('test_')]
+    failed = 0
+
+    for name, func in tests:
+        try:
+            func()
+            print(f"✓ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"✗ {name}: {type(e).__name__}: {e}")
+
+    print(f"\n{len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Tests for the mergeable quantile sketches
+Checks DDSketch quantiles against exact ones within SKETCH_ACCURACY, and that merged and decoded
+sketches answer like the sketch of all values
+
+Run with: python test_quantile_sketch.py  (or pytest test_quantile_sketch.py)
+"""
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, 'backend'))
+
+import quantile_sketch
+from quantile_sketch import DDSketch, SKETCH_ACCURACY
+
+QUANTILES = (0.0, 0.01, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99, 1.0)
+
+
+def sketch_of(values):
+    sketch = DDSketch()
+    for value in values:
+        sketch.add(value)
+    return sketch
+
+
+def exact(values, q):
+    """The value the sketch approximates: rank q * (n - 1) of the sorted values"""
+    ordered = sorted(values)
+    return ordered[int(q * (len(ordered) - 1))]
+
+
+def within_bound(estimate, value):
+    return abs(estimate - value) <= SKETCH_ACCURACY * abs(value) * (1 + 1e-9)
+
+
+def test_relative_error_bound():
+    rng = random.Random(3)
+    series = {
+        'uniform': [rng.uniform(0, 100) for _ in range(5000)],
+        'lognormal': [rng.lognormvariate(10, 3) for _ in range(5000)],
+        'signed': [rng.gauss(0, 1000) for _ in range(5000)],
+        'spiky': [1.0] * 4900 + [1e9] * 100,
+    }
+    for name, values in series.items():
+        sketch = sketch_of(values)
+        for q in QUANTILES:
+            assert within_bound(sketch.quantile(q), exact(values, q)), (name, q)
+
+
+def test_estimates_stay_inside_min_and_max():
+    values = [3.7, 12.25, 99.9, 0.5]
+    sketch = sketch_of(values)
+    assert sketch.min == 0.5 and sketch.max == 99.9
+    assert sketch.quantile(1) == 99.9 and within_bound(sketch.quantile(0), 0.5)
+    assert sketch_of([-7.0, -2.0]).quantile(0) == -7.0
+
+
+def test_zeros_and_tiny_values():
+    sketch = sketch_of([0.0] * 60 + [1e-12, -1e-12] + [5.0] * 38)
+    assert sketch.zeros == 62 and sketch.count == 100
+    assert sketch.quantile(0.5) == 0.0
+    assert within_bound(sketch.quantile(0.99), 5.0)
+
+
+def test_non_finite_values_are_ignored():
+    sketch = sketch_of([1.0, float('nan'), float('inf'), float('-inf'), 2.0])
+    assert sketch.count == 2 and (sketch.min, sketch.max) == (1.0, 2.0)
+
+
+def test_empty_sketch_has_no_quantiles():
+    assert DDSketch().quantile(0.5) is None
+    assert quantile_sketch.percentiles(['cpu'], [DDSketch()]) == {}
+
+
+def test_merge_equals_sketch_of_all_values():
+    rng = random.Random(5)
+    parts = [[rng.expovariate(0.01) - 20 for _ in range(rng.randint(1, 500))] for _ in range(12)]
+    merged = DDSketch()
+    for part in parts:
+        merged.merge(sketch_of(part))
+    whole = sketch_of([value for part in parts for value in part])
+
+    assert (merged.positive, merged.negative, merged.zeros) == (whole.positive, whole.negative, whole.zeros)
+    assert (merged.count, merged.min, merged.max) == (whole.count, whole.min, whole.max)
+    for q in QUANTILES:
+        assert merged.quantile(q) == whole.quantile(q)
+
+
+def test_merge_with_empty_and_copy_are_independent():
+    sketch = sketch_of([1.0, 2.0, 3.0])
+    copy = sketch.copy()
+    assert sketch.merge(DDSketch()) is sketch and sketch.count == 3
+    copy.add(100.0)
+    assert sketch.count == 3 and sketch.max == 3.0 and copy.max == 100.0
+
+
+def test_encode_round_trip():
+    rng = random.Random(9)
+    sketches = [sketch_of([rng.gauss(50, 30) for _ in range(300)]), DDSketch(), sketch_of([0.0, -4.0])]
+    data = quantile_sketch.encode_sketches(sketches)
+    decoded = quantile_sketch.decode_sketches(data, 5)
+
+    assert len(decoded) == 5 and decoded[3].count == decoded[4].count == 0
+    for sketch, copy in zip(sketches, decoded):
+        assert (copy.positive, copy.negative, copy.zeros, copy.count) == \
+            (sketch.positive, sketch.negative, sketch.zeros, sketch.count)
+        assert (copy.min, copy.max) == (sketch.min, sketch.max)
+
+
+def test_collapse_keeps_upper_quantiles_accurate():
+    # One value per bin over more than MAX_BINS bins: the lowest ones are folded together
+    values = [1.03 ** n for n in range(3000)]
+    sketch = sketch_of(values)
+    assert len(sketch.positive) <= quantile_sketch.MAX_BINS
+    assert sketch.count == len(values)
+    for q in (0.5, 0.9, 0.99):
+        assert within_bound(sketch.quantile(q), exact(values, q))
+
+
+def test_percentiles_report_every_filled_sketch():
+    result = quantile_sketch.percentiles(['cpu', 'memory'], [sketch_of([10.0] * 10), DDSketch()])
+    assert set(result) == {'cpu'} and result['cpu']['count'] == 10
+    assert all(within_bound(result['cpu'][label], 10.0) for label in ('p50', 'p95', 'p99'))
+
+
+if __name__ == '__main__':
+    tests = [(name, func) for name, func in sorted(globals().items()) if name.startswith('test_')]
+    failed = 0
+
+    for name, func in tests:
+        try:
+            func()
+            print(f"✓ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"✗ {name}: {type(e).__name__}: {e}")
+
+    print(f"\n{len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Tests for the range query buckets
+Fills StepBuckets from samples and rollup buckets and compares each step with the samples that
+fall in it
+
+Run with: python test_range_query.py  (or pytest test_range_query.py)
+"""
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, 'backend'))
+
+import rollups
+from range_query import StepBuckets, rollup_resolution
+
+CPU = 'cpu.cpu_percent_total'
+NAN = float('nan')
+
+
+def rollup_bucket(start, values):
+    """(start, aggregates) of a rollup bucket holding `values` of the CPU series"""
+    aggregates = rollups.new_aggregates()
+    index = rollups.ROLLUP_METRICS.index(CPU)
+    for value in values:
+        sample = [None] * len(rollups.ROLLUP_METRICS)
+        sample[index] = value
+        rollups.update(aggregates, sample)
+    return start, aggregates
+
+
+def test_samples_land_in_their_step():
+    buckets = StepBuckets(1000, 1060, 20)
+    buckets.add_samples([990.0, 1000.0, 1005.0, 1019.9, 1020.0, 1059.0, 1060.0],
+                        [99.0, 1.0, 2.0, 3.0, 4.0, 5.0, 99.0])
+    assert buckets.timestamps() == [1000, 1020, 1040]
+    assert buckets.values('count') == [3, 1, 1]
+    assert buckets.values('sum') == [6.0, 4.0, 5.0]
+    assert buckets.values('min') == [1.0, 4.0, 5.0]
+    assert buckets.values('max') == [3.0, 4.0, 5.0]
+    assert buckets.values('avg') == [2.0, 4.0, 5.0]
+
+
+def test_matches_a_bucket_per_sample_reference():
+    rng = random.Random(4)
+    timestamps = sorted(rng.uniform(0, 3600) for _ in range(3000))
+    values = [rng.uniform(0, 100) if rng.random() > 0.1 else NAN for _ in timestamps]
+    buckets = StepBuckets(600, 3000, 60)
+    buckets.add_samples(timestamps, values)
+
+    expected = [[] for _ in range(buckets.size)]
+    for timestamp, value in zip(timestamps, values):
+        if 600 <= timestamp < 3000 and value == value:
+            expected[int((timestamp - 600) // 60)].append(value)
+    assert buckets.values('count') == [len(step) for step in expected]
+    assert buckets.values('max') == [max(step) if step else None for step in expected]
+    assert all(abs(got - sum(step)) < 1e-9 for got, step in zip(buckets.values('sum'), expected))
+
+
+def test_empty_steps_and_nan_only_steps_are_none():
+    buckets = StepBuckets(0, 40, 10)
+    buckets.add_samples([5.0, 25.0, 26.0], [NAN, 1.0, NAN])
+    assert buckets.values('avg') == [None, None, 1.0, None]
+    assert buckets.values('count') == [0, 0, 1, 0]
+    assert buckets.first_filled() == 2
+    assert StepBuckets(0, 40, 10).first_filled() is None
+
+
+def test_sources_add_up_in_a_step():
+    buckets = StepBuckets(0, 600, 300)
+    buckets.add_rollups(CPU, [rollup_bucket(0, [10.0, 20.0]), rollup_bucket(60, [30.0])])
+    buckets.add_samples([250.0, 299.0], [5.0, 40.0])
+    assert buckets.values('count') == [5, 0]
+    assert buckets.values('min') == [5.0, None] and buckets.values('max') == [40.0, None]
+    assert buckets.values('avg') == [21.0, None]
+
+
+def test_rollups_are_rebucketed_into_coarser_steps():
+    # 5m rollups read for a 15 minute step, plus buckets outside the range and an empty one
+    buckets = StepBuckets(900, 2700, 900)
+    rows = [rollup_bucket(600, [99.0]), rollup_bucket(900, [1.0]), rollup_bucket(1200, [2.0, 4.0]),
+            rollup_bucket(1500, []), rollup_bucket(1800, [8.0]), rollup_bucket(2700, [99.0])]
+    buckets.add_rollups(CPU, rows)
+    assert buckets.values('count') == [3, 1]
+    assert buckets.values('sum') == [7.0, 8.0]
+    assert buckets.values('min') == [1.0, 8.0]
+
+
+def test_straddling_rollup_counts_in_the_step_it_starts_in():
+    # 1m rollups read for a 90s step: the bucket at 60 covers 60-120, across the boundary at 90
+    buckets = StepBuckets(0, 180, 90)
+    buckets.add_rollups(CPU, [rollup_bucket(0, [1.0]), rollup_bucket(60, [2.0]), rollup_bucket(120, [3.0])])
+    assert buckets.values('count') == [2, 1]
+
+
+def test_rollup_resolution():
+    assert rollup_resolution(CPU, 60) == '1m'
+    assert rollup_resolution(CPU, 600) == '5m'
+    assert rollup_resolution(CPU, 7200) == '1h'
+    # No resolution divides the step: the finest one not longer than it, rebucketed
+    assert rollup_resolution(CPU, 90) == '1m'
+    assert rollup_resolution(CPU, 330) == '1m'
+    assert rollup_resolution(CPU, 30) is None
+    assert rollup_resolution('cpu.cpu_freq_current', 600) is None
+
+
+def test_empty_range():
+    buckets = StepBuckets(1000, 1000, 60)
+    buckets.add_samples([1000.0], [1.0])
+    assert buckets.size == 0 and buckets.values('avg') == [] and buckets.timestamps() == []
+
+
+if __name__ == '__main__':
+    tests = [(name, func) for name, func in sorted(globals().items()) if name.startswith('test_')]
+    failed = 0
+
+    for name, func in tests:
+        try:
+            func()
+            print(f"✓ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"✗ {name}: {type(e).__name__}: {e}")
+
+    print(f"\n{len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Tests for the per-host ring buffers
+Writes samples through a writable RingDirectory in a temporary directory and reads them back,
+through the writer's mapping and through a reader's
+
+Run with: python test_ring_buffer.py  (or pytest test_ring_buffer.py)
+"""
+import json
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, 'backend'))
+
+import ring_buffer
+from ring_buffer import RingBuffer, RingDirectory, format_timestamp, parse_timestamp
+from wire_format import SAMPLE_FIELDS
+from test_wire_format import make_sample
+
+
+def new_rings(capacity=5):
+    directory = tempfile.mkdtemp()
+    return RingDirectory(directory, capacity=capacity, writable=True), RingDirectory(directory)
+
+
+def sample(cpu=37.5, cores=None):
+    metrics = make_sample()
+    metrics['cpu']['cpu_percent_total'] = cpu
+    if cores is not None:
+        metrics['cpu']['cpu_percent_per_core'] = cores
+    return metrics
+
+
+def test_round_trip_every_stored_section():
+    writer, _ = new_rings()
+    metrics = make_sample()
+    writer.append('web-01', metrics, 1000.5)
+
+    entry, = writer.read('web-01')
+    assert entry['timestamp'] == format_timestamp(1000.5)
+    assert entry['hostname'] == 'web-01'
+    for section in ('cpu', 'memory', 'io'):
+        assert entry[section] == metrics[section]
+    assert entry['disk'] == metrics['disk']
+
+
+def test_missing_values_read_back_as_missing():
+    writer, _ = new_rings()
+    writer.append('web-01', make_sample(first=True), 1000.0)
+
+    entry, = writer.read('web-01')
+    assert entry['cpu']['load_average'] is None
+    assert entry['cpu']['cpu_freq_current'] is None
+    # Rates the agent did not send are left out, not zero
+    assert 'bytes_sent_per_sec' not in entry['io']['network']
+    assert 'read_bytes_per_sec' not in entry['io']['disk_io']
+
+
+def test_wraps_around_keeping_the_newest_samples():
+    writer, _ = new_rings(capacity=5)
+    for n in range(12):
+        writer.append('web-01', sample(cpu=n), 1000.0 + n)
+
+    ring = writer.get('web-01')
+    assert len(ring) == 5
+    assert ring.oldest_timestamp() == 1007.0
+    assert [entry['cpu']['cpu_percent_total'] for entry in ring.read()] == [7, 8, 9, 10, 11]
+    assert ring.read_columns(['cpu.cpu_percent_total'])['cpu.cpu_percent_total'] == [7, 8, 9, 10, 11]
+
+
+def test_window_is_found_by_timestamp_and_limit():
+    writer, _ = new_rings(capacity=10)
+    for n in range(10):
+        writer.append('web-01', sample(cpu=n), 1000.0 + 10 * n)
+
+    def cpu(**window):
+        return [entry['cpu']['cpu_percent_total'] for entry in writer.read('web-01', **window)]
+
+    assert cpu(since=1045) == [5, 6, 7, 8, 9]
+    assert cpu(since=1050) == [5, 6, 7, 8, 9]
+    assert cpu(since=1050.5) == [6, 7, 8, 9]
+    assert cpu(since=1045, limit=2) == [8, 9]
+    assert cpu(since=2000) == []
+
+
+def test_older_timestamp_is_stored_with_the_newest():
+    writer, _ = new_rings()
+    assert not writer.append('web-01', sample(), 1000.0)
+    assert writer.append('web-01', sample(), 990.0)
+    timestamps = [parse_timestamp(entry['timestamp']) for entry in writer.read('web-01')]
+    assert timestamps == [1000.0, 1000.0]
+
+
+def test_seqlock_skips_slots_being_written():
+    writer, _ = new_rings(capacity=5)
+    for n in range(3):
+        writer.append('web-01', sample(cpu=n), 1000.0 + n)
+
+    ring = writer.get('web-01')
+    # Sample 1 half written (odd sequence), as a reader would see it during append
+    ring.columns['sequence'][1] = 2 * 1 + 1
+    assert [entry['cpu']['cpu_percent_total'] for entry in ring.read()] == [0, 2]
+    assert ring.read_columns(['cpu.cpu_percent_total'])['cpu.cpu_percent_total'] == [0, 2]
+
+    # A slot already holding a newer sample than the one expected there is skipped too
+    ring.columns['sequence'][1] = 2 * 6 + 2
+    assert [entry['cpu']['cpu_percent_total'] for entry in ring.read()] == [0, 2]
+
+
+def test_reader_sees_appends_without_remapping():
+    writer, reader = new_rings()
+    writer.append('web-01', sample(cpu=1), 1000.0)
+    ring = reader.get('web-01')
+    writer.append('web-01', sample(cpu=2), 1001.0)
+
+    assert reader.get('web-01') is ring
+    assert [entry['cpu']['cpu_percent_total'] for entry in ring.read()] == [1, 2]
+
+
+def test_migration_keeps_history_and_old_mapping_stays_readable():
+    writer, reader = new_rings()
+    writer.append('web-01', sample(cpu=1, cores=[10.0, 20.0]), 1000.0)
+    old = reader.get('web-01')
+
+    # A core count change migrates the ring to a new file
+    writer.append('web-01', sample(cpu=2, cores=[10.0, 20.0, 30.0]), 1001.0)
+    ring = reader.get('web-01')
+    assert ring is not old and ring.core_count == 3
+    assert [entry['cpu']['cpu_percent_total'] for entry in ring.read()] == [1, 2]
+
+    # A request still holding the replaced ring keeps reading it
+    assert [entry['cpu']['cpu_percent_total'] for entry in old.read()] == [1]
+
+
+def test_capacity_change_keeps_the_newest_samples():
+    writer, _ = new_rings(capacity=5)
+    for n in range(5):
+        writer.append('web-01', sample(cpu=n), 1000.0 + n)
+
+    writer.capacity = 3
+    writer.append('web-01', sample(cpu=5), 1005.0)
+    ring = writer.get('web-01')
+    assert ring.capacity == 3
+    assert [entry['cpu']['cpu_percent_total'] for entry in ring.read()] == [3, 4, 5]
+
+
+def write_v2_ring(directory, hostname, total):
+    """A version 2 ring (partition total in the layout, no partition_total column) with two samples"""
+    path = ring_buffer.ring_path(directory, hostname)
+    layout = [{'device': '/dev/sda1', 'mountpoint': '/', 'fstype': 'ext4', 'total': total}]
+    layout_data = json.dumps(layout).encode('utf-8')
+    _, size = ring_buffer.column_offsets(5, 0, len(layout), len(layout_data), version=2)
+    with open(path, 'wb') as f:
+        f.truncate(size)
+        f.write(ring_buffer.HEADER.pack(ring_buffer.RING_MAGIC, 2, len(SAMPLE_FIELDS), 5, 0, len(layout),
+                                        len(layout_data)))
+        f.seek(ring_buffer.HEADER_SIZE)
+        f.write(layout_data)
+
+    ring = RingBuffer(path, hostname, writable=True)
+    columns = ring.columns
+    for n in range(2):
+        columns['timestamp'][n] = 1000.0 + n
+        columns['cpu.cpu_percent_total'][n] = n
+        columns['missing'][n] = 1 << ring_buffer.LOAD_AVERAGE_BIT | 1 << ring_buffer.PER_CORE_BIT
+        columns['partition_used'][n] = 40
+        columns['partition_free'][n] = 60
+        columns['partition_percent'][n] = 4000
+        columns['sequence'][n] = 2 * n + 2
+    ring_buffer.WRITE_INDEX.pack_into(ring.mm, ring_buffer.WRITE_INDEX_OFFSET, 2)
+    ring.flush()
+
+
+def partition_sample(cpu, total):
+    metrics = sample(cpu=cpu)
+    del metrics['cpu']['cpu_percent_per_core']
+    metrics['disk']['partitions'] = [{'device': '/dev/sda1', 'mountpoint': '/', 'fstype': 'ext4',
+                                      'total': total, 'used': 40, 'free': total - 40, 'percent': 40.0}]
+    return metrics
+
+
+def test_version_2_ring_is_read_with_the_layout_total():
+    writer, reader = new_rings()
+    write_v2_ring(writer.directory, 'web-01', 100)
+
+    ring = reader.get('web-01')
+    assert ring.version == 2
+    partitions = [entry['disk']['partitions'] for entry in ring.read()]
+    assert partitions == [[{'device': '/dev/sda1', 'mountpoint': '/', 'fstype': 'ext4', 'total': 100,
+                            'used': 40, 'free': 60, 'percent': 40.0}]] * 2
+
+
+def test_version_2_ring_migrates_on_the_next_sample():
+    writer, reader = new_rings()
+    write_v2_ring(writer.directory, 'web-01', 100)
+
+    writer.append('web-01', partition_sample(cpu=2, total=200), 1002.0)
+    ring = writer.get('web-01')
+    assert ring.version == ring_buffer.RING_VERSION
+    # The total is a column now, not part of the layout
+    assert ring.layout == [{'device': '/dev/sda1', 'mountpoint': '/', 'fstype': 'ext4'}]
+
+    entries = reader.read('web-01')
+    assert [entry['cpu']['cpu_percent_total'] for entry in entries] == [0, 1, 2]
+    assert [entry['disk']['partitions'][0]['total'] for entry in entries] == [100, 100, 200]
+
+
+def test_changing_partition_total_does_not_migrate():
+    writer, _ = new_rings()
+    writer.append('web-01', partition_sample(cpu=1, total=100), 1000.0)
+    ring = writer.get('web-01')
+    for n, total in enumerate((101, 250, 99)):
+        writer.append('web-01', partition_sample(cpu=2 + n, total=total), 1001.0 + n)
+
+    assert writer.get('web-01') is ring
+    assert [entry['disk']['partitions'][0]['total'] for entry in ring.read()] == [100, 101, 250, 99]
+
+
+if __name__ == '__main__':
+    tests = [(name, func) for name, func in sorted(globals().items()) if name.startswith('test_')]
+    failed = 0
+
+    for name, func in tests:
+        try:
+            func()
+            print(f"✓ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"✗ {name}: {type(e).__name__}: {e}")
+
+    print(f"\n{len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Tests for the multi-resolution rollups
+Feeds samples to a RollupEngine and checks the buckets it closes, then merges them through a
+HistoryWriter into a temporary history database
+
+Run with: python test_rollups.py  (or pytest test_rollups.py)
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, 'backend'))
+
+import history_db
+import rollups
+from rollups import ROLLUP_METRICS, RollupEngine
+
+HOUR = 3600 * 500000  # an epoch on an hour boundary
+CPU = 4 * ROLLUP_METRICS.index('cpu.cpu_percent_total')
+
+
+def sample(cpu):
+    return {'cpu': {'cpu_percent_total': cpu}, 'memory': {'memory_percent': 50.0},
+            'io': {'network': {'bytes_sent_per_sec': 1.0}}}
+
+
+def cpu_of(aggregates):
+    """(count, sum, min, max) of the CPU series"""
+    return tuple(aggregates[CPU:CPU + 4])
+
+
+def new_engine():
+    closed = []
+    return RollupEngine(sink=closed.extend), closed
+
+
+def test_bucket_closes_when_a_sample_moves_past_it():
+    engine, closed = new_engine()
+    for n in range(6):
+        engine.add('web-01', HOUR + 10 * n, sample(cpu=n))
+    assert closed == []
+    assert cpu_of(engine.get_open('web-01', '1m')[1]) == (6, 15, 0, 5)
+
+    engine.add('web-01', HOUR + 60, sample(cpu=10))
+    assert [(row[1], row[2]) for row in closed] == [('1m', HOUR)]
+    assert cpu_of(closed[0][3]) == (6, 15, 0, 5)
+    # The coarser buckets are still open and hold every sample
+    assert engine.get_open('web-01', '1m')[0] == HOUR + 60
+    assert cpu_of(engine.get_open('web-01', '5m')[1]) == (7, 25, 0, 10)
+    assert cpu_of(engine.get_open('web-01', '1h')[1]) == (7, 25, 0, 10)
+
+
+def test_every_resolution_closes_at_its_boundary():
+    engine, closed = new_engine()
+    engine.add('web-01', HOUR, sample(cpu=1))
+    engine.add('web-01', HOUR + 3600, sample(cpu=2))
+    assert sorted((row[1], row[2]) for row in closed) == [('1h', HOUR), ('1m', HOUR), ('5m', HOUR)]
+
+
+def test_late_sample_becomes_a_one_sample_bucket():
+    engine, closed = new_engine()
+    engine.add('web-01', HOUR + 70, sample(cpu=1))
+    engine.add('web-01', HOUR + 130, sample(cpu=2))
+    closed.clear()
+
+    # Minute 0 closed long ago (it was never open), the 5m and 1h buckets are still open
+    engine.add('web-01', HOUR + 10, sample(cpu=40))
+    assert engine.late == 1
+    assert [(row[1], row[2], cpu_of(row[3])) for row in closed] == [('1m', HOUR, (1, 40, 40, 40))]
+    assert cpu_of(engine.get_open('web-01', '5m')[1]) == (3, 43, 1, 40)
+
+
+def test_hosts_are_kept_apart():
+    engine, _ = new_engine()
+    engine.add('web-01', HOUR, sample(cpu=1))
+    engine.add('web-02', HOUR, sample(cpu=3))
+    assert cpu_of(engine.get_open('web-01', '1m')[1]) == (1, 1, 1, 1)
+    assert cpu_of(engine.get_open('web-02', '1m')[1]) == (1, 3, 3, 3)
+    assert engine.get_open('web-03', '1m') is None
+
+
+def test_missing_and_non_finite_values_are_not_counted():
+    engine, _ = new_engine()
+    engine.add('web-01', HOUR, sample(cpu=None))
+    engine.add('web-01', HOUR + 1, sample(cpu=float('nan')))
+    engine.add('web-01', HOUR + 2, sample(cpu=float('inf')))
+    engine.add('web-01', HOUR + 3, sample(cpu=5))
+    assert cpu_of(engine.get_open('web-01', '1m')[1]) == (1, 5, 5, 5)
+
+
+def test_open_bucket_handed_out_is_not_modified():
+    engine, _ = new_engine()
+    engine.add('web-01', HOUR, sample(cpu=1))
+    start, aggregates = engine.get_open('web-01', '1m')
+    engine.add('web-01', HOUR + 1, sample(cpu=2))
+    assert cpu_of(aggregates) == (1, 1, 1, 1)
+
+
+def test_close_all_hands_over_every_open_bucket():
+    engine, closed = new_engine()
+    engine.add('web-01', HOUR, sample(cpu=1))
+    engine.add('web-02', HOUR, sample(cpu=1))
+    assert engine.close_all() == 6
+    assert len(closed) == 6 and engine.get_open('web-01', '1m') is None
+
+
+def test_minute_sketches_go_to_every_resolution():
+    sketch_rows = []
+    engine = RollupEngine(sketch_sink=sketch_rows.extend)
+    for n in range(1, 11):
+        engine.add('web-01', HOUR + n, sample(cpu=n))
+    engine.add('web-01', HOUR + 60, sample(cpu=1))
+
+    assert [(row[1], row[2]) for row in sketch_rows] == [('1m', HOUR), ('5m', HOUR), ('1h', HOUR)]
+    cpu_sketch = sketch_rows[0][3][ROLLUP_METRICS.index('cpu.cpu_percent_total')]
+    assert cpu_sketch.count == 10
+
+
+def test_aggregates_encode_round_trip():
+    aggregates = rollups.new_aggregates()
+    rollups.update(aggregates, [1.5, None, 2.0, 3.0, 4.0, 5.0, 6.0])
+    assert rollups.decode_aggregates(rollups.encode_aggregates(aggregates)) == aggregates
+    # Buckets written before a metric was added decode with it empty
+    short = rollups.decode_aggregates(rollups.encode_aggregates(aggregates[:8]))
+    assert short[:8] == aggregates[:8] and short[8:] == rollups.new_aggregates()[8:]
+
+
+def test_choose_resolution():
+    assert rollups.choose_resolution(3600, 100) is None
+    assert rollups.choose_resolution(6 * 3600, 100) == '1m'
+    assert rollups.choose_resolution(30 * 86400, 100) == '1h'
+    assert rollups.choose_resolution(86400, 0) is None
+
+
+def test_late_and_split_buckets_merge_in_the_database():
+    path = os.path.join(tempfile.mkdtemp(), 'metrics.db')
+    history_db.init_history_db(path)
+    writer = history_db.HistoryWriter(path)
+    engine = RollupEngine(sink=writer.add_rollups)
+
+    for n in range(3):
+        engine.add('web-01', HOUR + 10 * n, sample(cpu=n))
+    engine.add('web-01', HOUR + 60, sample(cpu=10))
+    writer.flush()
+    # A late sample of the stored minute, queued and flushed separately
+    engine.add('web-01', HOUR + 50, sample(cpu=20))
+    generation, unwritten = writer.unwritten('rollups', '1m', HOUR)
+    assert [(owner, start, cpu_of(value)) for owner, start, value in unwritten] == \
+        [('web-01', HOUR, (1, 20, 20, 20))]
+    writer.flush()
+    assert writer.generation == generation + 1 and writer.unwritten('rollups', '1m', HOUR)[1] == []
+
+    (start, aggregates), = history_db.read_rollups('web-01', '1m', HOUR, 10, path=path)
+    assert start == HOUR and cpu_of(aggregates) == (4, 23, 0, 20)
+
+
+if __name__ == '__main__':
+    tests = [(name, func) for name, func in sorted(globals().items()) if name.startswith('test_')]
+    failed = 0
+
+    for name, func in tests:
+        try:
+            func()
+            print(f"✓ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"✗ {name}: {type(e).__name__}: {e}")
+
+    print(f"\n{len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
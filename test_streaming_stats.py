@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Tests for the streaming statistics
+Feeds samples to StreamingStats and compares every window with statistics computed from scratch
+over the samples it should hold
+
+Run with: python test_streaming_stats.py  (or pytest test_streaming_stats.py)
+"""
+import math
+import os
+import random
+import statistics
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, 'backend'))
+
+from streaming_stats import HostStats, StreamingStats, sample_values
+from test_wire_format import make_sample
+
+CPU = 'cpu.cpu_percent_total'
+
+
+def sample(cpu):
+    metrics = make_sample()
+    metrics['cpu']['cpu_percent_total'] = cpu
+    return metrics
+
+
+def expected(values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    return {'count': len(values), 'average': statistics.fmean(values),
+            'stddev': statistics.stdev(values) if len(values) > 1 else 0.0,
+            'min': min(values), 'max': max(values)}
+
+
+def check(result, values):
+    """The CPU statistics of `result` match those computed over `values`"""
+    want = expected(values)
+    got = result['metrics'][CPU]
+    if want is None:
+        assert got['count'] == 0 and got['average'] is None
+        return
+    assert got['count'] == want['count']
+    assert got['min'] == want['min'] and got['max'] == want['max']
+    assert math.isclose(got['average'], want['average'], rel_tol=1e-9, abs_tol=1e-9)
+    assert math.isclose(got['stddev'], want['stddev'], rel_tol=1e-6, abs_tol=1e-6)
+
+
+def test_welford_matches_statistics():
+    stats = StreamingStats(capacity=1000)
+    rng = random.Random(7)
+    values = [rng.uniform(0, 100) for _ in range(500)]
+    for n, value in enumerate(values):
+        stats.add('web-01', 1000.0 + n, sample(cpu=value))
+    check(stats.get('web-01', 'all'), values)
+
+
+def test_count_window_keeps_the_last_capacity_samples():
+    stats = StreamingStats(capacity=50)
+    rng = random.Random(11)
+    values = []
+    for n in range(400):
+        value = rng.choice([rng.uniform(0, 100), rng.uniform(1e6, 1e6 + 1)])
+        values.append(value)
+        stats.add('web-01', 1000.0 + n, sample(cpu=value))
+        if n % 37 == 0:
+            check(stats.get('web-01', 'all'), values[-50:])
+    result = stats.get('web-01', 'all')
+    assert result['samples'] == 50
+    check(result, values[-50:])
+
+
+def test_time_windows_expire_by_the_newest_timestamp():
+    stats = StreamingStats(capacity=10000)
+    values = []
+    for n in range(1000):
+        values.append(float(n % 97))
+        stats.add('web-01', 10.0 * n, sample(cpu=values[-1]))
+    newest = 10.0 * 999
+    # '5m' holds samples no older than newest - 300, '1h' no older than newest - 3600
+    check(stats.get('web-01', '5m'), [v for n, v in enumerate(values) if 10.0 * n >= newest - 300])
+    check(stats.get('web-01', '1h'), [v for n, v in enumerate(values) if 10.0 * n >= newest - 3600])
+    assert stats.get('web-01', '5m')['samples'] == 31
+
+
+def test_min_max_follow_the_window():
+    stats = StreamingStats(capacity=3)
+    values = [5.0, 1.0, 9.0, 4.0, 3.0, 2.0, 8.0]
+    for n, value in enumerate(values):
+        stats.add('web-01', 1000.0 + n, sample(cpu=value))
+        metrics = stats.get('web-01', 'all')['metrics'][CPU]
+        window = values[max(0, n - 2):n + 1]
+        assert (metrics['min'], metrics['max']) == (min(window), max(window))
+
+
+def test_missing_values_are_skipped():
+    stats = StreamingStats(capacity=4)
+    for n, value in enumerate([10.0, None, 20.0, None, None, None, None]):
+        stats.add('web-01', 1000.0 + n, sample(cpu=value))
+        result = stats.get('web-01', 'all')
+        assert result['metrics'][CPU]['current'] == value
+    # The last four samples hold no CPU value at all
+    check(stats.get('web-01', 'all'), [])
+    assert stats.get('web-01', 'all')['samples'] == 4
+
+
+def test_equal_values_give_zero_stddev():
+    stats = StreamingStats(capacity=5)
+    for n, value in enumerate([0.1, 7.3, 0.3, 0.3, 0.3, 0.3, 0.3]):
+        stats.add('web-01', 1000.0 + n, sample(cpu=value))
+    metrics = stats.get('web-01', 'all')['metrics'][CPU]
+    # The reverse updates leave rounding noise at most, never a negative variance
+    assert 0.0 <= metrics['stddev'] < 1e-7
+    assert metrics['min'] == metrics['max'] == 0.3
+
+
+def test_seed_starts_from_the_stored_history():
+    stats = StreamingStats(capacity=3)
+    stats.seed('web-01', [(1000.0 + n, sample(cpu=float(n))) for n in range(10)])
+    check(stats.get('web-01', 'all'), [7.0, 8.0, 9.0])
+    assert stats.get('db-01', 'all') is None
+
+
+def test_reader_sees_none_while_the_writer_is_busy():
+    series = HostStats(capacity=5)
+    series.add(1000.0, sample_values(sample(cpu=1.0)))
+    series.version += 1
+    assert series.result('all') is None
+    series.version += 1
+    assert series.result('all')['samples'] == 1
+
+
+def test_sample_values_reads_load_and_fullest_partition():
+    metrics = make_sample()
+    metrics['cpu']['load_average'] = [1.0, 2.0]
+    metrics['disk']['partitions'] = [{'percent': 40.0}, {'percent': None}, {'percent': 90.5}]
+    values = dict(zip(('load_1m', 'load_5m', 'load_15m'), sample_values(metrics)[3:6]))
+    assert values['load_1m'] == 1.0 and values['load_5m'] == 2.0 and math.isnan(values['load_15m'])
+    assert sample_values(metrics)[-1] == 90.5
+
+
+if __name__ == '__main__':
+    tests = [(name, func) for name, func in sorted(globals().items()) if name.startswith('test_')]
+    failed = 0
+
+    for name, func in tests:
+        try:
+            func()
+            print(f"✓ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"✗ {name}: {type(e).__name__}: {e}")
+
+    print(f"\n{len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Tests for the top hosts rankings
+Moves hosts around a RankedIndex and ranks hosts fed through StreamingStats, comparing with a
+sort of the whole fleet
+
+Run with: python test_top_hosts.py  (or pytest test_top_hosts.py)
+"""
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, 'backend'))
+
+from streaming_stats import STATS_METRICS, StreamingStats
+from top_hosts import RankedIndex, TopHosts
+from test_streaming_stats import sample
+
+NAN = float('nan')
+
+
+def everyone(hostname):
+    return True
+
+
+def test_top_matches_a_full_sort_after_updates():
+    index = RankedIndex()
+    rng = random.Random(1)
+    values = {}
+    for _ in range(2000):
+        hostname = f"host-{rng.randrange(200):03d}"
+        values[hostname] = float(rng.randrange(50))  # plenty of ties
+        index.set(hostname, values[hostname])
+
+    expected = sorted(((value, hostname) for hostname, value in values.items()), reverse=True)[:10]
+    assert index.top(10, everyone) == [(hostname, value) for value, hostname in expected]
+    assert len(index.keys) == len(values) == 200
+    assert index.keys == sorted(index.keys)
+
+
+def test_setting_the_same_value_keeps_one_entry():
+    index = RankedIndex()
+    for _ in range(3):
+        index.set('web-01', 5.0)
+    assert index.keys == [(5.0, 'web-01')]
+
+
+def test_nan_takes_a_host_out_of_the_ranking():
+    index = RankedIndex()
+    index.set('web-01', 10.0)
+    index.set('web-02', 20.0)
+    index.set('web-02', NAN)
+    assert index.top(5, everyone) == [('web-01', 10.0)]
+    assert 'web-02' not in index.values
+    # Missing from the start is fine too
+    index.set('web-03', NAN)
+    assert index.keys == [(10.0, 'web-01')]
+
+
+def test_top_looks_past_excluded_hosts():
+    index = RankedIndex()
+    for n in range(100):
+        index.set(f"host-{n:03d}", float(n))
+    # The 60 hottest hosts are excluded: more than the first slice of 2 * k entries
+    include = lambda hostname: int(hostname[5:]) < 40
+    assert index.top(3, include) == [('host-039', 39.0), ('host-038', 38.0), ('host-037', 37.0)]
+    assert index.top(3, lambda hostname: False) == []
+    assert len(index.top(500, everyone)) == 100
+
+
+def test_top_hosts_ranks_every_window():
+    stats = StreamingStats(capacity=100)
+    top = TopHosts(STATS_METRICS)
+    for hostname, cpus in (('web-01', [90.0, 10.0]), ('web-02', [40.0, 50.0]), ('web-03', [20.0, 30.0])):
+        for n, cpu in enumerate(cpus):
+            stats.add(hostname, 1000.0 + n, sample(cpu=cpu))
+            top.update(hostname, 1000.0 + n, stats.hosts[hostname])
+
+    assert [hostname for hostname, _, _ in top.top('cpu', 'current', 3, 0)] == ['web-02', 'web-03', 'web-01']
+    assert [(hostname, value) for hostname, value, _ in top.top('cpu', '5m', 2, 0)] == \
+        [('web-01', 50.0), ('web-02', 45.0)]
+    assert top.top('cpu', 'current', 1, 0) == [('web-02', 50.0, 1001.0)]
+
+
+def test_summed_ranking_is_missing_when_a_series_is():
+    stats = StreamingStats(capacity=10)
+    top = TopHosts(STATS_METRICS)
+    metrics = sample(cpu=1.0)
+    metrics['io']['network'] = {'bytes_sent_per_sec': 100.0, 'bytes_recv_per_sec': 50.0}
+    stats.add('web-01', 1000.0, metrics)
+    top.update('web-01', 1000.0, stats.hosts['web-01'])
+    metrics = sample(cpu=1.0)
+    metrics['io']['network'] = {'bytes_sent_per_sec': 500.0}
+    stats.add('web-02', 1000.0, metrics)
+    top.update('web-02', 1000.0, stats.hosts['web-02'])
+
+    assert top.top('network', 'current', 5, 0) == [('web-01', 150.0, 1000.0)]
+    assert [hostname for hostname, _, _ in top.top('network_sent', 'current', 5, 0)] == ['web-02', 'web-01']
+
+
+def test_since_skips_hosts_that_stopped_reporting():
+    stats = StreamingStats(capacity=10)
+    top = TopHosts(STATS_METRICS)
+    for hostname, epoch, cpu in (('web-01', 1000.0, 99.0), ('web-02', 2000.0, 10.0), ('web-03', 2500.0, 5.0)):
+        stats.add(hostname, epoch, sample(cpu=cpu))
+        top.update(hostname, epoch, stats.hosts[hostname])
+
+    assert [hostname for hostname, _, _ in top.top('cpu', 'current', 2, 1500.0)] == ['web-02', 'web-03']
+    assert top.top('cpu', 'current', 1, 0)[0][0] == 'web-01'
+
+    # An older sample arriving late does not move the host's last report back
+    stats.add('web-02', 500.0, sample(cpu=10.0))
+    top.update('web-02', 500.0, stats.hosts['web-02'])
+    assert top.epochs['web-02'] == 2000.0
+
+
+if __name__ == '__main__':
+    tests = [(name, func) for name, func in sorted(globals().items()) if name.startswith('test_')]
+    failed = 0
+
+    for name, func in tests:
+        try:
+            func()
+            print(f"✓ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"✗ {name}: {type(e).__name__}: {e}")
+
+    print(f"\n{len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Round-trip tests for the binary sample wire format
+Encodes samples with the agent encoder and decodes them with the backend decoder
+
+Run with: python test_wire_format.py  (or pytest test_wire_format.py)
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, 'agent'))
+sys.path.insert(0, os.path.join(ROOT, 'backend'))
+
+import monitor_agent
+import wire_format
+
+
+def make_sample(first=False):
+    """Build a realistic sample, `first` mimics the agent's first cycle (no rates yet)"""
+    network = {
+        'bytes_sent': 123456789012, 'bytes_recv': 987654321098,
+        'packets_sent': 1234567, 'packets_recv': 7654321,
+        'errin': 0, 'errout': 1, 'dropin': 2, 'dropout': 3
+    }
+    disk_io = {
+        'read_count': 111111, 'write_count': 222222,
+        'read_bytes': 33333333333, 'write_bytes': 44444444444,
+        'read_time': 5555, 'write_time': 6666
+    }
+    if not first:
+        network.update({'bytes_sent_per_sec': 10240.5, 'bytes_recv_per_sec': 204800.25})
+        disk_io.update({'read_bytes_per_sec': 4096.0, 'write_bytes_per_sec': 8192.75})
+
+    return {
+        'timestamp': '2026-10-18T10:20:30.123456',
+        'cpu': {
+            'cpu_percent_total': 37.5,
+            'cpu_percent_per_core': [12.5, 99.9, 0.0, 42.1],
+            'cpu_count_logical': 4,
+            'cpu_count_physical': 2,
+            'cpu_freq_current': None if first else 2400.0,
+            'cpu_freq_min': None if first else 800.0,
+            'cpu_freq_max': None if first else 3600.0,
+            'load_average': None if first else [1.5, 1.25, 0.75]
+        },
+        'memory': {
+            'memory_total': 17179869184, 'memory_available': 8589934592,
+            'memory_used': 6442450944, 'memory_percent': 50.0,
+            'memory_free': 2147483648, 'swap_total': 4294967296,
+            'swap_used': 0, 'swap_free': 4294967296, 'swap_percent': 0.0
+        },
+        'disk': {
+            'partitions': [
+                {'device': '/dev/sda1', 'mountpoint': '/', 'fstype': 'ext4',
+                 'total': 107374182400, 'used': 53687091200, 'free': 53687091200, 'percent': 50.0},
+                {'device': '/dev/sdb1', 'mountpoint': '/data/ünïcode', 'fstype': 'xfs',
+                 'total': 1099511627776, 'used': 879609302220, 'free': 219902325556, 'percent': 80.0}
+            ]
+        },
+        'io': {'network': network, 'disk_io': disk_io},
+        'system': {'os': 'Linux', 'kernel': '6.1.0', 'uptime': '3d 4h 5m'}
+    }
+
+
+def test_round_trip_full_sample():
+    sample = make_sample()
+    decoded = wire_format.decode_samples(monitor_agent.encode_binary_sample(sample))
+    assert decoded == [sample]
+
+
+def test_round_trip_first_sample_without_rates():
+    sample = make_sample(first=True)
+    decoded, = wire_format.decode_samples(monitor_agent.encode_binary_sample(sample))
+    assert decoded == sample
+    assert 'bytes_sent_per_sec' not in decoded['io']['network']
+
+
+def test_round_trip_batch_of_records():
+    samples = [make_sample(first=True), make_sample(), dict(make_sample(), hostname='web-01')]
+    body = b''.join(monitor_agent.encode_binary_sample(sample) for sample in samples)
+    assert wire_format.decode_samples(body) == samples
+
+
+def test_timestamp_without_microseconds():
+    sample = dict(make_sample(), timestamp='2026-10-18T10:20:30')
+    decoded, = wire_format.decode_samples(monitor_agent.encode_binary_sample(sample))
+    assert decoded['timestamp'] == '2026-10-18T10:20:30'
+
+
+def test_round_trip_partition_usage_only():
+    sample = make_sample()
+    del sample['system']
+    sample['disk'] = {'usage': [[53687091200, 53687091200, 50.0], [879609302220, 219902325556, 80.0]]}
+    sample.update({'static': {'system': 'a1', 'disk': 'b2'}, 'uptime': '3d 4h 5m'})
+
+    record = monitor_agent.encode_binary_sample(sample)
+    assert record[4] == 2
+    assert wire_format.decode_samples(record) == [sample]
+
+
+def test_rejects_corrupt_records():
+    record = monitor_agent.encode_binary_sample(make_sample())
+
+    for corrupt in (record[:-1], record[:5], b'XXXX' + record[4:], record + b'\x00'):
+        try:
+            wire_format.decode_samples(corrupt)
+        except ValueError:
+            continue
+        raise AssertionError("corrupt record was accepted")
+
+
+if __name__ == '__main__':
+    tests = [(name, func) for name, func in sorted(globals().items()) if name.startswith('test_')]
+    failed = 0
+
+    for name, func in tests:
+        try:
+            func()
+            print(f"✓ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"✗ {name}: {type(e).__name__}: {e}")
+
+    print(f"\n{len(tests) - failed}/{len(tests)} tests passed")
+    sys.exit(1 if failed else 0)